@@ -1,15 +1,117 @@
-from typing import Optional
+import os
+from typing import Any, Dict, Optional
 
+from openai import OpenAI as OpenAIClient
 from phi.assistant import Assistant
 from phi.knowledge import AssistantKnowledge
-from phi.llm.groq import Groq
-from phi.llm.openai import OpenAIChat
 from phi.embedder.openai import OpenAIEmbedder
 from phi.embedder.ollama import OllamaEmbedder
-from phi.vectordb.pgvector import PgVector2
 from phi.storage.assistant.postgres import PgAssistantStorage
 
-db_url = "postgresql+psycopg://ai:ai@localhost:5532/ai"
+from budget import answer_tokens, budgeted_references
+from cache import LRUCache
+from chunking import set_strategy
+from db import get_engine
+from embedding_cache import CachedEmbedder
+from failover import FailoverGroq, FailoverOpenAIChat, llm_client
+from retrieval import set_settings as set_retrieval_settings
+from local_vector import VECTOR_BACKEND, LocalVectorDb
+from storage_profiles import get_profile, set_profile
+from shared_table import VECTOR_STORAGE_LAYOUT, SharedPgVector
+from vector_index import IndexedPgVector
+
+# Heavy components (clients, embedder, vector db, storage) are built once per
+# (provider, llm_model, embeddings_model, kb_name, storage profile) and reused across requests.
+# Only the Assistant and its LLM wrapper, which carry per-run state, are created per call.
+ASSISTANT_CACHE_SIZE = int(os.getenv("ASSISTANT_CACHE_SIZE", "256"))
+ASSISTANT_CACHE_TTL = float(os.getenv("ASSISTANT_CACHE_TTL", "1800"))
+component_cache = LRUCache(maxsize=ASSISTANT_CACHE_SIZE, ttl=ASSISTANT_CACHE_TTL)
+
+
+def get_embeddings_table(embeddings_model: str, user_id: Optional[str] = None) -> str:
+    """Name of the vector table holding the documents for a knowledge base."""
+    if embeddings_model == "nomic-embed-text":
+        return "groq_rag_documents_ollama"
+    # extra check for collection of tables/embedding models
+    groq_rag_documents_openai = "groq_rag_documents_openai"
+    if user_id is not None and user_id != '':
+        groq_rag_documents_openai = groq_rag_documents_openai + "_" + user_id
+    return groq_rag_documents_openai
+
+
+def get_storage_profile(embeddings_model: str, user_id: Optional[str] = None):
+    """Storage profile of a knowledge base; None for Ollama embeddings, which are stored as is."""
+    if embeddings_model == "nomic-embed-text":
+        return None
+    return get_profile(get_embeddings_table(embeddings_model, user_id))
+
+
+def set_storage_profile(embeddings_model: str, user_id: Optional[str], profile: Optional[str]) -> None:
+    """Choose the storage profile of a new knowledge base; see storage_profiles.set_profile."""
+    if embeddings_model != "nomic-embed-text":
+        set_profile(get_embeddings_table(embeddings_model, user_id), profile)
+
+
+def set_chunking_strategy(embeddings_model: str, user_id: Optional[str], strategy: Optional[str]) -> None:
+    """Choose the chunking strategy of a new knowledge base; see chunking.set_strategy."""
+    set_strategy(get_embeddings_table(embeddings_model, user_id), strategy)
+
+
+def set_retrieval(
+    embeddings_model: str,
+    user_id: Optional[str],
+    mode: Optional[str],
+    top_k: Optional[int],
+    reranker: Optional[str] = None,
+) -> None:
+    """Change how a knowledge base is searched (vector or hybrid, top_k, reranker); see retrieval.set_settings."""
+    set_retrieval_settings(get_embeddings_table(embeddings_model, user_id), mode, top_k, reranker)
+
+
+def _build_components(provider: str, embeddings_model: str, user_id: Optional[str], profile) -> Dict[str, Any]:
+    # Define the embedder based on the embeddings model
+    embedder = (
+        OllamaEmbedder(model=embeddings_model, dimensions=768)
+        if profile is None
+        else OpenAIEmbedder(model=embeddings_model, dimensions=profile.dimensions, openai_client=OpenAIClient())
+    )
+    # Look up the local embedding cache before calling the provider
+    embedder = CachedEmbedder(embedder=embedder, dimensions=embedder.dimensions)
+    embeddings_table = get_embeddings_table(embeddings_model, user_id)
+    print("building components for embeddings table ===== ", embeddings_table, " >> for user_id :", user_id)
+
+    vector_db_params = dict(db_engine=get_engine(), collection=embeddings_table, embedder=embedder, profile=profile)
+    if VECTOR_BACKEND == "local":
+        # Embeddings kept in memory-mapped files on this host, searched in process
+        vector_db = LocalVectorDb(collection=embeddings_table, embedder=embedder, profile=profile)
+    elif profile is not None and VECTOR_STORAGE_LAYOUT == "shared":
+        # Rows live in the shared table of the profile, tagged with the kb_name
+        vector_db = SharedPgVector(kb_name=user_id or '', **vector_db_params)
+    else:
+        vector_db = IndexedPgVector(**vector_db_params)
+
+    return {
+        "llm_client": llm_client(provider),
+        "storage": PgAssistantStorage(table_name="groq_rag_assistant", db_engine=get_engine()),
+        "knowledge_base": AssistantKnowledge(
+            vector_db=vector_db,
+            # 2 references are added to the prompt
+            num_documents=2,
+        ),
+    }
+
+
+def get_components(
+    provider: str, llm_model: str, embeddings_model: str, user_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """Get the cached heavy components for a provider/model/knowledge base combination."""
+    profile = get_storage_profile(embeddings_model, user_id)
+    key = (provider, llm_model, embeddings_model, user_id or '', profile)
+    return component_cache.get_or_create(key, lambda: _build_components(provider, embeddings_model, user_id, profile))
+
+
+def component_cache_stats() -> Dict[str, Any]:
+    return component_cache.stats()
 
 
 def get_groq_assistant(
@@ -21,40 +123,17 @@ def get_groq_assistant(
 ) -> Assistant:
     """Get a Groq RAG Assistant."""
 
-    # Define the embedder based on the embeddings model
-    embedder = (
-        OllamaEmbedder(model=embeddings_model, dimensions=768)
-        if embeddings_model == "nomic-embed-text"
-        else OpenAIEmbedder(model=embeddings_model, dimensions=3072)
-    )
-    # Define the embeddings table based on the embeddings model
-    # extra check for collection of tables/embedding models
-    groq_rag_documents_openai= "groq_rag_documents_openai"
-
-    if user_id is not None:
-        if user_id !='':
-            groq_rag_documents_openai = groq_rag_documents_openai+"_"+user_id
-    
-   
-    embeddings_table = (
-        "groq_rag_documents_ollama" if embeddings_model == "nomic-embed-text" else groq_rag_documents_openai
-    )
+    components = get_components("groq", llm_model, embeddings_model, user_id)
 
     return Assistant(
         name="groq_rag_assistant",
         run_id=run_id,
         user_id=user_id,
-        llm=Groq(model=llm_model),
-        storage=PgAssistantStorage(table_name="groq_rag_assistant", db_url=db_url),
-        knowledge_base=AssistantKnowledge(
-            vector_db=PgVector2(
-                db_url=db_url,
-                collection=embeddings_table,
-                embedder=embedder,
-            ),
-            # 2 references are added to the prompt
-            num_documents=2,
-        ),
+        # Trims history to the model's context window and caps the answer to the room left for it;
+        # falls back to another provider when Groq fails or is too slow (see failover.py)
+        llm=FailoverGroq(model=llm_model, groq_client=components["llm_client"], max_tokens=answer_tokens(llm_model)),
+        storage=components["storage"],
+        knowledge_base=components["knowledge_base"],
         description="You are an AI called 'Trainer Assistant' and your task is to answer questions using the provided information,focusing on clear explanations",
         instructions=[
                 "When a user asks a question, you will be provided with information relevant to the question from our knowledge base.",
@@ -65,6 +144,8 @@ def get_groq_assistant(
   ],
         # This setting adds references from the knowledge_base to the user prompt
         add_references_to_prompt=True,
+        # Deduplicated references cut to the token budget of the model
+        references_function=budgeted_references,
         # This setting tells the LLM to format messages in markdown
         markdown=True,
         # This setting adds chat history to the messages
@@ -82,42 +163,17 @@ def get_openai_assistant(
     run_id: Optional[str] = None,
     debug_mode: bool = True,
 ) -> Assistant:
-    """Get a Groq RAG Assistant."""
+    """Get an OpenAI RAG Assistant."""
 
-    # Define the embedder based on the embeddings model
-    embedder = (
-        OllamaEmbedder(model=embeddings_model, dimensions=768)
-        if embeddings_model == "nomic-embed-text"
-        else OpenAIEmbedder(model=embeddings_model, dimensions=3072)
-    )
-    # Define the embeddings table based on the embeddings model
-    # extra check for collection of tables/embedding models
-    groq_rag_documents_openai= "groq_rag_documents_openai"
-
-    if user_id is not None:
-        if user_id !='':
-            groq_rag_documents_openai = groq_rag_documents_openai+"_"+user_id
-    
-    print("before embedding model init groq_rag_documents_openai ===== ",groq_rag_documents_openai," >> for user_id :",user_id)
-    embeddings_table = (
-        "groq_rag_documents_ollama" if embeddings_model == "nomic-embed-text" else groq_rag_documents_openai
-    )
+    components = get_components("openai", llm_model, embeddings_model, user_id)
 
     return Assistant(
         name="groq_rag_assistant",
         run_id=run_id,
         user_id=user_id,
-        llm=OpenAIChat(model=llm_model),
-        storage=PgAssistantStorage(table_name="groq_rag_assistant", db_url=db_url),
-        knowledge_base=AssistantKnowledge(
-            vector_db=PgVector2(
-                db_url=db_url,
-                collection=embeddings_table,
-                embedder=embedder,
-            ),
-            # 2 references are added to the prompt
-            num_documents=2,
-        ),
+        llm=FailoverOpenAIChat(model=llm_model, client=components["llm_client"], max_tokens=answer_tokens(llm_model)),
+        storage=components["storage"],
+        knowledge_base=components["knowledge_base"],
        description="You are an AI called 'Trainer Assistant' and your task is to answer questions using the provided information,focusing on clear explanations",
         instructions=[
             "When a user asks a question, you will be provided with information relevant to the question from our knowledge base.",
@@ -130,6 +186,8 @@ def get_openai_assistant(
         ],
         # This setting adds references from the knowledge_base to the user prompt
         add_references_to_prompt=True,
+        # Deduplicated references cut to the token budget of the model
+        references_function=budgeted_references,
         # This setting tells the LLM to format messages in markdown
         markdown=True,
         # This setting adds chat history to the messages
@@ -0,0 +1,149 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+from phi.document import Document
+from phi.embedder.base import Embedder
+
+# Upper bounds for one embeddings request; the OpenAI API accepts up to 2048
+# inputs and roughly 300k tokens per request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))
+# Retries of a batch after rate limits, connection errors and 5xx. These are the
+# only retries: batch requests are sent with the SDK's own retries disabled
+# (see embedding_cache.provider_embeddings).
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+# Maximum number of embedding requests in flight per ingestion
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text with the cl100k tokenizer
+    return len(text) // 4 + 1
+
+
+def _retry_after(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        header = response.headers.get("retry-after")
+        if header:
+            try:
+                return float(header)
+            except ValueError:
+                pass
+    return min(60.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def _is_too_large(error: openai.BadRequestError) -> bool:
+    """Whether a 400 says the request had too many inputs or tokens, rather than that it was wrong."""
+    code = str(getattr(error, "code", None) or "")
+    message = str(getattr(error, "message", None) or error).lower()
+    return code in ("context_length_exceeded", "max_tokens_per_request") or any(
+        phrase in message
+        for phrase in ("maximum context length", "too many tokens", "tokens per request", "too many inputs", "maximum request size")
+    )
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class BatchEmbedder:
+    """Embeds documents in provider-sized batches on a bounded thread pool.
+
+    Batches are cut by document count and estimated token count. When the
+    provider rate limits us the token budget for later batches is halved, and
+    it grows back by 10% after each successful request. A batch the provider
+    rejects as too large is split in two and retried; other 400s are raised
+    at once.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        concurrency: int = EMBED_CONCURRENCY,
+        max_items: int = EMBED_BATCH_SIZE,
+        max_tokens: int = EMBED_BATCH_TOKENS,
+    ):
+        self.embedder = embedder
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self._token_budget = max_tokens
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed")
+
+    def __enter__(self) -> "BatchEmbedder":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._pool.shutdown(wait=True)
+
+    def make_batches(self, documents: List[Document]) -> List[List[Document]]:
+        with self._lock:
+            token_budget = self._token_budget
+        batches: List[List[Document]] = []
+        batch: List[Document] = []
+        batch_tokens = 0
+        for document in documents:
+            tokens = estimate_tokens(document.content)
+            if batch and (len(batch) >= self.max_items or batch_tokens + tokens > token_budget):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(document)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def submit(self, documents: List[Document]) -> List[Future]:
+        """Queue documents for embedding; each future resolves to that batch's stats."""
+        return [self._pool.submit(self._embed_batch, batch) for batch in self.make_batches(documents)]
+
+    def _request(self, texts: List[str]) -> Tuple[List[List[float]], Optional[Dict]]:
+        if hasattr(self.embedder, "get_embeddings_and_usage"):
+            return self.embedder.get_embeddings_and_usage(texts)
+        return [self.embedder.get_embedding(text) for text in texts], None
+
+    def _embed_batch(self, batch: List[Document]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        retries = 0
+        while True:
+            try:
+                embeddings, _ = self._request([document.content for document in batch])
+                break
+            except openai.BadRequestError as e:
+                if len(batch) == 1 or not _is_too_large(e):
+                    raise
+                # Too large for one request: split and embed the halves separately
+                middle = len(batch) // 2
+                first, second = self._embed_batch(batch[:middle]), self._embed_batch(batch[middle:])
+                return {
+                    "size": len(batch),
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+                    "retries": first["retries"] + second["retries"],
+                }
+            except Exception as e:
+                if not _is_retryable(e) or retries >= EMBED_MAX_RETRIES:
+                    raise
+                if isinstance(e, openai.RateLimitError):
+                    with self._lock:
+                        self._token_budget = max(1, self._token_budget // 2)
+                delay = _retry_after(e, retries)
+                logging.info(f"Embedding batch of {len(batch)} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                retries += 1
+
+        for document, embedding in zip(batch, embeddings):
+            document.embedding = embedding
+        with self._lock:
+            self._token_budget = min(self.max_tokens, int(self._token_budget * 1.1) + 1)
+        stats = {"size": len(batch), "latency_ms": round((time.perf_counter() - start) * 1000, 1), "retries": retries}
+        logging.info(f"Embedded batch of {stats['size']} in {stats['latency_ms']}ms ({retries} retries)")
+        return stats
@@ -0,0 +1,252 @@
+"""Keep every chat prompt inside the context window of its model.
+
+The prompt is the system prompt, the recent chat history and a user message
+carrying the knowledge base references. Before it is sent:
+
+- references (budgeted_references, the assistants' references_function) are
+  deduplicated, with the overlap between neighbouring chunks of a document
+  removed, and cut to what fits next to the system prompt and the question
+  with PROMPT_ANSWER_TOKENS left for the answer;
+- history (BudgetedGroq / BudgetedOpenAIChat) gets whatever room is left:
+  long past answers are shortened to PROMPT_HISTORY_MESSAGE_TOKENS, then
+  the oldest messages are dropped until the prompt fits.
+
+The answer is capped at PROMPT_ANSWER_TOKENS, so prompt and answer always
+fit. Token counts are kept per request (breakdown()).
+"""
+import json
+import logging
+import os
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from phi.document import Document
+from phi.llm.groq import Groq
+from phi.llm.message import Message
+from phi.llm.openai import OpenAIChat
+
+from chunking import count_tokens
+
+# Context window of each chat model, in tokens; unknown models get DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS: Dict[str, int] = {
+    "llama3-8b-8192": 8192,
+    "llama3-70b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+    "gemma-7b-it": 8192,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "8192"))
+# Tokens kept free for the answer, which is capped at this length
+PROMPT_ANSWER_TOKENS = int(os.getenv("PROMPT_ANSWER_TOKENS", "1024"))
+# Past messages longer than this are shortened before any is dropped
+PROMPT_HISTORY_MESSAGE_TOKENS = int(os.getenv("PROMPT_HISTORY_MESSAGE_TOKENS", "300"))
+# Share of the window left unused: the models' tokenizers differ from the one counted with
+PROMPT_SAFETY_MARGIN = float(os.getenv("PROMPT_SAFETY_MARGIN", "0.05"))
+# Tokens of role markers and separators per message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Wording phidata puts around the question and the references (Assistant.get_user_prompt)
+USER_PROMPT_TEMPLATE_TOKENS = 80
+# Neighbouring chunks sharing at least this many characters are merged
+MIN_OVERLAP_CHARS = 40
+
+# Token breakdown of the current request's prompt
+_breakdown: ContextVar[Optional[Dict[str, Any]]] = ContextVar("prompt_breakdown", default=None)
+
+
+def breakdown() -> Optional[Dict[str, Any]]:
+    """Tokens of each part of the last prompt this request sent, or None if it sent none."""
+    return _breakdown.get()
+
+
+def reset_breakdown() -> None:
+    _breakdown.set(None)
+
+
+def context_window(model: str) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+def prompt_budget(model: str, window: Optional[int] = None) -> int:
+    """Tokens the prompt may use: the window (the model's by default) less the safety margin and the answer."""
+    window = window or context_window(model)
+    return int(window * (1 - PROMPT_SAFETY_MARGIN)) - min(PROMPT_ANSWER_TOKENS, window // 4)
+
+
+def answer_tokens(model: str) -> int:
+    return min(PROMPT_ANSWER_TOKENS, context_window(model) // 4)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """The longest prefix of `text` (cut at a word) within `max_tokens`."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text[:low]
+    return (cut.rsplit(" ", 1)[0] if " " in cut else cut) + " ..."
+
+
+def _overlap(first: str, second: str) -> int:
+    """Length of the longest suffix of `first` that starts `second` (at least MIN_OVERLAP_CHARS)."""
+    if len(first) < MIN_OVERLAP_CHARS or len(second) < MIN_OVERLAP_CHARS:
+        return 0
+    head = second[:MIN_OVERLAP_CHARS]
+    start = first.find(head, max(0, len(first) - len(second)))
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(head, start + 1)
+    return 0
+
+
+def dedupe_documents(documents: List[Document]) -> List[Document]:
+    """Drop repeated chunks and remove the text a chunk shares with a neighbour already kept."""
+    kept: List[Document] = []
+    for document in documents:
+        content = document.content.strip()
+        for other in kept:
+            if content in other.content:
+                content = ""
+                break
+            if other.name != document.name:
+                continue
+            # Chunk overlap: the end of one chunk repeats at the start of the next
+            content = content[_overlap(other.content, content):]
+            cut = _overlap(content, other.content)
+            if cut:
+                content = content[:-cut]
+        if content.strip():
+            kept.append(document.model_copy(update={"content": content.strip()}))
+    return kept
+
+
+def budgeted_references(assistant: Any, query: str, num_documents: Optional[int] = None) -> Optional[str]:
+    """The references_function of the assistants: the search results that fit the model's budget."""
+    if assistant.knowledge_base is None:
+        return None
+    model = assistant.llm.model
+    # The references must also fit the model the answer may fail over to
+    window = min(context_window(answer_model) for answer_model in assistant.llm.answer_models())
+    searched = assistant.knowledge_base.search(query=query, num_documents=num_documents)
+    documents = dedupe_documents(searched)
+
+    system_tokens = count_tokens(assistant.get_system_prompt() or "") + MESSAGE_OVERHEAD_TOKENS
+    # The question is in the user prompt twice
+    question_tokens = 2 * count_tokens(query) + USER_PROMPT_TEMPLATE_TOKENS + MESSAGE_OVERHEAD_TOKENS
+    available = prompt_budget(model, window) - system_tokens - question_tokens
+
+    references: List[Dict[str, Any]] = []
+    used = 0
+    for document in documents:
+        reference = {"name": document.name, "meta_data": document.meta_data, "content": document.content}
+        tokens = count_tokens(json.dumps(reference, indent=2))
+        if used + tokens > available:
+            # Part of the first chunk that does not fit is better than no reference at all
+            room = available - used - count_tokens(json.dumps({**reference, "content": ""}, indent=2))
+            if not references and room > 0:
+                reference["content"] = truncate_tokens(document.content, room)
+                references.append(reference)
+                used += count_tokens(json.dumps(reference, indent=2))
+            break
+        references.append(reference)
+        used += tokens
+
+    _breakdown.set(
+        {
+            "model": model,
+            "context_window": window,
+            "system": system_tokens,
+            "question": question_tokens,
+            "references": used,
+            "references_searched": len(searched),
+            "references_deduplicated": len(searched) - len(documents),
+            "references_dropped": len(documents) - len(references),
+        }
+    )
+    if not references:
+        return None
+    return json.dumps(references, indent=2)
+
+
+def fit_messages(messages: List[Message], model: str) -> Dict[str, Any]:
+    """Shorten, then drop, the oldest history until the messages fit the model's budget.
+
+    `messages` is edited in place: phidata appends the answer to the same list.
+    History is every message between the system prompt and the last message.
+    """
+    budget = prompt_budget(model)
+
+    def tokens(message: Message) -> int:
+        return count_tokens(message.get_content_string()) + MESSAGE_OVERHEAD_TOKENS
+
+    first = 1 if messages and messages[0].role == "system" else 0
+    history = messages[first:-1] if len(messages) > first else []
+    fixed = sum(tokens(message) for message in messages[:first] + messages[len(messages) - 1:])
+    history_tokens = [tokens(message) for message in history]
+
+    shortened = 0
+    if fixed + sum(history_tokens) > budget:
+        for index, message in enumerate(history):
+            if message.role == "assistant" and history_tokens[index] > PROMPT_HISTORY_MESSAGE_TOKENS:
+                content = truncate_tokens(message.get_content_string(), PROMPT_HISTORY_MESSAGE_TOKENS)
+                history[index] = message.model_copy(update={"content": content})
+                history_tokens[index] = tokens(history[index])
+                shortened += 1
+    dropped = 0
+    while history and fixed + sum(history_tokens) > budget:
+        history.pop(0)
+        history_tokens.pop(0)
+        dropped += 1
+    # Never start the history with an answer whose question was dropped
+    if dropped and history and history[0].role == "assistant":
+        history.pop(0)
+        history_tokens.pop(0)
+        dropped += 1
+    messages[first:len(messages) - 1] = history
+
+    total = fixed + sum(history_tokens)
+    if total > budget:
+        logging.warning(f"Prompt of {total} tokens exceeds the {budget} token budget of {model}")
+    result = dict(_breakdown.get() or {"model": model, "context_window": context_window(model)})
+    result.update(
+        history=sum(history_tokens),
+        history_messages=len(history),
+        history_shortened=shortened,
+        history_dropped=dropped,
+        prompt=total,
+        answer_reserved=answer_tokens(model),
+    )
+    _breakdown.set(result)
+    return result
+
+
+class _BudgetedLLM:
+    """Fits the messages to the model's budget before every request to the LLM."""
+
+    def answer_models(self) -> List[str]:
+        """Models that may answer a request made to this LLM."""
+        return [self.model]
+
+    def response(self, messages: List[Message]) -> str:
+        fit_messages(messages, self.model)
+        return super().response(messages)
+
+    def response_stream(self, messages: List[Message]) -> Iterator[str]:
+        fit_messages(messages, self.model)
+        yield from super().response_stream(messages)
+
+
+class BudgetedGroq(_BudgetedLLM, Groq):
+    pass
+
+
+class BudgetedOpenAIChat(_BudgetedLLM, OpenAIChat):
+    pass
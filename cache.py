@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe bounded LRU cache with an optional idle TTL.
+
+    Entries are evicted when the cache grows past `maxsize` (least recently used first)
+    or when they have not been accessed for `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._last_used: Dict[Hashable, float] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, key: Hashable, now: float) -> bool:
+        return self.ttl is not None and now - self._last_used[key] > self.ttl
+
+    def _evict_expired(self, now: float) -> None:
+        if self.ttl is None:
+            return
+        for key in [k for k in self._data if self._expired(k, now)]:
+            del self._data[key]
+            del self._last_used[key]
+            self.expirations += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            now = time.monotonic()
+            if key in self._data and not self._expired(key, now):
+                self._data.move_to_end(key)
+                self._last_used[key] = now
+                self.hits += 1
+                return self._data[key]
+            if key in self._data:
+                del self._data[key]
+                del self._last_used[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._last_used[key] = now
+            self._evict_expired(now)
+            while len(self._data) > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                del self._last_used[old_key]
+                self.evictions += 1
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the cached value for `key`, building it with `factory` on a miss."""
+        _missing = object()
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+        # Build outside the lock so a slow factory doesn't block other keys
+        value = factory()
+        with self._lock:
+            existing = self._data.get(key, _missing)
+            if existing is not _missing:
+                return existing
+            self.set(key, value)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            self._last_used.pop(key, None)
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._last_used.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data and not self._expired(key, time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
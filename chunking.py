@@ -0,0 +1,358 @@
+"""Token budgeted, structure aware chunking of parsed documents.
+
+The readers' own chunking cuts the whitespace-collapsed text every N
+characters. The "tokens" strategies instead split the raw text into headings,
+tables and sentences and pack them into chunks of at most max_tokens tokens:
+a chunk never ends mid-sentence or mid-row, a heading starts a new chunk
+unless the current one is still small, and consecutive chunks share up to
+overlap_tokens tokens of trailing sentences.
+
+Compare the strategies on your own documents with:
+
+    python chunking.py benchmark FILE [FILE ...] [--queries 50] [--k 3]
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from phi.document import Document
+from sqlalchemy.inspection import inspect
+
+import manifest
+from batch_embed import estimate_tokens
+from db import get_engine
+
+
+class ChunkSettings(NamedTuple):
+    max_tokens: int
+    overlap_tokens: int = 0
+
+
+def _settings(file_type: str, max_tokens: int, overlap_tokens: int) -> ChunkSettings:
+    return ChunkSettings(
+        int(os.getenv(f"CHUNK_TOKENS_{file_type}", str(max_tokens))),
+        int(os.getenv(f"CHUNK_OVERLAP_{file_type}", str(overlap_tokens))),
+    )
+
+
+# Chunk size and overlap per file type for the "tokens" strategy
+CHUNK_SETTINGS: Dict[str, ChunkSettings] = {
+    '.pdf': _settings("PDF", 512, 64),
+    '.docx': _settings("DOCX", 512, 64),
+    '.json': _settings("JSON", 256, 0),
+    '.txt': _settings("TXT", 256, 32),
+    # Crawled web pages (crawler.py)
+    '.html': _settings("HTML", 384, 48),
+}
+
+# None keeps the readers' fixed size character chunks
+CHUNKING_STRATEGIES: Dict[str, Optional[Dict[str, ChunkSettings]]] = {
+    "chars": None,
+    "tokens": CHUNK_SETTINGS,
+    "tokens-small": {
+        extension: ChunkSettings(settings.max_tokens // 2, settings.overlap_tokens // 2)
+        for extension, settings in CHUNK_SETTINGS.items()
+    },
+}
+
+# Strategy given to new knowledge bases when the upload does not ask for one.
+# Knowledge bases that already have documents keep "chars".
+CHUNKING_STRATEGY = os.getenv("CHUNKING_STRATEGY", "tokens")
+# tiktoken encoding used to count tokens; estimated from the length without it
+CHUNK_TOKEN_ENCODING = os.getenv("CHUNK_TOKEN_ENCODING", "cl100k_base")
+# A heading only starts a new chunk once the current one has this share of max_tokens
+HEADING_BREAK_RATIO = 0.25
+
+HEADING_PATTERN = re.compile(
+    r"^(#{1,6}\s+\S.*"  # markdown
+    r"|(\d+(\.\d+)*\.?|[IVXLC]+\.)\s+[A-Z][^.!?]{0,80}"  # numbered section
+    r"|[A-Z][A-Z0-9 ,&/:'()-]{2,80})$"  # all caps
+)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=\S)")
+
+_encoding: Any = None
+_encoding_loaded = False
+_strategies: Dict[str, str] = {}
+_strategies_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding(CHUNK_TOKEN_ENCODING)
+        except Exception as e:
+            # Not installed, or the encoding could not be downloaded
+            logging.warning(f"Estimating token counts, tiktoken is unavailable: {e}")
+        _encoding_loaded = True
+    if _encoding is None:
+        return estimate_tokens(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+class _Unit(NamedTuple):
+    text: str
+    tokens: int
+    heading: bool = False
+    # Starts a new paragraph, table row or heading, joined with a newline
+    new_block: bool = True
+
+
+def _is_table_row(line: str) -> bool:
+    return line.count("|") >= 2 or "\t" in line
+
+
+def _is_heading(line: str) -> bool:
+    return len(line) <= 100 and not line.endswith((".", ",", ";")) and HEADING_PATTERN.match(line) is not None
+
+
+def _split_words(text: str, max_tokens: int) -> List[str]:
+    """Split text without sentence boundaries into pieces of at most max_tokens."""
+    words = text.split()
+    pieces = max(1, -(-count_tokens(text) // max_tokens))
+    size = -(-len(words) // pieces)
+    return [" ".join(words[i:i + size]) for i in range(0, len(words), size)]
+
+
+def _units(text: str, max_tokens: int) -> List[_Unit]:
+    """Headings, table rows and sentences of the text, each at most max_tokens."""
+    units: List[_Unit] = []
+    paragraph: List[str] = []
+
+    def add(piece: str, heading: bool = False, new_block: bool = True) -> None:
+        tokens = count_tokens(piece)
+        if tokens <= max_tokens:
+            units.append(_Unit(piece, tokens, heading, new_block))
+            return
+        for i, part in enumerate(_split_words(piece, max_tokens)):
+            units.append(_Unit(part, count_tokens(part), heading, new_block and i == 0))
+
+    def end_paragraph() -> None:
+        if paragraph:
+            for i, sentence in enumerate(SENTENCE_END.split(" ".join(paragraph))):
+                add(sentence, new_block=i == 0)
+            paragraph.clear()
+
+    for line in text.splitlines():
+        if _is_table_row(line):
+            end_paragraph()
+            add(re.sub(r"[ \t]+", " ", line.strip()))
+            continue
+        line = re.sub(r"\s+", " ", line).strip()
+        if not line:
+            end_paragraph()
+        elif _is_heading(line):
+            end_paragraph()
+            add(line, heading=True)
+        else:
+            paragraph.append(line)
+    end_paragraph()
+    return units
+
+
+def split_text(text: str, settings: ChunkSettings) -> List[str]:
+    """Pack the text's headings, rows and sentences into chunks of at most settings.max_tokens."""
+    chunks: List[str] = []
+    current: List[_Unit] = []
+    current_tokens = 0
+    # Leading units of `current` repeated from the previous chunk
+    carried_count = 0
+
+    def emit(overlap: bool) -> None:
+        nonlocal current, current_tokens, carried_count
+        # A heading belongs with the text after it
+        trailing: List[_Unit] = []
+        while len(current) > 1 and current[-1].heading:
+            trailing.insert(0, current.pop())
+        parts: List[str] = []
+        for unit in current:
+            parts.append(("\n" if unit.new_block else " ") + unit.text if parts else unit.text)
+        chunks.append("".join(parts))
+        carried: List[_Unit] = []
+        if overlap and not trailing:
+            carried_tokens = 0
+            for unit in reversed(current):
+                if unit.heading or carried_tokens + unit.tokens > settings.overlap_tokens:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit.tokens
+        current = carried + trailing
+        current_tokens = sum(unit.tokens for unit in current)
+        carried_count = len(carried)
+
+    for unit in _units(text, settings.max_tokens):
+        if unit.heading and current_tokens >= settings.max_tokens * HEADING_BREAK_RATIO:
+            emit(overlap=False)
+        if current_tokens + unit.tokens > settings.max_tokens:
+            emit(overlap=True)
+            if current_tokens + unit.tokens > settings.max_tokens:
+                # Not even the overlap fits with this unit
+                current = current[carried_count:]
+                current_tokens = sum(kept.tokens for kept in current)
+                carried_count = 0
+        current.append(unit)
+        current_tokens += unit.tokens
+    if len(current) > carried_count:
+        emit(overlap=False)
+    return chunks
+
+
+def chunk_documents(documents: List[Document], settings: ChunkSettings) -> List[Document]:
+    """Split documents into token budgeted chunks, with the ids the readers' chunking gives."""
+    chunked: List[Document] = []
+    for document in documents:
+        for chunk_number, content in enumerate(split_text(document.content, settings), start=1):
+            meta_data = dict(document.meta_data or {})
+            meta_data["chunk"] = chunk_number
+            meta_data["chunk_size"] = len(content)
+            chunk_id = None
+            if document.id:
+                chunk_id = f"{document.id}_{chunk_number}"
+            elif document.name:
+                chunk_id = f"{document.name}_{chunk_number}"
+            chunked.append(Document(id=chunk_id, name=document.name, meta_data=meta_data, content=content))
+    return chunked
+
+
+def chunk_settings(strategy: str, file_name: str) -> Optional[ChunkSettings]:
+    """Settings a strategy uses for a file, or None to keep the reader's chunking."""
+    settings = CHUNKING_STRATEGIES[strategy]
+    if settings is None:
+        return None
+    return settings.get(os.path.splitext(file_name)[-1].lower())
+
+
+def _has_documents(collection: str) -> bool:
+    return manifest.has_entries(collection) or inspect(get_engine()).has_table(collection, schema="ai")
+
+
+def get_strategy(collection: str) -> str:
+    """Chunking strategy of a knowledge base."""
+    if collection in _strategies:
+        return _strategies[collection]
+    name = manifest.get_chunking(collection)
+    if name is None and _has_documents(collection):
+        name = manifest.save_chunking(collection, "chars")
+    if name is None:
+        # New knowledge base: the first upload records its strategy
+        return CHUNKING_STRATEGY
+    with _strategies_lock:
+        _strategies[collection] = name
+    return name
+
+
+def set_strategy(collection: str, name: Optional[str] = None) -> str:
+    """Fix the chunking strategy of a knowledge base before its first documents are stored.
+
+    Raises ValueError for an unknown strategy or one that differs from the
+    strategy the knowledge base already uses.
+    """
+    if name is not None and name not in CHUNKING_STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy '{name}', expected one of {', '.join(CHUNKING_STRATEGIES)}")
+    current = get_strategy(collection)
+    if collection in _strategies:
+        if name is not None and name != current:
+            raise ValueError(f"Knowledge base already uses the '{current}' chunking strategy")
+        return current
+
+    saved = manifest.save_chunking(collection, name or CHUNKING_STRATEGY)
+    if name is not None and saved != name:
+        raise ValueError(f"Knowledge base already uses the '{saved}' chunking strategy")
+    with _strategies_lock:
+        _strategies[collection] = saved
+    return saved
+
+
+def benchmark(
+    paths: List[str],
+    strategies: List[str],
+    queries: int = 50,
+    k: int = 3,
+    embeddings_model: str = "text-embedding-3-large",
+    dimensions: int = 3072,
+    seed: int = 0,
+) -> Dict[str, Dict[str, Any]]:
+    """Chunk counts, sizes and retrieval hit rate of each strategy on the given files.
+
+    The queries are sentences sampled from the files. A query is a hit when
+    one of the k chunks most similar to it contains its middle eight words.
+    """
+    import numpy as np
+    from phi.embedder.openai import OpenAIEmbedder
+
+    # Imported here: ingest chunks with this module
+    from batch_embed import BatchEmbedder
+    from ingest import read_file
+
+    embedder = OpenAIEmbedder(model=embeddings_model, dimensions=dimensions)
+    whole = ChunkSettings(max_tokens=10**9)
+    sentences: List[str] = []
+    chunks: Dict[str, List[Document]] = {strategy: [] for strategy in strategies}
+    for path in paths:
+        file_name = os.path.basename(path)
+        for document in read_file(path, file_name, whole):
+            sentences.extend(
+                unit.text for unit in _units(document.content, whole.max_tokens)
+                if not unit.heading and len(unit.text.split()) >= 12
+            )
+        for strategy in strategies:
+            chunks[strategy].extend(read_file(path, file_name, chunk_settings(strategy, file_name)))
+    if not sentences:
+        raise ValueError("No sentences of 12 words or more to query with")
+    random.Random(seed).shuffle(sentences)
+    questions = [Document(content=sentence) for sentence in sentences[:queries]]
+    needles = []
+    for question in questions:
+        words = question.content.split()
+        middle = len(words) // 2
+        needles.append(" ".join(words[middle - 4:middle + 4]).lower())
+
+    def embed(documents: List[Document]) -> Any:
+        with BatchEmbedder(embedder) as batch_embedder:
+            for future in batch_embedder.submit(documents):
+                future.result()
+        matrix = np.array([document.embedding for document in documents], dtype=np.float32)
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    question_matrix = embed(questions)
+    results: Dict[str, Dict[str, Any]] = {}
+    for strategy, documents in chunks.items():
+        tokens = [count_tokens(document.content) for document in documents]
+        contents = [" ".join(document.content.split()).lower() for document in documents]
+        top = np.argsort(-(question_matrix @ embed(documents).T), axis=1)[:, :k]
+        hits = sum(any(needle in contents[i] for i in row) for needle, row in zip(needles, top))
+        results[strategy] = {
+            "chunks": len(documents),
+            "tokens": sum(tokens),
+            "avg_tokens": round(sum(tokens) / max(1, len(tokens)), 1),
+            "max_tokens": max(tokens, default=0),
+            f"hit_rate@{k}": round(hits / len(questions), 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    benchmark_parser = subparsers.add_parser("benchmark", help="compare chunking strategies on some files")
+    benchmark_parser.add_argument("paths", nargs="+", metavar="FILE")
+    benchmark_parser.add_argument("--strategy", action="append", dest="strategies", choices=list(CHUNKING_STRATEGIES))
+    benchmark_parser.add_argument("--queries", type=int, default=50)
+    benchmark_parser.add_argument("--k", type=int, default=3)
+    benchmark_parser.add_argument("--model", default="text-embedding-3-large")
+    benchmark_parser.add_argument("--dimensions", type=int, default=3072)
+    args = parser.parse_args()
+    results = benchmark(
+        args.paths, args.strategies or list(CHUNKING_STRATEGIES), args.queries, args.k, args.model, args.dimensions
+    )
+    columns = list(next(iter(results.values())))
+    print(f"{'strategy':<14}" + "".join(f"{column:>14}" for column in columns))
+    for strategy, result in results.items():
+        print(f"{strategy:<14}" + "".join(f"{result[column]:>14}" for column in columns))
@@ -0,0 +1,372 @@
+"""Concurrent, polite website crawler for URL ingestion.
+
+Pages are fetched concurrently, at most CRAWL_HOST_CONCURRENCY at a time per
+host and CRAWL_DELAY seconds apart (or the robots.txt Crawl-delay when
+longer), skipping what robots.txt disallows. Every page is kept in an on-disk
+cache with its ETag / Last-Modified, so a re-crawl revalidates it with a
+conditional GET and unchanged pages cost a 304. Pages are ingested through the
+manifest (see ingest.ingest_documents), so only pages whose text changed are
+embedded again, and after a complete crawl the pages of earlier crawls from
+the same start URL that were not found again are removed. Re-crawl a knowledge base with:
+
+    python crawler.py KB_NAME URL [--max-pages N] [--max-depth N]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+import httpx
+from bs4 import BeautifulSoup
+from phi.document import Document
+from phi.document.reader.website import WebsiteReader
+
+import manifest
+from chunking import chunk_documents, chunk_settings, get_strategy
+from ingest import ingest_documents, remove_sources
+
+# Defaults for a crawl that does not set its own limits (WebsiteReader's)
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "10"))
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "3"))
+# Requests in flight per crawl, and per host
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "16"))
+CRAWL_HOST_CONCURRENCY = int(os.getenv("CRAWL_HOST_CONCURRENCY", "2"))
+# Minimum seconds between two requests to the same host
+CRAWL_DELAY = float(os.getenv("CRAWL_DELAY", "0.5"))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "10"))
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "phi-api-crawler/1.0")
+CRAWL_CACHE_PATH = os.getenv("CRAWL_CACHE_PATH", os.path.join("uploads", "crawl_cache.sqlite3"))
+
+SKIPPED_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".svg", ".zip")
+CONTENT_CLASSES = ("content", "main-content", "post-content")
+
+
+class Page(NamedTuple):
+    url: str
+    content: str
+    links: List[str]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class PageCache:
+    """Last fetched version of every crawled page, in a local SQLite file.
+
+    Shared by every knowledge base: it only saves downloads, the manifest
+    decides what each knowledge base has to embed.
+    """
+
+    def __init__(self, path: str = CRAWL_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content TEXT NOT NULL,
+                links TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, url: str) -> Optional[Page]:
+        try:
+            row = self._conn().execute(
+                "SELECT url, content, links, etag, last_modified FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Page cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        return Page(row[0], row[1], json.loads(row[2]), row[3], row[4])
+
+    def put(self, page: Page) -> None:
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, content, links, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (page.url, page.etag, page.last_modified, page.content, json.dumps(page.links), time.time()),
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Page cache write failed: {e}")
+
+
+_cache: Optional[PageCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_page_cache() -> PageCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = PageCache()
+    return _cache
+
+
+def extract_page(html: str, url: str) -> Tuple[str, List[str]]:
+    """Main text and outgoing links of an HTML page.
+
+    The text comes from <article>, <main> or a "content" element like
+    WebsiteReader's, else from the <body> without navigation; block elements
+    are kept on separate lines for the chunker.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    links = [urldefrag(urljoin(url, link["href"]))[0] for link in soup.find_all("a", href=True)]
+    element = soup.find("article") or soup.find("main")
+    for class_name in CONTENT_CLASSES:
+        element = element or soup.find(class_=class_name)
+    if element is None and soup.body is not None:
+        for tag in soup.body.find_all(["script", "style", "nav", "header", "footer", "noscript"]):
+            tag.decompose()
+        element = soup.body
+    content = element.get_text(separator="\n", strip=True) if element is not None else ""
+    return content, links
+
+
+class _Host:
+    def __init__(self) -> None:
+        self.slots = asyncio.Semaphore(CRAWL_HOST_CONCURRENCY)
+        self.turn = asyncio.Lock()
+        self.next_request = 0.0
+        self.delay = CRAWL_DELAY
+        self.robots: Optional[RobotFileParser] = None
+        self.robots_lock = asyncio.Lock()
+
+
+class Crawler:
+    """Breadth-first crawl of the pages on the start URL's domain, like WebsiteReader's.
+
+    `pages` holds up to max_pages pages with text, in discovery order; `stats`
+    counts pages fetched, revalidated (304), disallowed by robots.txt, skipped
+    (not HTML, or a 4xx status) and failed (errors, 429 and 5xx statuses).
+    """
+
+    def __init__(
+        self,
+        start_url: str,
+        max_pages: int = CRAWL_MAX_PAGES,
+        max_depth: int = CRAWL_MAX_DEPTH,
+        cache: Optional[PageCache] = None,
+    ):
+        self.start_url = urldefrag(start_url)[0]
+        self.max_pages = max_pages
+        self.max_depth = max_depth
+        self.cache = cache or get_page_cache()
+        # Same scope as WebsiteReader: the primary domain and its subdomains
+        self.domain = ".".join(urlparse(self.start_url).netloc.split(".")[-2:])
+        self.pages: List[Page] = []
+        self.stats = {"fetched": 0, "not_modified": 0, "disallowed": 0, "skipped": 0, "failed": 0}
+        self._hosts: Dict[str, _Host] = {}
+        self._seen: Set[str] = set()
+        # Pages were left out because max_pages was reached
+        self.truncated = False
+
+    @property
+    def complete(self) -> bool:
+        """Whether every page within max_depth was visited: only then are missing pages really gone."""
+        return not self.truncated and self.stats["failed"] == 0
+
+    def in_scope(self, url: str) -> bool:
+        parsed = urlparse(url)
+        return (
+            parsed.scheme in ("http", "https")
+            and parsed.netloc.endswith(self.domain)
+            and not parsed.path.lower().endswith(SKIPPED_EXTENSIONS)
+        )
+
+    async def run(self) -> List[Page]:
+        queue: asyncio.Queue = asyncio.Queue()
+        queue.put_nowait((self.start_url, 1))
+        self._seen.add(self.start_url)
+        async with httpx.AsyncClient(
+            timeout=CRAWL_TIMEOUT,
+            follow_redirects=True,
+            headers={"User-Agent": CRAWL_USER_AGENT},
+            limits=httpx.Limits(max_connections=CRAWL_CONCURRENCY),
+        ) as client:
+            workers = [asyncio.create_task(self._work(client, queue)) for _ in range(CRAWL_CONCURRENCY)]
+            await queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return self.pages
+
+    async def _work(self, client: httpx.AsyncClient, queue: asyncio.Queue) -> None:
+        while True:
+            url, depth = await queue.get()
+            try:
+                if len(self.pages) >= self.max_pages:
+                    self.truncated = True
+                    continue
+                page = await self._fetch(client, url)
+                if page is None:
+                    continue
+                if page.content:
+                    if len(self.pages) < self.max_pages:
+                        self.pages.append(page)
+                    else:
+                        self.truncated = True
+                if depth < self.max_depth:
+                    for link in page.links:
+                        if link not in self._seen and self.in_scope(link):
+                            self._seen.add(link)
+                            queue.put_nowait((link, depth + 1))
+            except Exception as e:
+                self.stats["failed"] += 1
+                logging.warning(f"Could not crawl {url}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _host(self, client: httpx.AsyncClient, url: str) -> _Host:
+        parsed = urlparse(url)
+        host = self._hosts.setdefault(parsed.netloc, _Host())
+        async with host.robots_lock:
+            if host.robots is None:
+                robots = RobotFileParser()
+                try:
+                    response = await client.get(f"{parsed.scheme}://{parsed.netloc}/robots.txt")
+                    if response.status_code in (401, 403):
+                        robots.disallow_all = True
+                    elif response.status_code == 200:
+                        robots.parse(response.text.splitlines())
+                    else:
+                        robots.allow_all = True
+                except httpx.HTTPError:
+                    robots.allow_all = True
+                host.delay = max(CRAWL_DELAY, float(robots.crawl_delay(CRAWL_USER_AGENT) or 0))
+                host.robots = robots
+        return host
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str) -> Optional[Page]:
+        host = await self._host(client, url)
+        if not host.robots.can_fetch(CRAWL_USER_AGENT, url):
+            self.stats["disallowed"] += 1
+            return None
+        cached = self.cache.get(url)
+        headers = {}
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+        async with host.slots:
+            # Politeness: requests to a host start at least host.delay apart
+            async with host.turn:
+                wait = host.next_request - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                host.next_request = time.monotonic() + host.delay
+            response = await client.get(url, headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            self.stats["not_modified"] += 1
+            return cached
+        if response.status_code == 429 or response.status_code >= 500:
+            # The page may still exist: the crawl is not complete
+            self.stats["failed"] += 1
+            return None
+        if response.status_code != 200 or "html" not in response.headers.get("content-type", ""):
+            self.stats["skipped"] += 1
+            return None
+        self.stats["fetched"] += 1
+        content, links = await asyncio.to_thread(extract_page, response.text, str(response.url))
+        page = Page(url, content, links, response.headers.get("etag"), response.headers.get("last-modified"))
+        self.cache.put(page)
+        return page
+
+
+def crawl(url: str, max_pages: Optional[int] = None, max_depth: Optional[int] = None) -> Crawler:
+    """Crawl a site from `url`; the crawled pages are in the returned crawler's `pages`."""
+    crawler = Crawler(url, max_pages or CRAWL_MAX_PAGES, max_depth or CRAWL_MAX_DEPTH)
+    asyncio.run(crawler.run())
+    return crawler
+
+
+def ingest_url(
+    rag_assistant, url: str, max_pages: Optional[int] = None, max_depth: Optional[int] = None
+) -> Dict[str, Any]:
+    """Crawl a site into a knowledge base, embedding only pages whose text changed.
+
+    Every page is a manifest entry keyed by its URL, its chunks are named after
+    the start URL and have ids <page url>_<n>, as WebsiteReader's. When the
+    crawl is complete (see Crawler.complete), pages ingested from the same
+    start URL that it did not find (deleted, now disallowed, empty or beyond
+    max_depth) are removed from the knowledge base.
+    """
+    start = time.perf_counter()
+    crawler = crawl(url, max_pages, max_depth)
+    settings = chunk_settings(get_strategy(rag_assistant.knowledge_base.vector_db.collection), "page.html")
+    reader = WebsiteReader()
+    sources: List[Tuple[str, List[Document]]] = []
+    for page in crawler.pages:
+        document = Document(name=url, id=page.url, meta_data={"url": page.url}, content=page.content)
+        chunks = chunk_documents([document], settings) if settings else reader.chunk_document(document)
+        sources.append((page.url, chunks))
+    results = ingest_documents(rag_assistant, sources)
+
+    removed: List[str] = []
+    if crawler.complete:
+        vector_db = rag_assistant.knowledge_base.vector_db
+        entries = manifest.list_entries(vector_db.collection)
+        found = {page.url for page in crawler.pages}
+        removed = sorted(
+            name for name, entry in entries.items()
+            if entry["doc_name"] == url and name not in found and crawler.in_scope(name)
+        )
+        remove_sources(vector_db, entries, removed)
+    else:
+        logging.info(f"Crawl of {url} is incomplete, keeping pages it did not find")
+    return {
+        "pages": len(crawler.pages),
+        **crawler.stats,
+        "complete": crawler.complete,
+        "removed": removed,
+        "crawl_ms": round((time.perf_counter() - start) * 1000, 1),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kb_name")
+    parser.add_argument("url")
+    parser.add_argument("--max-pages", type=int, default=CRAWL_MAX_PAGES)
+    parser.add_argument("--max-depth", type=int, default=CRAWL_MAX_DEPTH)
+    parser.add_argument("--embeddings-model", default="text-embedding-3-large")
+    args = parser.parse_args()
+
+    from assistant import get_groq_assistant
+
+    rag_assistant = get_groq_assistant(embeddings_model=args.embeddings_model, user_id=args.kb_name, debug_mode=False)
+    summary = ingest_url(rag_assistant, args.url, args.max_pages, args.max_depth)
+    embedded = sum(1 for result in summary["results"].values() if result["chunks"])
+    print(
+        f"{summary['pages']} pages ({summary['fetched']} fetched, {summary['not_modified']} not modified), "
+        f"{embedded} re-embedded, {summary['crawl_ms']}ms"
+    )
@@ -0,0 +1,75 @@
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy.engine import create_engine, Engine
+from sqlalchemy.sql.expression import text
+
+db_url = os.getenv("DB_URL", "postgresql+psycopg://ai:ai@localhost:5532/ai")
+
+# Pool settings are per worker process: with gunicorn -w 4 the total number of
+# connections to Postgres is at most 4 * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+_engine: Optional[Engine] = None
+_engine_pid: Optional[int] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> Engine:
+    """Get the SQLAlchemy engine shared by the assistant storage, vector db and delete path.
+
+    The engine is created lazily once per process, so a worker forked from a
+    preloaded master never reuses the master's connections.
+    """
+    global _engine, _engine_pid
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+    with _engine_lock:
+        if _engine is None or _engine_pid != pid:
+            if _engine is not None:
+                # Forked child: drop the inherited pool without closing the parent's sockets
+                _engine.dispose(close=False)
+            _engine = create_engine(
+                db_url,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=DB_POOL_RECYCLE,
+                pool_pre_ping=DB_POOL_PRE_PING,
+            )
+            _engine_pid = pid
+    return _engine
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Utilisation of this worker's connection pool."""
+    if _engine is None or _engine_pid != os.getpid():
+        return {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "checked_out": 0, "checked_in": 0, "overflow": 0}
+    pool = _engine.pool
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+    }
+
+
+_pgvector_versions: Dict[str, Tuple[int, ...]] = {}
+
+
+def pgvector_version(engine: Optional[Engine] = None) -> Tuple[int, ...]:
+    """Installed version of the pgvector extension, e.g. (0, 7, 0); (0,) if it isn't installed."""
+    engine = engine or get_engine()
+    key = str(engine.url)
+    if key not in _pgvector_versions:
+        with engine.connect() as conn:
+            version = conn.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+        _pgvector_versions[key] = tuple(int(part) for part in (version or "0").split("."))
+    return _pgvector_versions[key]
@@ -1,27 +1,35 @@
-import psycopg2
-import os
 import json
 
+from sqlalchemy.sql.expression import text
 
+from db import get_engine
+from local_vector import VECTOR_BACKEND, LocalVectorDb
+import manifest
+from shared_table import VECTOR_STORAGE_LAYOUT, shared_table_name
+from storage_profiles import get_profile
 
-# PostgreSQL connection details
-connection_details = "dbname='ai' user='ai' host='localhost' password='ai' port='5532'"
 
 # Function to delete rows by matching column "name" with the given variable
 def delete_rows_by_name(kb_name, name_value):
-    # Connect to PostgreSQL
-    conn = psycopg2.connect(connection_details)
-    cur = conn.cursor()
-    
     # SQL query to delete rows with parameterized input
-    sql_query = f"""DELETE FROM groq_rag_documents_openai_{kb_name} WHERE name = %s"""
-    
+    collection = f"groq_rag_documents_openai_{kb_name}"
+    if VECTOR_BACKEND == "local":
+        sql_query = None
+    elif VECTOR_STORAGE_LAYOUT == "shared":
+        table = shared_table_name(get_profile(collection))
+        sql_query = text(f"""DELETE FROM ai.{table} WHERE kb_name = :kb_name AND name = :name""")
+    else:
+        sql_query = text(f"""DELETE FROM {collection} WHERE name = :name""")
+
     try:
-        # Execute the query with parameterized input
-        
-        cur.execute(sql_query, (name_value,))
-        # Commit the changes
-        conn.commit()
+        if sql_query is None:
+            LocalVectorDb(collection=collection, profile=get_profile(collection)).delete_name(name_value)
+        else:
+            # Borrow a connection from the shared pool; commits on exit
+            with get_engine().begin() as conn:
+                conn.execute(sql_query, {"kb_name": kb_name, "name": name_value})
+        # Forget the file's hashes so a re-upload is ingested again
+        manifest.delete_entries(collection, doc_name=name_value)
         response = {
             "message": f"File with name = '{name_value}' has been deleted.",
             "status": 200
@@ -31,10 +39,6 @@ def delete_rows_by_name(kb_name, name_value):
             "error": str(e),
             "status": 500
         }
-    finally:
-        # Close the connection
-        cur.close()
-        conn.close()
     return json.dumps(response)
 
 # Example usage
@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from phi.embedder.base import Embedder
+from phi.embedder.openai import OpenAIEmbedder
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join("uploads", "embeddings.sqlite3"))
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+# How many writes between checks of the cache size
+EMBEDDING_CACHE_EVICT_EVERY = 200
+# Keys per SELECT ... IN (...), below SQLite's default limit of 999 parameters
+EMBEDDING_CACHE_KEYS_PER_QUERY = 500
+
+
+class EmbeddingCache:
+    """Embeddings stored as float32 blobs in a local SQLite file, keyed by
+    (model, dimensions, sha256(text)).
+
+    The file is shared by every worker process on the host and by every
+    knowledge base. When it grows past `max_mb` the least recently used
+    vectors are evicted.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_mb: int = EMBEDDING_CACHE_MAX_MB):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used_idx ON embeddings (last_used)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def key(model: str, dimensions: int, text: str) -> str:
+        return f"{model}:{dimensions}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+    def _write(self, statement: str, rows: List[tuple]) -> None:
+        """Run `statement` for every row in one transaction: one commit for a whole batch."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(statement, rows)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_many(self, model: str, dimensions: int, texts: List[str]) -> List[Optional[List[float]]]:
+        """Cached embeddings of `texts`, None for misses; a few SELECTs and one last_used update per call."""
+        keys = [self.key(model, dimensions, text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+        vectors: Dict[str, bytes] = {}
+        try:
+            conn = self._conn()
+            for first in range(0, len(unique_keys), EMBEDDING_CACHE_KEYS_PER_QUERY):
+                chunk = unique_keys[first:first + EMBEDDING_CACHE_KEYS_PER_QUERY]
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})", chunk
+                )
+                vectors.update(rows.fetchall())
+            if vectors:
+                now = time.time()
+                self._write("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in vectors])
+        except sqlite3.Error as e:
+            logging.error(f"Embedding cache read failed: {e}")
+            self.misses += len(texts)
+            return [None] * len(texts)
+        embeddings = [array('f', vectors[key]).tolist() if key in vectors else None for key in keys]
+        hits = sum(1 for embedding in embeddings if embedding is not None)
+        self.hits += hits
+        self.misses += len(texts) - hits
+        return embeddings
+
+    def get(self, model: str, dimensions: int, text: str) -> Optional[List[float]]:
+        return self.get_many(model, dimensions, [text])[0]
+
+    def put_many(self, model: str, dimensions: int, texts: List[str], embeddings: List[List[float]]) -> None:
+        """Store embeddings of `texts` in a single transaction."""
+        now = time.time()
+        rows = [
+            (self.key(model, dimensions, text), array('f', embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+            if embedding
+        ]
+        if not rows:
+            return
+        try:
+            self._write("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logging.error(f"Embedding cache write failed: {e}")
+            return
+        checks = self._writes // EMBEDDING_CACHE_EVICT_EVERY
+        self._writes += len(rows)
+        if self._writes // EMBEDDING_CACHE_EVICT_EVERY != checks:
+            self.evict()
+
+    def put(self, model: str, dimensions: int, text: str, embedding: List[float]) -> None:
+        self.put_many(model, dimensions, [text], [embedding])
+
+    def evict(self) -> None:
+        """Drop least recently used vectors until the cache is under 90% of its size limit."""
+        conn = self._conn()
+        total = conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings").fetchone()
+        if total[0] <= self.max_bytes or total[1] == 0:
+            return
+        average = total[0] / total[1]
+        to_delete = int((total[0] - self.max_bytes * 0.9) / average) + 1
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (to_delete,)
+        )
+        self.evictions += to_delete
+        logging.info(f"Evicted {to_delete} embeddings from the cache")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "max_mb": self.max_bytes // (1024 * 1024)}
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+
+def provider_embeddings(embedder: Embedder, texts: List[str]) -> Tuple[List[List[float]], Optional[Dict]]:
+    """Embed several texts with as few provider requests as the embedder allows."""
+    if isinstance(embedder, OpenAIEmbedder):
+        request_params: Dict[str, Any] = {
+            "input": texts,
+            "model": embedder.model,
+            "encoding_format": embedder.encoding_format,
+        }
+        if embedder.user is not None:
+            request_params["user"] = embedder.user
+        if embedder.model.startswith("text-embedding-3"):
+            request_params["dimensions"] = embedder.dimensions
+        if embedder.request_params:
+            request_params.update(embedder.request_params)
+        # BatchEmbedder retries failed batches itself (EMBED_MAX_RETRIES); SDK retries would multiply them
+        response = embedder.client.with_options(max_retries=0).embeddings.create(**request_params)
+        embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        return embeddings, response.usage.model_dump() if response.usage else None
+    # No batch endpoint: one request per text
+    return [embedder.get_embedding_and_usage(text)[0] for text in texts], None
+
+
+class CachedEmbedder(Embedder):
+    """Embedder that consults the local embedding cache before calling `embedder`."""
+
+    embedder: Embedder
+
+    @property
+    def model(self) -> str:
+        return getattr(self.embedder, "model", type(self.embedder).__name__)
+
+    def get_embedding(self, text: str) -> List[float]:
+        return self.get_embedding_and_usage(text)[0]
+
+    def get_embedding_and_usage(self, text: str) -> Tuple[List[float], Optional[Dict]]:
+        cache = get_embedding_cache()
+        embedding = cache.get(self.model, self.dimensions, text)
+        if embedding is not None:
+            return embedding, None
+        embedding, usage = self.embedder.get_embedding_and_usage(text)
+        cache.put(self.model, self.dimensions, text, embedding)
+        return embedding, usage
+
+    def get_embeddings_and_usage(self, texts: List[str]) -> Tuple[List[List[float]], Optional[Dict]]:
+        """Batch version of get_embedding_and_usage; only cache misses go to the provider."""
+        cache = get_embedding_cache()
+        embeddings = cache.get_many(self.model, self.dimensions, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        usage = None
+        if missing:
+            fetched, usage = provider_embeddings(self.embedder, [texts[i] for i in missing])
+            for i, embedding in zip(missing, fetched):
+                embeddings[i] = embedding
+            cache.put_many(self.model, self.dimensions, [texts[i] for i in missing], fetched)
+        return embeddings, usage
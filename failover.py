@@ -0,0 +1,402 @@
+"""Fail over between LLM providers, and optionally hedge slow requests.
+
+Every answer is requested from the knowledge base's routed provider/model
+(see routing.py) first. FAILOVER_MODELS names the provider/model to use
+instead when that fails:
+
+- an error before the first token, or no first token within
+  LLM_FIRST_TOKEN_TIMEOUT (LLM_RESPONSE_TIMEOUT for non-streamed answers),
+  starts the same request on the fallback;
+- a circuit breaker per provider opens after CIRCUIT_FAILURES consecutive
+  failures (timeouts, connection errors, 429 and 5xx), sending requests
+  straight to the fallback for CIRCUIT_OPEN_SECONDS; then a single trial
+  request decides whether it closes again;
+- with LLM_HEDGING, the fallback is also started when the primary has not
+  produced its first token after its recent p95 time to first token.
+  Whichever answers first is streamed, the other one is cancelled.
+
+Once a provider has streamed part of the answer it is not switched any more.
+Each attempt gets its own copy of the messages, the winner's answer is added
+to the assistant's messages. Health is kept per worker process (provider_stats()).
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from queue import Empty, Queue
+from typing import Any, Callable, ClassVar, Deque, Dict, Iterator, List, Optional, Tuple
+
+from groq import Groq as GroqClient
+from openai import OpenAI as OpenAIClient
+from phi.llm.message import Message
+
+from budget import BudgetedGroq, BudgetedOpenAIChat, answer_tokens, fit_messages
+
+LLM_FAILOVER = os.getenv("LLM_FAILOVER", "true").lower() == "true"
+# provider=fallback_provider:fallback_model, comma separated
+FAILOVER_MODELS: Dict[str, Tuple[str, str]] = {
+    provider.strip(): tuple(fallback.strip().split(":", 1))
+    for provider, fallback in (
+        entry.split("=", 1)
+        for entry in os.getenv("FAILOVER_MODELS", "groq=openai:gpt-4o,openai=groq:llama3-70b-8192").split(",")
+        if "=" in entry
+    )
+}
+# Fire the fallback when the primary is slower than its p95 to answer
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+# Hedge delay while a provider has fewer latency samples than HEDGE_MIN_SAMPLES
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.25"))
+HEDGE_MIN_SAMPLES = 20
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "20"))
+LLM_RESPONSE_TIMEOUT = float(os.getenv("LLM_RESPONSE_TIMEOUT", "120"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+# Client settings; the SDKs' own retries wait (up to their retry-after) before failover can start
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "1"))
+# Latencies kept per provider for the percentiles
+LLM_LATENCY_WINDOW = 500
+
+# Which provider answered the last LLM call of this request
+_last_call: ContextVar[Optional[Dict[str, Any]]] = ContextVar("llm_call", default=None)
+
+
+def last_call() -> Optional[Dict[str, Any]]:
+    """Provider, model and failover/hedging details of this request's last answer, or None."""
+    return _last_call.get()
+
+
+def reset_last_call() -> None:
+    _last_call.set(None)
+
+
+_clients: Dict[Tuple[str, int], Any] = {}
+_clients_lock = threading.Lock()
+
+
+def llm_client(provider: str) -> Any:
+    """This process's client of a provider, created on first use."""
+    key = (provider, os.getpid())
+    if key not in _clients:
+        with _clients_lock:
+            if key not in _clients:
+                client_class = GroqClient if provider == "groq" else OpenAIClient
+                _clients[key] = client_class(timeout=LLM_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+    return _clients[key]
+
+
+def _percentile(samples: List[float], share: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def _is_outage(error: Exception) -> bool:
+    """Whether an error says the provider is unhealthy, rather than that the request was wrong."""
+    status = getattr(error, "status_code", None)
+    return status is None or status in (408, 409, 429) or status >= 500
+
+
+class ProviderHealth:
+    """Latencies and circuit breaker of one provider in this process."""
+
+    def __init__(self, name: str):
+        self.name = name
+        # "stream": seconds to the first token; "response": seconds to the whole answer
+        self._latencies: Dict[str, Deque[float]] = {
+            "stream": deque(maxlen=LLM_LATENCY_WINDOW),
+            "response": deque(maxlen=LLM_LATENCY_WINDOW),
+        }
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < CIRCUIT_OPEN_SECONDS or self._trial:
+                return "open"
+            return "half-open"
+
+    def start(self) -> None:
+        """Count a request; on a half-open circuit it is the trial, and the circuit stays open meanwhile."""
+        with self._lock:
+            self.counts["requests"] += 1
+            if self._opened_at is not None and time.monotonic() - self._opened_at >= CIRCUIT_OPEN_SECONDS:
+                self._trial = True
+
+    def success(self, kind: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies[kind].append(seconds)
+            if self._opened_at is not None:
+                logging.info(f"Circuit of {self.name} closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def latency(self, kind: str, seconds: float) -> None:
+        """A latency sample from a request that counted as failed (too slow)."""
+        with self._lock:
+            self._latencies[kind].append(seconds)
+
+    def failure(self, error: Exception) -> None:
+        with self._lock:
+            self.counts["timeouts" if isinstance(error, TimeoutError) else "errors"] += 1
+            if not _is_outage(error):
+                return
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= CIRCUIT_FAILURES):
+                logging.warning(f"Circuit of {self.name} opened after {self._failures} failures: {error}")
+                self._opened_at = time.monotonic()
+                self.counts["circuit_opened"] += 1
+            self._trial = False
+
+    def hedge_delay(self, kind: str) -> float:
+        with self._lock:
+            samples = list(self._latencies[kind])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, _percentile(samples, 0.95))
+
+    def stats(self) -> Dict[str, Any]:
+        summary: Dict[str, Any] = {"state": self.state(), "consecutive_failures": self._failures, **self.counts}
+        with self._lock:
+            for kind, samples in self._latencies.items():
+                if samples:
+                    summary[f"{kind}_s"] = {
+                        "p50": round(_percentile(list(samples), 0.5), 3),
+                        "p95": round(_percentile(list(samples), 0.95), 3),
+                    }
+        return summary
+
+
+_health: Dict[str, ProviderHealth] = {}
+_health_lock = threading.Lock()
+
+
+def provider_health(provider: str) -> ProviderHealth:
+    if provider not in _health:
+        with _health_lock:
+            _health.setdefault(provider, ProviderHealth(provider))
+    return _health[provider]
+
+
+def provider_stats() -> Dict[str, Any]:
+    return {provider: health.stats() for provider, health in list(_health.items())}
+
+
+_DONE = object()
+
+
+class _Attempt:
+    """One provider answering on its own thread; puts (attempt, delta), then (attempt, _DONE) or (attempt, error)."""
+
+    def __init__(self, provider: str, model: str, answer: Callable[[List[Message]], Iterator[str]], kind: str,
+                 messages: List[Message], out: "Queue[Tuple[_Attempt, Any]]"):
+        self.provider = provider
+        self.model = model
+        self.kind = kind
+        self.health = provider_health(provider)
+        self.messages = list(messages)
+        self._question = messages[-1] if messages else None
+        self.cancelled = threading.Event()
+        self.failed = False
+        self.health.start()
+        self.started = time.monotonic()
+        threading.Thread(target=self._run, args=(answer, out), name=f"llm-{provider}", daemon=True).start()
+
+    def _run(self, answer: Callable[[List[Message]], Iterator[str]], out: "Queue[Tuple[_Attempt, Any]]") -> None:
+        first = True
+        try:
+            deltas = answer(self.messages)
+            try:
+                for delta in deltas:
+                    if first:
+                        first = False
+                        self._answered()
+                    if self.cancelled.is_set():
+                        return
+                    out.put((self, delta))
+            finally:
+                close = getattr(deltas, "close", None)
+                if close is not None:
+                    close()
+            if first:
+                self._answered()
+            out.put((self, _DONE))
+        except Exception as e:
+            if not self.failed and not self.cancelled.is_set():
+                self.health.failure(e)
+            out.put((self, e))
+
+    def answer_messages(self) -> List[Message]:
+        """The messages this attempt added after the question (its copy may have had history trimmed)."""
+        for index, message in enumerate(self.messages):
+            if message is self._question:
+                return self.messages[index + 1:]
+        return []
+
+    def _answered(self) -> None:
+        seconds = time.monotonic() - self.started
+        if self.failed:
+            # Gave up on it already: still a sample of how slow it was
+            self.health.latency(self.kind, seconds)
+        else:
+            self.health.success(self.kind, seconds)
+
+    def give_up(self, error: Exception) -> None:
+        self.failed = True
+        self.cancelled.set()
+        self.health.failure(error)
+
+
+class FailoverLLM:
+    """Answers with the LLM it is mixed into, falling back to FAILOVER_MODELS (see the module docstring)."""
+
+    PROVIDER: ClassVar[str] = ""
+
+    def response(self, messages: List[Message]) -> str:
+        return "".join(self._answer(messages, stream=False))
+
+    def response_stream(self, messages: List[Message]) -> Iterator[str]:
+        yield from self._answer(messages, stream=True)
+
+    def _primary(self, stream: bool) -> Callable[[List[Message]], Iterator[str]]:
+        parent = super(FailoverLLM, self)
+        if stream:
+            return parent.response_stream
+        return lambda messages: iter([parent.response(messages)])
+
+    def _fallback_route(self) -> Optional[Tuple[str, str]]:
+        fallback = FAILOVER_MODELS.get(self.PROVIDER) if LLM_FAILOVER else None
+        if fallback is None or fallback == (self.PROVIDER, self.model) or len(fallback) != 2:
+            return None
+        return fallback
+
+    def answer_models(self) -> List[str]:
+        fallback = self._fallback_route()
+        return [self.model] if fallback is None else [self.model, fallback[1]]
+
+    def _fallback(self, stream: bool) -> Optional[Tuple[str, str, Callable[[List[Message]], Iterator[str]]]]:
+        fallback = self._fallback_route()
+        if fallback is None:
+            return None
+        provider, model = fallback
+        try:
+            if provider == "groq":
+                llm = BudgetedGroq(model=model, groq_client=llm_client(provider), max_tokens=answer_tokens(model))
+            else:
+                llm = BudgetedOpenAIChat(model=model, client=llm_client(provider), max_tokens=answer_tokens(model))
+        except Exception as e:
+            # e.g. no API key for the fallback provider
+            logging.error(f"Fallback {provider} {model} is not available: {e}")
+            return None
+        if stream:
+            return provider, model, llm.response_stream
+        return provider, model, lambda messages: iter([llm.response(messages)])
+
+    def _answer(self, messages: List[Message], stream: bool) -> Iterator[str]:
+        kind = "stream" if stream else "response"
+        timeout = LLM_FIRST_TOKEN_TIMEOUT if stream else LLM_RESPONSE_TIMEOUT
+        # Fitted here so the token breakdown of this request is kept; each attempt fits its own copy again
+        fit_messages(messages, self.model)
+        candidates = [(self.PROVIDER, self.model, self._primary(stream))]
+        fallback = self._fallback(stream)
+        if fallback is not None:
+            if provider_health(self.PROVIDER).state() == "open" and provider_health(fallback[0]).state() != "open":
+                candidates.insert(0, fallback)
+            else:
+                candidates.append(fallback)
+
+        out: "Queue[Tuple[_Attempt, Any]]" = Queue()
+        attempts: List[_Attempt] = []
+
+        def start() -> None:
+            provider, model, answer = candidates.pop(0)
+            attempts.append(_Attempt(provider, model, answer, kind, messages, out))
+
+        start()
+        hedge_at = None
+        if LLM_HEDGING and candidates and provider_health(candidates[0][0]).state() == "closed":
+            hedge_at = attempts[0].started + attempts[0].health.hedge_delay(kind)
+        hedged = False
+        winner: Optional[_Attempt] = None
+        first: Any = _DONE
+        error: Optional[Exception] = None
+        while winner is None:
+            live = [attempt for attempt in attempts if not attempt.failed]
+            if not live:
+                if not candidates:
+                    raise error or TimeoutError("No LLM provider answered")
+                start()
+                continue
+            # An attempt is only given up on while there is something else to try
+            deadlines = [attempt.started + timeout for attempt in live] if candidates else []
+            if hedge_at is not None and candidates:
+                deadlines.append(hedge_at)
+            try:
+                attempt, item = out.get(timeout=max(0.0, min(deadlines) - time.monotonic()) if deadlines else None)
+            except Empty:
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    hedged = True
+                    attempts[0].health.counts["hedged"] += 1
+                    start()
+                    continue
+                for attempt in live:
+                    if now - attempt.started >= timeout:
+                        error = TimeoutError(f"No answer from {attempt.provider} {attempt.model} in {timeout}s")
+                        logging.warning(str(error))
+                        attempt.give_up(error)
+                continue
+            if attempt.failed:
+                continue
+            if isinstance(item, Exception):
+                logging.error(f"Error from {attempt.provider} {attempt.model}: {item}")
+                attempt.failed = True
+                error = item
+                continue
+            winner, first = attempt, item
+
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancelled.set()
+        failed_over = winner is not attempts[0] or winner.provider != self.PROVIDER
+        if failed_over:
+            winner.health.counts["served_as_fallback"] += 1
+            logging.warning(f"Answered by {winner.provider} {winner.model} instead of {self.PROVIDER} {self.model}")
+        _last_call.set(
+            {
+                "provider": winner.provider,
+                "model": winner.model,
+                "failed_over": failed_over,
+                "hedged": hedged,
+                "attempts": len(attempts),
+            }
+        )
+
+        item = first
+        while item is not _DONE:
+            if isinstance(item, Exception):
+                # Part of the answer was already sent: too late to switch
+                raise item
+            yield item
+            attempt, item = out.get()
+            while attempt is not winner:
+                attempt, item = out.get()
+        # The winner's answer (and any tool messages) is what the assistant keeps
+        messages.extend(winner.answer_messages())
+
+
+class FailoverGroq(FailoverLLM, BudgetedGroq):
+    PROVIDER: ClassVar[str] = "groq"
+
+
+class FailoverOpenAIChat(FailoverLLM, BudgetedOpenAIChat):
+    PROVIDER: ClassVar[str] = "openai"
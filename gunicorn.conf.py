@@ -0,0 +1,19 @@
+import os
+
+# Loaded automatically by gunicorn from the working directory.
+#
+# Chats and ingests spend almost all of their time waiting on Groq/OpenAI and
+# Postgres, which releases the GIL, so each worker serves requests on a pool
+# of threads instead of one at a time: a worker holds up to GUNICORN_THREADS
+# requests in flight. Streaming responses keep their thread until the answer
+# is complete. Set GUNICORN_WORKER_CLASS=sync to go back to one request per
+# worker.
+#
+# Database connections are per worker too (see db.py); requests that need one
+# while DB_POOL_SIZE + DB_MAX_OVERFLOW are checked out wait up to DB_POOL_TIMEOUT.
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:7002")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
@@ -0,0 +1,494 @@
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from hashlib import md5
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Deque, Dict, Iterator, List, Optional, Tuple
+
+from phi.document import Document
+from phi.document.reader.base import Reader
+from phi.document.reader.docx import DocxReader
+from phi.document.reader.json import JSONReader
+from phi.document.reader.pdf import PDFReader
+from phi.document.reader.text import TextReader
+from phi.vectordb.pgvector import PgVector2
+from pypdf import PdfReader
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import delete
+
+import manifest
+from batch_embed import BatchEmbedder
+from chunking import ChunkSettings, chunk_documents, chunk_settings, get_strategy
+from local_vector import LocalVectorDb
+from manifest import chunk_id, file_stat, sha256_file, sha256_text
+from vector_index import IndexedPgVector, maintain_index, maintain_text_index
+
+# Parsing is CPU bound and runs in a process pool; 0 parses in threads instead
+INGEST_PARSE_PROCESSES = int(os.getenv("INGEST_PARSE_PROCESSES", str(min(os.cpu_count() or 1, 4))))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "200"))
+# Streaming: PDFs are parsed this many pages per task, chunks are embedded and
+# upserted this many at a time, and at most INGEST_PARSE_AHEAD parsed tasks
+# wait for embedding. Together these bound the memory used per ingestion.
+INGEST_PDF_WINDOW_PAGES = int(os.getenv("INGEST_PDF_WINDOW_PAGES", "16"))
+INGEST_WINDOW_CHUNKS = int(os.getenv("INGEST_WINDOW_CHUNKS", "256"))
+INGEST_PARSE_AHEAD = int(os.getenv("INGEST_PARSE_AHEAD", str(max(2, INGEST_PARSE_PROCESSES * 2))))
+
+# Reader used for each supported file type
+FILE_READERS: Dict[str, Callable[[], Reader]] = {
+    '.pdf': lambda: PDFReader(chunk_size=2048),
+    '.docx': lambda: DocxReader(chunk_size=2048),
+    '.json': lambda: JSONReader(chunk_size=1024),
+    '.txt': lambda: TextReader(chunk_size=1024),
+}
+
+
+def file_extension(file_name: str) -> str:
+    return os.path.splitext(file_name)[-1].lower()
+
+
+def is_supported(file_name: str) -> bool:
+    return file_extension(file_name) in FILE_READERS
+
+
+def read_file(file_path: str, file_name: str, settings: Optional[ChunkSettings] = None) -> List[Document]:
+    """Parse and chunk a saved upload into documents.
+
+    Chunked by the reader unless token chunk `settings` are given (see chunking.py).
+    """
+    extension = file_extension(file_name)
+    make_reader = FILE_READERS.get(extension)
+    if make_reader is None:
+        raise ValueError(f"No handler for file type: {extension}")
+    reader = make_reader()
+    reader.chunk = settings is None
+    documents = reader.read(file_path if extension == '.pdf' else Path(file_path))
+    return documents if settings is None else chunk_documents(documents, settings)
+
+
+def pdf_doc_name(file_path: str) -> str:
+    # Same name PDFReader gives the documents of a file
+    return file_path.split("/")[-1].split(".")[0].replace(" ", "_")
+
+
+def pdf_page_count(file_path: str) -> int:
+    # A file object, not a path: given a path pypdf reads the whole file into memory
+    with open(file_path, 'rb') as file:
+        return len(PdfReader(file).pages)
+
+
+def read_pdf_pages(
+    file_path: str, first_page: int, last_page: int, settings: Optional[ChunkSettings] = None
+) -> List[Document]:
+    """Parse and chunk pages [first_page, last_page) of a PDF, with PDFReader's ids."""
+    reader = FILE_READERS['.pdf']()
+    reader.chunk = settings is None
+    doc_name = pdf_doc_name(file_path)
+    documents: List[Document] = []
+    with open(file_path, 'rb') as file:
+        pdf = PdfReader(file)
+        for page_number in range(first_page + 1, last_page + 1):
+            document = Document(
+                name=doc_name,
+                id=f"{doc_name}_{page_number}",
+                meta_data={"page": page_number},
+                content=pdf.pages[page_number - 1].extract_text(),
+            )
+            documents.append(document)
+    if settings is not None:
+        return chunk_documents(documents, settings)
+    return [chunk for document in documents for chunk in reader.chunk_document(document)]
+
+
+def parse_tasks(
+    file_path: str, file_name: str, settings: Optional[ChunkSettings] = None
+) -> Iterator[Tuple[Callable, tuple]]:
+    """Units of parse work for a file: a task per window of pages for PDFs, one for other files."""
+    if file_extension(file_name) == '.pdf':
+        pages = pdf_page_count(file_path)
+        for first_page in range(0, pages, INGEST_PDF_WINDOW_PAGES):
+            last_page = min(first_page + INGEST_PDF_WINDOW_PAGES, pages)
+            yield read_pdf_pages, (file_path, first_page, last_page, settings)
+    else:
+        yield read_file, (file_path, file_name, settings)
+
+
+_parse_pool: Optional[Executor] = None
+_parse_pool_pid: Optional[int] = None
+
+
+def _get_parse_pool() -> Executor:
+    global _parse_pool, _parse_pool_pid
+    if _parse_pool is None or _parse_pool_pid != os.getpid():
+        if INGEST_PARSE_PROCESSES > 0:
+            # spawn, not fork: web workers are multi-threaded
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=INGEST_PARSE_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            _parse_pool = ThreadPoolExecutor(max_workers=4)
+        _parse_pool_pid = os.getpid()
+    return _parse_pool
+
+
+def _timed(task: Callable, *args: Any) -> Tuple[Any, float]:
+    """Run a parse task in the pool; returns its result and its own duration in seconds."""
+    start = time.perf_counter()
+    return task(*args), time.perf_counter() - start
+
+
+def upsert_documents(vector_db, documents: List[Document], batch_size: int = UPSERT_BATCH_SIZE) -> None:
+    """Upsert already embedded documents in multi-row batches.
+
+    PgVector2.upsert embeds and executes one statement per document; this
+    writes the embeddings computed by the ingestion pipeline as they are.
+    """
+    if not isinstance(vector_db, PgVector2):
+        vector_db.upsert(documents=documents)
+        return
+
+    # A multi-row upsert cannot touch the same id twice; the last document wins
+    scope = vector_db.scope() if isinstance(vector_db, IndexedPgVector) else {}
+    rows: Dict[str, Dict[str, Any]] = {}
+    for document in documents:
+        cleaned_content = document.content.replace("\x00", "\ufffd")
+        content_hash = md5(cleaned_content.encode()).hexdigest()
+        _id = chunk_id(document)
+        rows[_id] = dict(
+            **scope,
+            id=_id,
+            name=document.name,
+            meta_data=document.meta_data,
+            content=cleaned_content,
+            embedding=document.embedding,
+            usage=document.usage,
+            content_hash=content_hash,
+        )
+
+    values = list(rows.values())
+    with vector_db.Session() as sess:
+        for start in range(0, len(values), batch_size):
+            stmt = postgresql.insert(vector_db.table).values(values[start:start + batch_size])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[column.name for column in vector_db.table.primary_key.columns],
+                set_=dict(
+                    name=stmt.excluded.name,
+                    meta_data=stmt.excluded.meta_data,
+                    content=stmt.excluded.content,
+                    embedding=stmt.excluded.embedding,
+                    usage=stmt.excluded.usage,
+                    content_hash=stmt.excluded.content_hash,
+                ),
+            )
+            sess.execute(stmt)
+            sess.commit()
+    logging.info(f"Upserted {len(values)} documents into {vector_db.collection}")
+
+
+def delete_documents(vector_db, ids: List[str]) -> None:
+    """Delete chunk rows that a re-uploaded file no longer produces."""
+    if ids and isinstance(vector_db, LocalVectorDb):
+        vector_db.delete_ids(ids)
+        return
+    if not ids or not isinstance(vector_db, PgVector2):
+        return
+    with vector_db.Session() as sess, sess.begin():
+        stmt = delete(vector_db.table).where(vector_db.table.c.id.in_(ids))
+        if isinstance(vector_db, IndexedPgVector):
+            stmt = vector_db.scoped(stmt)
+        sess.execute(stmt)
+
+
+def _buffered(vector_db) -> ContextManager:
+    """Write the local store once per ingestion rather than once per window; see LocalVectorDb.buffered."""
+    return vector_db.buffered() if isinstance(vector_db, LocalVectorDb) else nullcontext()
+
+
+def remove_sources(vector_db, entries: Dict[str, Dict[str, Any]], names: List[str]) -> None:
+    """Delete the chunks and manifest entries of sources (files, pages) a knowledge base no longer has."""
+    if not names:
+        return
+    collection = vector_db.collection
+    stale_ids = [stale_id for name in names for stale_id in entries[name]["chunk_hashes"] or {}]
+    delete_documents(vector_db, stale_ids)
+    manifest.delete_files(collection, names)
+    manifest.bump_version(collection)
+    logging.info(f"Removed {len(names)} sources ({len(stale_ids)} chunks) from {collection}")
+
+
+def ingest_files(rag_assistant, files: List[Tuple[str, str]]) -> Dict[str, Dict[str, Any]]:
+    """Parse, embed and load several saved uploads as one streaming pipeline.
+
+    Files whose SHA-256 matches the knowledge base manifest are skipped before
+    parsing. The rest are split into parse tasks (page windows for PDFs) that
+    run in the parse pool, at most INGEST_PARSE_AHEAD at a time. Each parsed
+    window is embedded and upserted INGEST_WINDOW_CHUNKS chunks at a time before
+    the next one is taken, so memory stays bounded whatever the file size.
+    Chunks whose hash is unchanged since the last upload are not re-embedded.
+
+    Returns a result per file name: chunks loaded, chunks reused, time spent
+    parsing and embedding the file, per-batch embedding stats and any error.
+    Results and the manifest are keyed by file name, so the names must be
+    unique; raises ValueError otherwise.
+    """
+    vector_db = rag_assistant.knowledge_base.vector_db
+    collection = vector_db.collection
+    results: Dict[str, Dict[str, Any]] = {}
+    file_names = [file_name for file_name, _ in files]
+    duplicates = sorted({file_name for file_name in file_names if file_names.count(file_name) > 1})
+    if duplicates:
+        raise ValueError(f"Files with the same name: {', '.join(duplicates)}")
+
+    file_stats = {file_name: file_stat(file_path) for file_name, file_path in files if is_supported(file_name)}
+    file_hashes = {file_name: sha256_file(file_path) for file_name, file_path in files if is_supported(file_name)}
+    previous = manifest.get_entries(collection, file_hashes)
+
+    to_parse: List[Tuple[str, str]] = []
+    for file_name, file_path in files:
+        results[file_name] = {"chunks": 0, "unchanged_chunks": 0, "error": None}
+        if not is_supported(file_name):
+            results[file_name]["error"] = f"No handler for file type: {file_extension(file_name)}"
+            continue
+        if file_name in previous and previous[file_name]["file_sha256"] == file_hashes[file_name]:
+            results[file_name]["unchanged_chunks"] = previous[file_name]["chunks"]
+            results[file_name]["unchanged"] = True
+            continue
+        results[file_name]["embed_batches"] = []
+        to_parse.append((file_name, file_path))
+
+    strategy = get_strategy(collection)
+
+    def tasks() -> Iterator[Tuple[str, Callable, tuple]]:
+        for file_name, file_path in to_parse:
+            try:
+                for task, args in parse_tasks(file_path, file_name, chunk_settings(strategy, file_name)):
+                    yield file_name, task, args
+            except Exception as e:
+                results[file_name]["error"] = str(e)
+
+    chunk_hashes: Dict[str, Dict[str, str]] = {file_name: {} for file_name, _ in to_parse}
+    doc_names: Dict[str, str] = {}
+    loaded = False
+    pending = tasks()
+    in_flight: Deque[Tuple[str, Future]] = deque()
+    pool = _get_parse_pool()
+    with _buffered(vector_db), BatchEmbedder(vector_db.embedder) as batch_embedder:
+        while True:
+            for file_name, task, args in pending:
+                if results[file_name]["error"] is None:
+                    in_flight.append((file_name, pool.submit(_timed, task, *args)))
+                if len(in_flight) >= INGEST_PARSE_AHEAD:
+                    break
+            if not in_flight:
+                break
+
+            file_name, future = in_flight.popleft()
+            result = results[file_name]
+            try:
+                documents, seconds = future.result()
+                # Windows of a file are parsed in parallel; this is the sum of their durations
+                result["parse_ms"] = round(result.get("parse_ms", 0) + seconds * 1000, 1)
+            except Exception as e:
+                result["error"] = result["error"] or str(e)
+            if result["error"] is not None:
+                continue
+            if documents and file_name not in doc_names:
+                doc_names[file_name] = documents[0].name
+
+            old_hashes = (previous.get(file_name) or {}).get("chunk_hashes") or {}
+            loaded = _load_chunks(vector_db, batch_embedder, documents, old_hashes, chunk_hashes[file_name], result, loaded)
+
+        _finish(vector_db, results, [file_name for file_name, _ in to_parse], previous, chunk_hashes, loaded)
+    _record(collection, results, previous, file_hashes, chunk_hashes, doc_names, file_stats)
+    return results
+
+
+def sync_folder(rag_assistant, folder_path: str) -> Dict[str, Any]:
+    """Reconcile a knowledge base with the folder its uploads are kept in.
+
+    Files whose size and mtime match the manifest are taken as unchanged
+    without being read. The others go through ingest_files, which hashes them
+    and embeds only new or changed chunks. Files the manifest knows but the
+    folder no longer has are removed from the vector table and the manifest.
+    Only entries with a recorded file size and mtime came from a file; the
+    others (crawled pages, named by URL) are left alone.
+
+    Returns {"added", "changed", "unchanged", "removed": [file names],
+    "results": ingest_files results, "sync_ms"}.
+    """
+    vector_db = rag_assistant.knowledge_base.vector_db
+    collection = vector_db.collection
+    start = time.perf_counter()
+
+    files: Dict[str, str] = {}
+    if os.path.isdir(folder_path):
+        for entry in os.scandir(folder_path):
+            if entry.is_file() and is_supported(entry.name):
+                files[entry.name] = entry.path
+    entries = {name: entry for name, entry in manifest.list_entries(collection).items() if "/" not in name}
+
+    to_ingest: List[Tuple[str, str]] = []
+    unchanged: List[str] = []
+    for file_name, file_path in sorted(files.items()):
+        entry = entries.get(file_name)
+        if entry is not None and (entry["file_size"], entry["file_mtime_ns"]) == file_stat(file_path):
+            unchanged.append(file_name)
+        else:
+            to_ingest.append((file_name, file_path))
+    results = ingest_files(rag_assistant, to_ingest) if to_ingest else {}
+    unchanged.extend(file_name for file_name, result in results.items() if result.get("unchanged"))
+
+    removed = sorted(
+        name for name in set(entries) - set(files)
+        if entries[name]["file_size"] is not None and entries[name]["file_mtime_ns"] is not None
+    )
+    remove_sources(vector_db, entries, removed)
+
+    loaded = [name for name, _ in to_ingest if not results[name]["error"] and not results[name].get("unchanged")]
+    return {
+        "added": [name for name in loaded if name not in entries],
+        "changed": [name for name in loaded if name in entries],
+        "unchanged": sorted(unchanged),
+        "removed": removed,
+        "results": results,
+        "sync_ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+def ingest_documents(rag_assistant, sources: List[Tuple[str, List[Document]]]) -> Dict[str, Dict[str, Any]]:
+    """Embed and load sources that are already parsed and chunked, such as crawled pages.
+
+    Each (name, chunks) source gets a manifest entry like an uploaded file:
+    sources whose chunks all match it are skipped, and otherwise only new or
+    changed chunks are embedded. Returns a result per source, as ingest_files.
+    """
+    vector_db = rag_assistant.knowledge_base.vector_db
+    collection = vector_db.collection
+    results: Dict[str, Dict[str, Any]] = {}
+
+    source_hashes = {name: sha256_text("\x00".join(d.content for d in documents)) for name, documents in sources}
+    previous = manifest.get_entries(collection, source_hashes)
+
+    to_load: List[Tuple[str, List[Document]]] = []
+    for name, documents in sources:
+        results[name] = {"chunks": 0, "unchanged_chunks": 0, "error": None}
+        if name in previous and previous[name]["file_sha256"] == source_hashes[name]:
+            results[name]["unchanged_chunks"] = previous[name]["chunks"]
+            results[name]["unchanged"] = True
+            continue
+        results[name]["embed_batches"] = []
+        to_load.append((name, documents))
+
+    chunk_hashes: Dict[str, Dict[str, str]] = {name: {} for name, _ in to_load}
+    doc_names = {name: documents[0].name for name, documents in to_load if documents}
+    loaded = False
+    with _buffered(vector_db), BatchEmbedder(vector_db.embedder) as batch_embedder:
+        for name, documents in to_load:
+            old_hashes = (previous.get(name) or {}).get("chunk_hashes") or {}
+            loaded = _load_chunks(vector_db, batch_embedder, documents, old_hashes, chunk_hashes[name], results[name], loaded)
+
+        _finish(vector_db, results, [name for name, _ in to_load], previous, chunk_hashes, loaded)
+    _record(collection, results, previous, source_hashes, chunk_hashes, doc_names)
+    return results
+
+
+def _load_chunks(
+    vector_db,
+    batch_embedder: BatchEmbedder,
+    documents: List[Document],
+    old_hashes: Dict[str, str],
+    chunk_hashes: Dict[str, str],
+    result: Dict[str, Any],
+    loaded: bool,
+) -> bool:
+    """Embed and upsert the new or changed chunks of a source, INGEST_WINDOW_CHUNKS at a time.
+
+    Records every chunk's hash in `chunk_hashes` and counts into `result`;
+    returns whether anything has been upserted so far.
+    """
+    for first in range(0, len(documents), INGEST_WINDOW_CHUNKS):
+        window = documents[first:first + INGEST_WINDOW_CHUNKS]
+        changed: List[Document] = []
+        for document in window:
+            document_id, content_hash = chunk_id(document), sha256_text(document.content)
+            chunk_hashes[document_id] = content_hash
+            # Only chunks that are new or whose content changed need embedding
+            if old_hashes.get(document_id) != content_hash:
+                changed.append(document)
+        result["unchanged_chunks"] += len(window) - len(changed)
+        if not changed:
+            continue
+        embed_start = time.perf_counter()
+        try:
+            for embed_future in batch_embedder.submit(changed):
+                result["embed_batches"].append(embed_future.result())
+        except Exception as e:
+            result["error"] = f"Embedding failed: {e}"
+            break
+        result["embed_ms"] = round(result.get("embed_ms", 0) + (time.perf_counter() - embed_start) * 1000, 1)
+        if not loaded:
+            vector_db.create()
+        upsert_documents(vector_db, changed)
+        loaded = True
+        result["chunks"] += len(changed)
+    return loaded
+
+
+def _finish(
+    vector_db,
+    results: Dict[str, Dict[str, Any]],
+    names: List[str],
+    previous: Dict[str, Dict[str, Any]],
+    chunk_hashes: Dict[str, Dict[str, str]],
+    loaded: bool,
+) -> None:
+    """Delete the chunks the loaded sources no longer have, then version and index the knowledge base."""
+    stale_ids: List[str] = []
+    for name in names:
+        result = results[name]
+        if result["error"] is None and not chunk_hashes[name]:
+            result["error"] = f"Could not read {name}"
+        if result["error"] is None:
+            old_hashes = (previous.get(name) or {}).get("chunk_hashes") or {}
+            stale_ids.extend(set(old_hashes) - set(chunk_hashes[name]))
+
+    delete_documents(vector_db, stale_ids)
+    if isinstance(vector_db, LocalVectorDb):
+        # The new rows must be searchable before the version that caches answers over them
+        vector_db.flush()
+    if loaded or stale_ids:
+        manifest.bump_version(vector_db.collection)
+    if loaded:
+        try:
+            maintain_index(vector_db)
+        except Exception as e:
+            logging.error(f"Could not maintain the vector index of {vector_db.collection}: {e}")
+        maintain_text_index(vector_db)
+
+
+def _record(
+    collection: str,
+    results: Dict[str, Dict[str, Any]],
+    previous: Dict[str, Dict[str, Any]],
+    source_hashes: Dict[str, str],
+    chunk_hashes: Dict[str, Dict[str, str]],
+    doc_names: Dict[str, str],
+    stats: Optional[Dict[str, Tuple[int, int]]] = None,
+) -> None:
+    """Save the manifest entry of every source that was loaded, with its file `stats` if any."""
+    stats = stats or {}
+    for name, result in results.items():
+        if result["error"]:
+            logging.error(f"Could not ingest {name}: {result['error']}")
+        elif result.get("unchanged"):
+            logging.info(f"{name} is unchanged, skipped")
+            entry = previous[name]
+            if name in stats and (entry["file_size"], entry["file_mtime_ns"]) != stats[name]:
+                manifest.save_stat(collection, name, stats[name])
+        else:
+            doc_name = doc_names.get(name) or (previous.get(name) or {}).get("doc_name")
+            manifest.save_entry(collection, name, doc_name, source_hashes[name], chunk_hashes[name], stats.get(name))
+            logging.info(f"{name} processed and loaded into the knowledge base")
@@ -0,0 +1,301 @@
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from uploads import keep_upload, upload_name
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join("uploads", "jobs.sqlite3"))
+JOBS_SPOOL_DIR = os.getenv("JOBS_SPOOL_DIR", os.path.join("uploads", ".jobs"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# A running job is leased to its worker, which renews the lease every third of
+# this; a job whose lease has expired (its process died) is claimed again
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+# handler(kb_name, [(file_name, file_path)]) -> {file_name: {"chunks", "error", "parse_ms", "embed_ms"}}
+JobHandler = Callable[[Optional[str], List[Tuple[str, str]]], Dict[str, Dict[str, Any]]]
+
+
+class JobQueue:
+    """Durable ingestion queue backed by a local SQLite file.
+
+    Every web worker process runs a few background threads that claim queued
+    jobs, so uploads return immediately and ingestion runs outside the request.
+    Each process renews the lease (heartbeat_at) of the jobs it is running;
+    jobs left `running` by a dead process are claimed again once their lease
+    has expired. Process ids are not used: containers reuse them.
+    """
+
+    def __init__(self, db_path: str = JOBS_DB_PATH, spool_dir: str = JOBS_SPOOL_DIR):
+        self.db_path = db_path
+        self.spool_root = spool_dir
+        self._wakeup = threading.Event()
+        self._started_pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        # Jobs this process is running, whose leases the heartbeat thread renews
+        self._running: Set[str] = set()
+        self._running_lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._init_db()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Autocommit connection; multi-statement writes use explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self) -> None:
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kb_name TEXT,
+                    status TEXT NOT NULL,
+                    worker_pid INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status_idx ON jobs (status, created_at);
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    file_name TEXT NOT NULL,
+                    file_path TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    chunks INTEGER,
+                    parse_ms REAL,
+                    embed_ms REAL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT,
+                    PRIMARY KEY (job_id, idx)
+                );
+                """
+            )
+            # Columns added after the tables were first created
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(job_files)")}
+            for column in ("parse_ms", "embed_ms"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE job_files ADD COLUMN {column} REAL")
+            if "heartbeat_at" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
+
+    def new_job_id(self) -> str:
+        return uuid4().hex
+
+    def spool_dir(self, job_id: str) -> str:
+        """Private directory where a job's uploads can be saved until processed."""
+        path = os.path.join(self.spool_root, job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def submit(self, kb_name: Optional[str], files: List[Tuple[str, str]], job_id: Optional[str] = None) -> str:
+        """Queue (file_name, file_path) pairs for ingestion into `kb_name`."""
+        job_id = job_id or self.new_job_id()
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO jobs (id, kb_name, status, created_at) VALUES (?, ?, 'queued', ?)", (job_id, kb_name, now)
+            )
+            conn.executemany(
+                "INSERT INTO job_files (job_id, idx, file_name, file_path, status) VALUES (?, ?, ?, ?, 'queued')",
+                [(job_id, idx, name, path) for idx, (name, path) in enumerate(files)],
+            )
+            conn.execute("COMMIT")
+        self._wakeup.set()
+        return job_id
+
+    def submit_uploads(self, kb_name: Optional[str], uploaded_files: List[Any], folder: Optional[str] = None) -> str:
+        """Keep uploaded files (in `folder`, or the job's spool dir) and queue them."""
+        job_id = self.new_job_id()
+        target = folder or self.spool_dir(job_id)
+        files: List[Tuple[str, str]] = []
+        for uploaded_file in uploaded_files:
+            if uploaded_file.filename == '':
+                logging.error("Error in processing file ")
+                continue
+            file_name = upload_name(uploaded_file.filename)
+            file_path = os.path.join(target, file_name)
+            keep_upload(uploaded_file, file_path)
+            files.append((file_name, file_path))
+        return self.submit(kb_name, files, job_id=job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            files = conn.execute("SELECT * FROM job_files WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        return {
+            "job_id": job["id"],
+            "kb_name": job["kb_name"],
+            "status": job["status"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "files": [
+                {
+                    "file_name": f["file_name"],
+                    "status": f["status"],
+                    "chunks": f["chunks"],
+                    "parse_ms": f["parse_ms"],
+                    "embed_ms": f["embed_ms"],
+                    "duration_ms": round((f["finished_at"] - f["started_at"]) * 1000, 1)
+                    if f["finished_at"] and f["started_at"]
+                    else None,
+                    "error": f["error"],
+                }
+                for f in files
+            ],
+        }
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        """Lease the oldest queued job, or a running job whose lease has expired."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            job = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' OR (status = 'running' AND COALESCE(heartbeat_at, 0) < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now - JOB_LEASE_SECONDS,),
+            ).fetchone()
+            if job is not None:
+                if job["status"] == "running":
+                    logging.info(f"Re-running ingestion job {job['id']}, its worker's lease expired")
+                    conn.execute(
+                        "UPDATE job_files SET status = 'queued' WHERE job_id = ? AND status = 'running'", (job["id"],)
+                    )
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker_pid = ?, heartbeat_at = ?, "
+                    "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                    (os.getpid(), now, now, job["id"]),
+                )
+            conn.execute("COMMIT")
+        if job is not None:
+            with self._running_lock:
+                self._running.add(job["id"])
+        return job
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                with self._connect() as conn:
+                    conn.executemany(
+                        "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                        [(time.time(), job_id) for job_id in running],
+                    )
+            except Exception as e:
+                logging.error(f"Error renewing ingestion job leases: {str(e)}")
+
+    def _fail(self, job_id: str, error: str) -> None:
+        """Mark a job and its unfinished files failed."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE job_files SET status = 'failed', error = ?, finished_at = ? "
+                "WHERE job_id = ? AND status IN ('queued', 'running')",
+                (error, now, job_id),
+            )
+            conn.execute("UPDATE jobs SET status = 'failed', finished_at = ? WHERE id = ?", (now, job_id))
+            conn.execute("COMMIT")
+
+    def _update_file(self, job_id: str, idx: int, **fields: Any) -> None:
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._connect() as conn:
+            conn.execute(f"UPDATE job_files SET {assignments} WHERE job_id = ? AND idx = ?", (*fields.values(), job_id, idx))
+
+    def _run_job(self, job: sqlite3.Row, handler: JobHandler) -> None:
+        job_id = job["id"]
+        with self._connect() as conn:
+            files = conn.execute(
+                "SELECT * FROM job_files WHERE job_id = ? AND status = 'queued' ORDER BY idx", (job_id,)
+            ).fetchall()
+        started_at = time.time()
+        for f in files:
+            self._update_file(job_id, f["idx"], status="running", started_at=started_at)
+        # All files of a job go through the ingestion pipeline together
+        try:
+            results = handler(job["kb_name"], [(f["file_name"], f["file_path"]) for f in files])
+        except Exception as e:
+            logging.error(f"Error ingesting job {job_id}: {str(e)}")
+            results = {f["file_name"]: {"chunks": 0, "error": str(e)} for f in files}
+        finished_at = time.time()
+        for f in files:
+            result = results.get(f["file_name"], {"chunks": 0, "error": "File was not processed"})
+            self._update_file(
+                job_id,
+                f["idx"],
+                status="failed" if result.get("error") else "done",
+                chunks=result.get("chunks"),
+                parse_ms=result.get("parse_ms"),
+                embed_ms=result.get("embed_ms"),
+                error=result.get("error"),
+                finished_at=finished_at,
+            )
+
+        with self._connect() as conn:
+            failed = conn.execute(
+                "SELECT COUNT(*) FROM job_files WHERE job_id = ? AND status = 'failed'", (job_id,)
+            ).fetchone()[0]
+            total = conn.execute("SELECT COUNT(*) FROM job_files WHERE job_id = ?", (job_id,)).fetchone()[0]
+            status = "failed" if total and failed == total else "done"
+            conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), job_id))
+        shutil.rmtree(os.path.join(self.spool_root, job_id), ignore_errors=True)
+
+    def _worker_loop(self, handler: JobHandler) -> None:
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logging.error(f"Error claiming ingestion job: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            try:
+                self._run_job(job, handler)
+            except Exception as e:
+                # e.g. the jobs database was locked while recording results
+                logging.error(f"Error running ingestion job {job['id']}: {str(e)}")
+                try:
+                    self._fail(job["id"], f"Could not record the job's results: {str(e)}")
+                except Exception as e:
+                    # The lease expires and another worker runs the job again
+                    logging.error(f"Error marking ingestion job {job['id']} failed: {str(e)}")
+            finally:
+                with self._running_lock:
+                    self._running.discard(job["id"])
+
+    def start(self, handler: JobHandler, workers: int = INGEST_WORKERS) -> None:
+        """Start the background workers for this process (idempotent)."""
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            # Leases of jobs claimed by the process this one was forked from are not ours to renew
+            self._running.clear()
+            threading.Thread(target=self._heartbeat_loop, name="ingest-heartbeat", daemon=True).start()
+            for i in range(workers):
+                threading.Thread(target=self._worker_loop, args=(handler,), name=f"ingest-worker-{i}", daemon=True).start()
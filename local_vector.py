@@ -0,0 +1,555 @@
+"""In-process vector store: NumPy matrices on local disk instead of pgvector.
+
+With VECTOR_BACKEND=local every knowledge base keeps its chunks under
+LOCAL_VECTOR_DIR/<collection>/ as generations of files:
+
+    vectors.<gen>.npy   N x dimensions matrix of unit length embeddings
+                        (float32, or float16), memory-mapped for searches
+    rows.<gen>.json     id, name, meta_data, usage, content_hash per row
+    ivf.<gen>.npz       optional IVF partitioning: centroids and each row's list
+    CURRENT             number of the live generation
+    contents.sqlite3    chunk contents by content_hash, shared by the generations
+
+Writers build the next generation under a file lock and switch CURRENT
+atomically, so searches in any worker process always see a complete
+generation and pick up a new one on their next search. The generation
+before the live one is kept until the next write, so a process that has
+just read CURRENT can still load the files it named. Every write
+rewrites the vectors and rows of the knowledge base (contents are only
+added to or pruned from contents.sqlite3), so ingestion buffers its
+upserts and deletes and writes one generation per call, or one per
+LOCAL_WRITE_BUFFER_ROWS changed rows; see LocalVectorDb.buffered. Searches are exact dot products (cosine similarity),
+or once a knowledge base has LOCAL_IVF_MIN_ROWS rows, dot products over the
+LOCAL_IVF_PROBES lists whose centroids are nearest to the query.
+
+Only the vectors move out of Postgres: the manifest, the per-kb settings
+tables, the model routes and the assistant storage still live in the
+database at DB_URL, so this backend needs it like the pgvector one.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from hashlib import md5
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from phi.document import Document
+from phi.embedder.base import Embedder
+from phi.vectordb.base import VectorDb
+
+from manifest import chunk_id
+from rerank import candidate_count, rerank
+from retrieval import get_settings as get_retrieval_settings
+from storage_profiles import STORAGE_PROFILES, StorageProfile
+
+# "pgvector" (PgVector2 tables in Postgres) or "local" (this module); either way
+# the rest of the knowledge base's state is kept in Postgres
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pgvector").lower()
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", os.path.join("uploads", ".vectors"))
+# float32 or float16; knowledge bases with the "half" storage profile always use float16
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32")
+LOCAL_IVF_MIN_ROWS = int(os.getenv("LOCAL_IVF_MIN_ROWS", "20000"))
+LOCAL_IVF_PROBES = int(os.getenv("LOCAL_IVF_PROBES", "8"))
+# The lists are trained again once the knowledge base has grown by this fraction
+LOCAL_IVF_REBUILD_GROWTH = float(os.getenv("LOCAL_IVF_REBUILD_GROWTH", "0.5"))
+# Rows scored per NumPy call, bounding the temporary memory of a search
+LOCAL_SEARCH_BLOCK_ROWS = int(os.getenv("LOCAL_SEARCH_BLOCK_ROWS", "65536"))
+# Buffered upserts and deletes are written as a generation once this many rows have changed
+LOCAL_WRITE_BUFFER_ROWS = int(os.getenv("LOCAL_WRITE_BUFFER_ROWS", "10000"))
+
+IVF_TRAIN_SAMPLE = 50000
+IVF_TRAIN_ITERATIONS = 10
+# Hashes per SELECT ... IN (...), below SQLite's default limit of 999 parameters
+CONTENT_HASHES_PER_QUERY = 500
+
+# A row to add: its rows.<gen>.json entry, its content and its unit length vector
+Entry = Tuple[Dict[str, Any], str, np.ndarray]
+
+
+class Generation(NamedTuple):
+    """One immutable, loaded version of a knowledge base's files."""
+
+    number: int
+    vectors: np.ndarray
+    rows: List[Dict[str, Any]]
+    centroids: Optional[np.ndarray] = None
+    # Row numbers ordered by list, and where each list starts in that order
+    list_rows: Optional[np.ndarray] = None
+    list_offsets: Optional[np.ndarray] = None
+    # Rows the centroids were trained on
+    trained_rows: int = 0
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for first in range(0, len(vectors), LOCAL_SEARCH_BLOCK_ROWS):
+        block = np.asarray(vectors[first:first + LOCAL_SEARCH_BLOCK_ROWS], dtype=np.float32)
+        lists[first:first + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return lists
+
+
+def train_ivf(vectors: np.ndarray, seed: int = 0) -> np.ndarray:
+    """Centroids of sqrt(N) lists, by spherical k-means on a sample of the vectors."""
+    rng = np.random.default_rng(seed)
+    n_lists = max(1, int(np.sqrt(len(vectors))))
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), IVF_TRAIN_SAMPLE), replace=False))]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(IVF_TRAIN_ITERATIONS):
+        lists = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, sample)
+        # Lists left empty keep their centroid
+        empty = ~np.bincount(lists, minlength=n_lists).astype(bool)
+        sums[empty] = centroids[empty]
+        centroids = _normalized(sums)
+    return centroids
+
+
+class ContentStore:
+    """Chunk contents of one knowledge base in a SQLite file, keyed by content_hash.
+
+    Contents are written once and kept across generations, so a write only
+    adds the new contents and prunes those no generation on disk uses.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread, opened again if the file was replaced (the knowledge base deleted and reloaded)
+        inode = os.stat(self.path).st_ino if os.path.exists(self.path) else None
+        conn = getattr(self._local, "conn", None)
+        if conn is None or inode is None or self._local.inode != inode or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS contents (content_hash TEXT PRIMARY KEY, content TEXT NOT NULL)")
+            self._local.conn, self._local.inode, self._local.pid = conn, os.stat(self.path).st_ino, os.getpid()
+        return conn
+
+    def get_many(self, content_hashes: Iterable[str]) -> Dict[str, str]:
+        unique_hashes = list(dict.fromkeys(content_hashes))
+        if not unique_hashes or not os.path.exists(self.path):
+            return {}
+        conn, contents = self._conn(), {}
+        for first in range(0, len(unique_hashes), CONTENT_HASHES_PER_QUERY):
+            chunk = unique_hashes[first:first + CONTENT_HASHES_PER_QUERY]
+            rows = conn.execute(
+                f"SELECT content_hash, content FROM contents WHERE content_hash IN ({', '.join('?' * len(chunk))})", chunk
+            )
+            contents.update(rows.fetchall())
+        return contents
+
+    def write(self, contents: Dict[str, str], keep: Iterable[str]) -> None:
+        """Add `contents` and delete every content whose hash is not in `keep`, in one transaction."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR IGNORE INTO contents (content_hash, content) VALUES (?, ?)", contents.items())
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep (content_hash TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM keep")
+            conn.executemany("INSERT OR IGNORE INTO keep (content_hash) VALUES (?)", ((h,) for h in keep))
+            conn.execute("DELETE FROM contents WHERE content_hash NOT IN (SELECT content_hash FROM keep)")
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class LocalVectorDb(VectorDb):
+    """One knowledge base stored by this module; a drop-in for IndexedPgVector."""
+
+    def __init__(
+        self,
+        collection: str,
+        embedder: Optional[Embedder] = None,
+        profile: Optional[StorageProfile] = None,
+        directory: str = LOCAL_VECTOR_DIR,
+    ):
+        self.collection = collection
+        self.embedder = embedder
+        self.profile = profile or STORAGE_PROFILES["full"]
+        self.dimensions = embedder.dimensions if embedder is not None else self.profile.dimensions
+        self.dtype = np.float16 if self.profile.precision == "half" else np.dtype(LOCAL_VECTOR_DTYPE).type
+        self.path = os.path.join(directory, collection)
+        self._generation: Optional[Generation] = None
+        self._current_stat = None
+        self._load_lock = threading.Lock()
+        self.contents = ContentStore(self._file("contents.sqlite3"))
+        # Changes buffered by this thread, see buffered()
+        self._buffer = threading.local()
+
+    # Files
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _empty(self) -> Generation:
+        return Generation(0, np.empty((0, self.dimensions), dtype=self.dtype), [])
+
+    def _load(self) -> Generation:
+        """The live generation, reloaded only when CURRENT has changed."""
+        try:
+            stat = os.stat(self._file("CURRENT"))
+        except FileNotFoundError:
+            return self._empty()
+        current_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        generation = self._generation
+        if generation is not None and current_stat == self._current_stat:
+            return generation
+        with self._load_lock:
+            if self._generation is not None and current_stat == self._current_stat:
+                return self._generation
+            try:
+                generation = self._read()
+            except FileNotFoundError:
+                # Two writes went by while the files were read and the second removed them
+                stat = os.stat(self._file("CURRENT"))
+                current_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+                generation = self._read()
+            self._generation, self._current_stat = generation, current_stat
+            return generation
+
+    def _read(self) -> Generation:
+        with open(self._file("CURRENT")) as current:
+            number = int(current.read())
+        vectors = np.load(self._file(f"vectors.{number}.npy"), mmap_mode="r")
+        with open(self._file(f"rows.{number}.json")) as rows_file:
+            rows = json.load(rows_file)
+        generation = Generation(number, vectors, rows)
+        if os.path.exists(self._file(f"ivf.{number}.npz")):
+            with np.load(self._file(f"ivf.{number}.npz")) as ivf:
+                lists = ivf["lists"]
+                order = np.argsort(lists, kind="stable").astype(np.int64)
+                offsets = np.searchsorted(lists[order], np.arange(len(ivf["centroids"]) + 1))
+                generation = generation._replace(
+                    centroids=ivf["centroids"],
+                    list_rows=order,
+                    list_offsets=offsets,
+                    trained_rows=int(ivf["trained_rows"]),
+                )
+        return generation
+
+    def _lists(self, generation: Generation) -> Optional[np.ndarray]:
+        """Each row's list, or None if the generation has no IVF partitioning."""
+        if generation.centroids is None:
+            return None
+        lists = np.empty(len(generation.rows), dtype=np.int32)
+        for list_number in range(len(generation.centroids)):
+            first, last = generation.list_offsets[list_number], generation.list_offsets[list_number + 1]
+            lists[generation.list_rows[first:last]] = list_number
+        return lists
+
+    def _write(
+        self,
+        vectors: np.ndarray,
+        rows: List[Dict[str, Any]],
+        lists: Optional[np.ndarray],
+        previous: Generation,
+        rebuild_ivf: bool = False,
+    ) -> None:
+        """Write and switch to the next generation; the caller holds the write lock."""
+        number = previous.number + 1
+        np.save(self._file(f"vectors.{number}.npy"), np.ascontiguousarray(vectors, dtype=self.dtype))
+        with open(self._file(f"rows.{number}.json"), "w") as rows_file:
+            json.dump(rows, rows_file)
+
+        centroids, trained_rows = previous.centroids, previous.trained_rows
+        grown = trained_rows and len(rows) > trained_rows * (1 + LOCAL_IVF_REBUILD_GROWTH)
+        if len(rows) < LOCAL_IVF_MIN_ROWS:
+            centroids = None
+        elif centroids is None or rebuild_ivf or grown:
+            logging.info(f"Training IVF lists for {self.collection} ({len(rows)} rows)")
+            centroids, trained_rows = train_ivf(vectors), len(rows)
+            lists = None
+        if centroids is not None:
+            if lists is None:
+                lists = _assign(vectors, centroids)
+            np.savez(self._file(f"ivf.{number}.npz"), centroids=centroids, lists=lists, trained_rows=trained_rows)
+
+        temp_path = self._file(f"CURRENT.{os.getpid()}.tmp")
+        with open(temp_path, "w") as current:
+            current.write(str(number))
+        os.replace(temp_path, self._file("CURRENT"))
+        # The previous generation stays for processes that read CURRENT just before the switch;
+        # those still searching older files keep them open until they reload
+        stale = previous.number - 1
+        for name in (f"vectors.{stale}.npy", f"rows.{stale}.json", f"ivf.{stale}.npz"):
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def _rewrite(self, keep: np.ndarray, entries: List[Entry] = ()) -> None:
+        """Keep the rows where `keep` is true, then add `entries`; under the write lock."""
+        previous = self._load()
+        vectors, rows, lists = previous.vectors[keep], [row for row, kept in zip(previous.rows, keep) if kept], None
+        # Stores written before contents.sqlite3 existed have the contents in their rows
+        contents = {row["content_hash"]: row["content"] for row in rows if "content" in row}
+        if contents:
+            rows = [{key: value for key, value in row.items() if key != "content"} for row in rows]
+        previous_lists = self._lists(previous)
+        if previous_lists is not None:
+            lists = previous_lists[keep]
+        if entries:
+            new_vectors = np.stack([vector for _, _, vector in entries])
+            vectors = np.concatenate([np.asarray(vectors, dtype=np.float32), new_vectors]).astype(self.dtype)
+            rows = rows + [row for row, _, _ in entries]
+            contents.update((row["content_hash"], content) for row, content, _ in entries)
+            if lists is not None:
+                lists = np.concatenate([lists, _assign(new_vectors, previous.centroids)])
+        # The previous generation stays on disk (see _write), so its contents do too
+        self.contents.write(contents, [row["content_hash"] for row in rows + previous.rows])
+        self._write(vectors, rows, lists, previous)
+
+    @staticmethod
+    def _entries(documents: List[Document]) -> List[Entry]:
+        vectors = _normalized([document.embedding for document in documents])
+        entries = []
+        for document, vector in zip(documents, vectors):
+            cleaned_content = document.content.replace("\x00", "\ufffd")
+            content_hash = md5(cleaned_content.encode()).hexdigest()
+            row = dict(
+                id=chunk_id(document),
+                name=document.name,
+                meta_data=document.meta_data,
+                usage=document.usage,
+                content_hash=content_hash,
+            )
+            entries.append((row, cleaned_content, vector))
+        return entries
+
+    def _apply(self, changes: Dict[str, Optional[Entry]]) -> None:
+        """Replace or add the rows of `changes`, deleting the ids mapped to None; under the write lock."""
+        previous = self._load()
+        keep = np.array([row["id"] not in changes for row in previous.rows], dtype=bool)
+        entries = [entry for entry in changes.values() if entry is not None]
+        if keep.all() and not entries:
+            return
+        self._rewrite(keep, entries)
+
+    # Buffered writes
+
+    @contextmanager
+    def buffered(self) -> Iterator[None]:
+        """Collect this thread's upserts and delete_ids and write them as one generation on leaving.
+
+        Every write rewrites the vectors and rows, so writing each ingestion
+        window on its own would make loading a knowledge base quadratic.
+        The buffer is also written by flush() and whenever LOCAL_WRITE_BUFFER_ROWS
+        rows have changed. Changes buffered when the block raises are dropped:
+        ingestion records nothing in the manifest then either.
+        """
+        if getattr(self._buffer, "changes", None) is not None:
+            yield
+            return
+        self._buffer.changes = {}
+        try:
+            yield
+            self.flush()
+        finally:
+            self._buffer.changes = None
+
+    def flush(self) -> None:
+        """Write the changes buffered by this thread, if any, as the next generation."""
+        changes = getattr(self._buffer, "changes", None)
+        if not changes:
+            return
+        with self._write_lock():
+            self._apply(changes)
+        changes.clear()
+
+    # VectorDb
+
+    def create(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file("CURRENT"))
+
+    def table_exists(self) -> bool:
+        return self.exists()
+
+    def doc_exists(self, document: Document) -> bool:
+        content_hash = md5(document.content.replace("\x00", "\ufffd").encode()).hexdigest()
+        return any(row["content_hash"] == content_hash for row in self._load().rows)
+
+    def name_exists(self, name: str) -> bool:
+        return any(row["name"] == name for row in self._load().rows)
+
+    def id_exists(self, id: str) -> bool:
+        return any(row["id"] == id for row in self._load().rows)
+
+    def get_count(self) -> int:
+        return len(self._load().rows)
+
+    def upsert_available(self) -> bool:
+        return True
+
+    def upsert(self, documents: List[Document], batch_size: int = 0) -> None:
+        """Add documents, replacing rows with the same id; embeds those that have no embedding yet."""
+        for document in documents:
+            if document.embedding is None:
+                document.embed(embedder=self.embedder)
+        if not documents:
+            return
+        # The last document with an id wins, as in a multi-row upsert
+        latest = {entry[0]["id"]: entry for entry in self._entries(documents)}
+        changes = getattr(self._buffer, "changes", None)
+        if changes is not None:
+            changes.update(latest)
+            if len(changes) >= LOCAL_WRITE_BUFFER_ROWS:
+                self.flush()
+            return
+        with self._write_lock():
+            self._apply(latest)
+        logging.info(f"Upserted {len(latest)} documents into {self.collection}")
+
+    def insert(self, documents: List[Document], batch_size: int = 0) -> None:
+        self.upsert(documents)
+
+    def delete_ids(self, ids: List[str]) -> None:
+        """Delete the rows of these chunk ids."""
+        changes = getattr(self._buffer, "changes", None)
+        if changes is not None:
+            changes.update(dict.fromkeys(ids))
+            return
+        self._delete_where("id", set(ids))
+
+    def delete_name(self, name: str) -> int:
+        """Delete every chunk of a document, as /delete does in Postgres; returns how many."""
+        return self._delete_where("name", {name})
+
+    def _delete_where(self, key: str, values: set) -> int:
+        if not values or not self.exists():
+            return 0
+        with self._write_lock():
+            keep = np.array([row[key] not in values for row in self._load().rows], dtype=bool)
+            if keep.all():
+                return 0
+            self._rewrite(keep)
+        return int((~keep).sum())
+
+    def clear(self) -> bool:
+        if self.exists():
+            with self._write_lock():
+                self._rewrite(np.zeros(len(self._load().rows), dtype=bool))
+        return True
+
+    def delete(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._generation = self._current_stat = None
+        if getattr(self._buffer, "changes", None):
+            self._buffer.changes.clear()
+
+    def optimize(self) -> None:
+        """Train the IVF lists again on the current rows."""
+        if not self.exists():
+            return
+        with self._write_lock():
+            previous = self._load()
+            self._write(previous.vectors, previous.rows, None, previous, rebuild_ivf=True)
+
+    def search(self, query: str, limit: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        # Full-text search is Postgres only: hybrid knowledge bases are searched by vector alone here
+        settings = get_retrieval_settings(self.collection)
+        limit = settings.top_k or limit
+        start = time.perf_counter()
+        query_embedding = self.embedder.get_embedding(query)
+        if query_embedding is None:
+            logging.error(f"Error getting embedding for Query: {query}")
+            return []
+        documents = self.search_batch([query_embedding], candidate_count(settings.reranker, limit), filters)[0]
+        return rerank(query, documents, limit, settings.reranker, (time.perf_counter() - start) * 1000)
+
+    def search_batch(
+        self, query_embeddings: List[List[float]], limit: int = 5, filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Document]]:
+        """The `limit` nearest documents for each of several query embeddings, scored in one pass."""
+        generation = self._load()
+        queries = _normalized(query_embeddings)
+        if not generation.rows:
+            return [[] for _ in queries]
+
+        candidates = None
+        if generation.centroids is not None:
+            # Only the rows of the lists nearest to any of the queries
+            probes = np.argsort(-(queries @ generation.centroids.T), axis=1)[:, :LOCAL_IVF_PROBES]
+            candidates = np.concatenate(
+                [
+                    generation.list_rows[generation.list_offsets[list_number]:generation.list_offsets[list_number + 1]]
+                    for list_number in np.unique(probes)
+                ]
+            )
+        if filters:
+            matching = [
+                number
+                for number, row in enumerate(generation.rows)
+                if all(row.get(key) == value for key, value in filters.items() if key in row)
+            ]
+            matching = np.array(matching, dtype=np.int64)
+            candidates = matching if candidates is None else np.intersect1d(candidates, matching)
+        if candidates is not None and len(candidates) == 0:
+            return [[] for _ in queries]
+
+        scores = self._scores(generation.vectors, queries, candidates)
+        limit = min(limit, scores.shape[1])
+        best = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+        hits = []
+        for query_number, row_numbers in enumerate(best):
+            row_numbers = row_numbers[np.argsort(-scores[query_number, row_numbers])]
+            if candidates is not None:
+                row_numbers = candidates[row_numbers]
+            hits.append([int(row_number) for row_number in row_numbers])
+        # One read of the contents for all the queries' results
+        contents = self.contents.get_many(
+            generation.rows[row_number]["content_hash"] for row_numbers in hits for row_number in row_numbers
+        )
+        return [[self._document(generation, row_number, contents) for row_number in row_numbers] for row_numbers in hits]
+
+    @staticmethod
+    def _scores(vectors: np.ndarray, queries: np.ndarray, candidates: Optional[np.ndarray]) -> np.ndarray:
+        """Similarity of every query to every candidate row (all rows if None), block by block."""
+        total = len(vectors) if candidates is None else len(candidates)
+        scores = np.empty((len(queries), total), dtype=np.float32)
+        for first in range(0, total, LOCAL_SEARCH_BLOCK_ROWS):
+            last = min(first + LOCAL_SEARCH_BLOCK_ROWS, total)
+            block = vectors[first:last] if candidates is None else vectors[candidates[first:last]]
+            scores[:, first:last] = queries @ np.asarray(block, dtype=np.float32).T
+        return scores
+
+    def _document(self, generation: Generation, row_number: int, contents: Dict[str, str]) -> Document:
+        row = generation.rows[row_number]
+        if "content" not in row and row["content_hash"] not in contents:
+            logging.warning(f"Missing content of {row['id']} in {self.collection}")
+        return Document(
+            id=row["id"],
+            name=row["name"],
+            meta_data=row["meta_data"] or {},
+            content=row.get("content", contents.get(row["content_hash"], "")),
+            embedder=self.embedder,
+            embedding=np.asarray(generation.vectors[row_number], dtype=np.float32).tolist(),
+            usage=row["usage"],
+        )
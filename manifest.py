@@ -0,0 +1,303 @@
+import hashlib
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from phi.document import Document
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql.expression import delete, select, text, update
+from sqlalchemy.types import BigInteger, DateTime, Integer, String
+
+from db import get_engine
+
+# Per knowledge base record of what has been ingested: the SHA-256 of every
+# uploaded file and of every chunk it produced, keyed by the vector table.
+metadata = MetaData(schema="ai")
+manifest_table = Table(
+    "groq_rag_manifest",
+    metadata,
+    Column("collection", String, primary_key=True),
+    Column("file_name", String, primary_key=True),
+    Column("doc_name", String),
+    Column("file_sha256", String),
+    # chunk id (see chunk_id, the id of its vector row) -> sha256 of the chunk content
+    Column("chunk_hashes", postgresql.JSONB),
+    Column("chunks", Integer),
+    # Size and mtime of the file when it was hashed, so a sync can skip hashing it again
+    Column("file_size", BigInteger),
+    Column("file_mtime_ns", BigInteger),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()"), onupdate=text("now()")),
+)
+
+_created = False
+_create_lock = threading.Lock()
+
+
+def _ensure_table() -> None:
+    global _created
+    if _created:
+        return
+    with _create_lock:
+        if not _created:
+            with get_engine().begin() as conn:
+                conn.execute(text("create schema if not exists ai;"))
+            metadata.create_all(get_engine(), checkfirst=True)
+            with get_engine().begin() as conn:
+                # Columns added after the table was first created
+                conn.execute(
+                    text(
+                        "alter table ai.groq_rag_manifest "
+                        "add column if not exists file_size bigint, add column if not exists file_mtime_ns bigint"
+                    )
+                )
+                conn.execute(text("alter table ai.groq_rag_kb_retrieval add column if not exists reranker varchar"))
+            _created = True
+
+
+def sha256_file(file_path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def sha256_text(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def chunk_id(document: Document) -> str:
+    """Id of a chunk's vector row and its key in chunk_hashes: its own id, else the MD5 of its content as PgVector2's."""
+    return document.id or hashlib.md5(document.content.replace("\x00", "\ufffd").encode()).hexdigest()
+
+
+def file_stat(file_path: str) -> Tuple[int, int]:
+    """(size, mtime_ns) of a file, as stored in the manifest."""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_entries(collection: str, file_names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Manifest entries for the given files of a knowledge base, keyed by file name."""
+    file_names = list(file_names)
+    if not file_names:
+        return {}
+    _ensure_table()
+    stmt = select(manifest_table).where(
+        manifest_table.c.collection == collection, manifest_table.c.file_name.in_(file_names)
+    )
+    with get_engine().connect() as conn:
+        return {row.file_name: dict(row._mapping) for row in conn.execute(stmt)}
+
+
+def list_entries(collection: str) -> Dict[str, Dict[str, Any]]:
+    """Every manifest entry of a knowledge base, keyed by file name."""
+    _ensure_table()
+    stmt = select(manifest_table).where(manifest_table.c.collection == collection)
+    with get_engine().connect() as conn:
+        return {row.file_name: dict(row._mapping) for row in conn.execute(stmt)}
+
+
+def save_entry(
+    collection: str,
+    file_name: str,
+    doc_name: Optional[str],
+    file_sha256: str,
+    chunk_hashes: Dict[str, str],
+    stat: Optional[Tuple[int, int]] = None,
+) -> None:
+    _ensure_table()
+    file_size, file_mtime_ns = stat or (None, None)
+    stmt = postgresql.insert(manifest_table).values(
+        collection=collection,
+        file_name=file_name,
+        doc_name=doc_name,
+        file_sha256=file_sha256,
+        chunk_hashes=chunk_hashes,
+        chunks=len(chunk_hashes),
+        file_size=file_size,
+        file_mtime_ns=file_mtime_ns,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["collection", "file_name"],
+        set_=dict(
+            doc_name=stmt.excluded.doc_name,
+            file_sha256=stmt.excluded.file_sha256,
+            chunk_hashes=stmt.excluded.chunk_hashes,
+            chunks=stmt.excluded.chunks,
+            file_size=stmt.excluded.file_size,
+            file_mtime_ns=stmt.excluded.file_mtime_ns,
+            updated_at=text("now()"),
+        ),
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+
+
+def save_stat(collection: str, file_name: str, stat: Tuple[int, int]) -> None:
+    """Record the size and mtime of a file whose content was found unchanged."""
+    _ensure_table()
+    stmt = (
+        update(manifest_table)
+        .where(manifest_table.c.collection == collection, manifest_table.c.file_name == file_name)
+        .values(file_size=stat[0], file_mtime_ns=stat[1])
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+
+
+def delete_files(collection: str, file_names: Iterable[str]) -> None:
+    """Forget files that were removed from a knowledge base."""
+    file_names = list(file_names)
+    if not file_names:
+        return
+    _ensure_table()
+    stmt = delete(manifest_table).where(
+        manifest_table.c.collection == collection, manifest_table.c.file_name.in_(file_names)
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+
+
+def delete_entries(collection: str, doc_name: Optional[str] = None) -> List[str]:
+    """Forget a knowledge base (or one document in it) so it is re-ingested next time."""
+    bump_version(collection)
+    stmt = delete(manifest_table).where(manifest_table.c.collection == collection)
+    if doc_name is not None:
+        stmt = stmt.where(manifest_table.c.doc_name == doc_name)
+    with get_engine().begin() as conn:
+        return [row.file_name for row in conn.execute(stmt.returning(manifest_table.c.file_name))]
+
+
+# Monotonic version per knowledge base, bumped whenever its documents change.
+# Anything derived from the knowledge base (e.g. cached answers) is keyed on it.
+kb_versions_table = Table(
+    "groq_rag_kb_versions",
+    metadata,
+    Column("collection", String, primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()"), onupdate=text("now()")),
+)
+
+
+def get_version(collection: str) -> int:
+    _ensure_table()
+    stmt = select(kb_versions_table.c.version).where(kb_versions_table.c.collection == collection)
+    with get_engine().connect() as conn:
+        return conn.execute(stmt).scalar() or 0
+
+
+def bump_version(collection: str) -> None:
+    _ensure_table()
+    stmt = postgresql.insert(kb_versions_table).values(collection=collection, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["collection"],
+        set_=dict(version=kb_versions_table.c.version + 1, updated_at=text("now()")),
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+
+
+# Embedding storage profile of each knowledge base (see storage_profiles.py).
+# It decides the vector table's layout, so it is fixed once the table exists.
+kb_profiles_table = Table(
+    "groq_rag_kb_profiles",
+    metadata,
+    Column("collection", String, primary_key=True),
+    Column("profile", String, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+)
+
+
+def get_profile(collection: str) -> Optional[str]:
+    _ensure_table()
+    stmt = select(kb_profiles_table.c.profile).where(kb_profiles_table.c.collection == collection)
+    with get_engine().connect() as conn:
+        return conn.execute(stmt).scalar()
+
+
+def save_profile(collection: str, profile: str) -> str:
+    """Record the profile unless one is already set; returns the profile in effect."""
+    _ensure_table()
+    stmt = postgresql.insert(kb_profiles_table).values(collection=collection, profile=profile)
+    stmt = stmt.on_conflict_do_nothing(index_elements=["collection"])
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+    return get_profile(collection)
+
+
+def has_entries(collection: str) -> bool:
+    _ensure_table()
+    stmt = select(manifest_table.c.file_name).where(manifest_table.c.collection == collection).limit(1)
+    with get_engine().connect() as conn:
+        return conn.execute(stmt).first() is not None
+
+
+# Chunking strategy of each knowledge base (see chunking.py). Chunk ids and
+# hashes depend on it, so it is fixed once the knowledge base has documents.
+kb_chunking_table = Table(
+    "groq_rag_kb_chunking",
+    metadata,
+    Column("collection", String, primary_key=True),
+    Column("strategy", String, nullable=False),
+    Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+)
+
+
+def get_chunking(collection: str) -> Optional[str]:
+    _ensure_table()
+    stmt = select(kb_chunking_table.c.strategy).where(kb_chunking_table.c.collection == collection)
+    with get_engine().connect() as conn:
+        return conn.execute(stmt).scalar()
+
+
+def save_chunking(collection: str, strategy: str) -> str:
+    """Record the strategy unless one is already set; returns the strategy in effect."""
+    _ensure_table()
+    stmt = postgresql.insert(kb_chunking_table).values(collection=collection, strategy=strategy)
+    stmt = stmt.on_conflict_do_nothing(index_elements=["collection"])
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+    return get_chunking(collection)
+
+
+# Retrieval mode and top_k of each knowledge base (see retrieval.py). Unlike
+# the profile and chunking strategy it only affects searches, so it can change.
+kb_retrieval_table = Table(
+    "groq_rag_kb_retrieval",
+    metadata,
+    Column("collection", String, primary_key=True),
+    Column("mode", String, nullable=False),
+    Column("top_k", Integer),
+    # None: the deployment's default reranker
+    Column("reranker", String),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()"), onupdate=text("now()")),
+)
+
+
+def get_retrieval(collection: str) -> Optional[Dict[str, Any]]:
+    _ensure_table()
+    stmt = select(kb_retrieval_table).where(kb_retrieval_table.c.collection == collection)
+    with get_engine().connect() as conn:
+        row = conn.execute(stmt).first()
+    return dict(row._mapping) if row is not None else None
+
+
+def save_retrieval(collection: str, mode: str, top_k: Optional[int], reranker: Optional[str] = None) -> None:
+    _ensure_table()
+    stmt = postgresql.insert(kb_retrieval_table).values(
+        collection=collection, mode=mode, top_k=top_k, reranker=reranker
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["collection"],
+        set_=dict(
+            mode=stmt.excluded.mode,
+            top_k=stmt.excluded.top_k,
+            reranker=stmt.excluded.reranker,
+            updated_at=text("now()"),
+        ),
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+
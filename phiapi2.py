@@ -18,18 +18,33 @@ from logging.handlers import RotatingFileHandler
 
 
 
-from assistant import get_groq_assistant ,get_openai_assistant 
+from assistant import get_groq_assistant ,get_openai_assistant ,component_cache_stats ,set_storage_profile ,set_chunking_strategy ,set_retrieval
+from budget import breakdown, reset_breakdown
+from failover import last_call, provider_stats, reset_last_call
+from db import pool_stats
+from embedding_cache import get_embedding_cache
+from streaming import stream_chat
+from ingest import ingest_files, sync_folder
+from jobs import JobQueue
+from crawler import get_page_cache, ingest_url
+from uploads import KEEP_UPLOADS, SpooledRequest, duplicate_names, keep_upload, upload_name, uploaded_paths
+from rerank import retrieval_stats
+from response_cache import response_cache
+from routing import get_assistant, routing_stats, set_route
+import runs
+from vector_index import set_search_params
+import manifest
 
 import shutil
 
 app = Flask(__name__)
+# Uploads are parsed straight from the file werkzeug streams them into
+app.request_class = SpooledRequest
 app.config['MAX_CONTENT_LENGTH'] = 60 * 1024 * 1024  # 60 MB
 upload_folder = 'uploads'
 os.makedirs(upload_folder, exist_ok=True)
 ds=defaultdict(list)  
-p_llm_model: Optional[str] = "llama3-70b-8192"
 p_embeddings_model = "text-embedding-3-large"
-assistant_processor: Optional[Callable] =get_groq_assistant
 custom_key = 42 #"NetComLearning@PhiRagChatBot"
 CORS(app) 
 
@@ -43,22 +58,19 @@ app.logger.addHandler(handler)
 
 @app.route('/select-model', methods=['POST'])
 def model():
-    global p_llm_model, assistant_processor
     if request.is_json:
      data = request.get_json()
     model_id=data.get('llm')
     p_llm_model=data.get('model')
-    
-    file_processors: Dict[str, Callable] = {
-            'groq': get_groq_assistant,
-            'openai': get_openai_assistant
-            }
 
     if not model_id or not p_llm_model:
         return jsonify("Missing necessary model information"), 400
 
-    assistant_processor = file_processors.get(model_id)
-    if not assistant_processor:
+    # Persisted, so every worker uses it: for kb_name, or without one for every
+    # knowledge base that has not selected its own model
+    try:
+        set_route(data.get('kb_name'), model_id, p_llm_model)
+    except ValueError:
         return jsonify("Invalid model ID"), 400
 
     return jsonify("Successfully selected the model"), 200
@@ -67,7 +79,6 @@ def model():
 
 @app.route('/receive-file', methods=['POST'])
 def receive_file():
-    global p_llm_model, assistant_processor
     # Get Knowledge Base (KB) name from request parameter
     folder_name_param = request.form.get('kb_name')
     folder_name = folder_name_param
@@ -78,126 +89,101 @@ def receive_file():
     folder_path = os.path.join(upload_folder, folder_name)
     os.makedirs(folder_path, exist_ok=True)
     
-    rag_assistant = assistant_processor(llm_model=p_llm_model, embeddings_model=p_embeddings_model,user_id=folder_name_param)
+    try:
+        # Only takes effect for a new knowledge base
+        set_storage_profile(p_embeddings_model, folder_name_param, request.form.get('storage_profile'))
+        set_chunking_strategy(p_embeddings_model, folder_name_param, request.form.get('chunking'))
+        # Can be changed on any upload: 'vector' or 'hybrid' search, chunks per answer and their reranker
+        set_retrieval(p_embeddings_model, folder_name_param, request.form.get('retrieval'), request.form.get('top_k', type=int), request.form.get('reranker'))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'kb_name': folder_name_param}), 400
+
+    rag_assistant = get_assistant(folder_name_param, p_embeddings_model)
     
     # Handle file uploads
     if 'file' in request.files:
         uploaded_files = request.files.getlist('file')
+        duplicates = duplicate_names(uploaded_files)
+        if duplicates:
+            return jsonify({'error': f"Files with the same name: {', '.join(duplicates)}", 'kb_name': folder_name_param}), 400
+        if request.form.get('async', 'true').lower() != 'false':
+            # Accept immediately; background workers parse and embed the files
+            job_id = ingest_queue.submit_uploads(folder_name_param, uploaded_files, folder=folder_path if KEEP_UPLOADS else None)
+            return jsonify({'message': 'Files queued for processing', 'kb_name': folder_name_param, 'job_id': job_id}),202
         # rag_assistant = get_groq_assistant(llm_model=p_llm_model, embeddings_model=p_embeddings_model,user_id=folder_name_param)
-        for uploaded_file in uploaded_files:
-            if uploaded_file.filename != '':
-                file_path = os.path.join(folder_path, uploaded_file.filename)
-                uploaded_file.save(file_path)
-                process_file(file_path,rag_assistant,folder_name_param,uploaded_file.filename)  # Process the file directly for the knowledge base
- 
-            else: logging.error(f"Error in processing file ")
+        with uploaded_paths(uploaded_files) as files:
+            if KEEP_UPLOADS:
+                # Hard links to the spooled uploads, not copies
+                for uploaded_file in uploaded_files:
+                    if uploaded_file.filename != '':
+                        keep_upload(uploaded_file, os.path.join(folder_path, upload_name(uploaded_file.filename)))
+            process_files(files,rag_assistant,folder_name_param)  # Process the files directly for the knowledge base
  
     elif 'url' in request.form:
         url = request.form['url']        
-        process_url(folder_path, rag_assistant, url)
+        process_url(folder_path, rag_assistant, url, request.form.get('max_pages', type=int), request.form.get('max_depth', type=int))
         
     return jsonify({'message': 'Files uploaded successfully', 'kb_name': folder_name_param}),200
 
 
-def process_file(file_path,rag_assistant,user_id,file_name):
-    print("Processing and integrating file into knowledge base:", file_path)
-    
-    # check file type ans 
-    
-    file_extension = os.path.splitext(file_name)[-1].lower()
-    file_processors = {
-        '.pdf': process_file_pdf,
-        '.docx': process_file_docx,
-        '.json': process_file_json,
-        '.txt': process_file_text,
-    }
-    
-    processor = file_processors.get(file_extension)
-    if processor:
-        processor(file_path,rag_assistant, user_id,file_name)
-    else:
-        logging.error(f"No handler for file type: {file_extension}")
-        return jsonify({'message': 'Unsupported filetype. Please upload a valid file.'}),400
+def process_files(files,rag_assistant,user_id):
+    print("Processing and integrating files into knowledge base:", [file_path for _, file_path in files])
 
-def process_file_pdf(file_path,rag_assistant,user_id,name):
+    # Parse, embed and upsert all files together
+    results = ingest_files(rag_assistant, files)
+    for file_name, result in results.items():
+        if result['chunks']:
+            ds[user_id].append(file_name)
+    return results
 
-    print("inside process_file_pdf")
-    
- 
-    if rag_assistant :
-    
-        with open(file_path, 'rb') as file:
-                reader = PDFReader(chunk_size=2048)
-                rag_documents: List[Document] = reader.read(file_path)
-                if rag_documents:
-                    rag_assistant.knowledge_base.load_documents(rag_documents, upsert=True)
-                    logging.info("PDF processed and loaded into the knowledge base")
-                    ds[user_id].append(name)
-                else:
-                    logging.error("Could not read PDF in process_file")
- 
-def process_file_docx(file_path, rag_assistant,user_id,name):
-   print("inside process_file_docx")
-   if rag_assistant :
-        with open(file_path, 'rb') as file:
-        
-        
-                print("inside process_file_docx")
-                reade = DocxReader(chunk_size=2048)
-                path_obj = Path(file_path)
-                rag_document = reade.read(path_obj)
-                if rag_document:
-                    rag_assistant.knowledge_base.load_documents(rag_document, upsert=True)
-                    logging.info("DOCX file processed and loaded into the knowledge base")
-                else:
-                    logging.error("Could not read DOCX file")
- 
- 
-def process_file_json(file_path, rag_assistant,user_id,name):
-   print("inside process_file_json")
-   if rag_assistant :
-        with open(file_path, 'rb') as file:
-        
-                print("inside process_file_json")
-                reade = JSONReader(chunk_size=1024)
-                path_obj = Path(file_path)
-                rag_document = reade.read(path_obj)
-                if rag_document:
-                    rag_assistant.knowledge_base.load_documents(rag_document, upsert=True)
-                    logging.info("JSON file processed and loaded into the knowledge base")
-                else:
-                    logging.error("Could not read JSON file")
-
-def process_file_text(file_path, rag_assistant,user_id,name):
-   print("inside process_file_text")
-   if rag_assistant :
-        with open(file_path, 'rb') as file:
-        
-        
-                print("inside process_file_docx")
-                reade = TextReader(chunk_size=1024)
-                path_obj = Path(file_path)
-                rag_document = reade.read(path_obj)
-                if rag_document:
-                    rag_assistant.knowledge_base.load_documents(rag_document, upsert=True)
-                    logging.info("TEXT file processed and loaded into the knowledge base")
-                else:
-                    logging.error("Could not read TEXT file")
+
+def run_ingest_job(kb_name, files):
+    rag_assistant = get_assistant(kb_name, p_embeddings_model)
+    return ingest_files(rag_assistant, files)
+
+
+ingest_queue = JobQueue()
+ingest_queue.start(run_ingest_job)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'job_id': job_id}), 404
+    return jsonify(job), 200
 
 
 
 
-def process_url(file_path, rag_assistant, input_url):
+@app.route('/kb/<kb_name>/sync', methods=['POST'])
+def sync_kb(kb_name):
+    # Re-embeds only the files added or changed in uploads/<kb_name> and drops the removed ones
+    if not KEEP_UPLOADS:
+        # uploads/<kb_name> holds no files, a sync would remove everything
+        return jsonify({'message': 'Uploads are not kept (KEEP_UPLOADS=false), there is no folder to sync.', 'kb_name': kb_name}), 409
+    directory_path = os.path.join(upload_folder, kb_name)
+    if not os.path.isdir(directory_path):
+        return jsonify({'message': 'The Knowledge Base does not exists.', 'kb_name': kb_name}), 404
+    rag_assistant = get_assistant(kb_name, p_embeddings_model)
+    logging.info("Syncing KB : "+kb_name)
+    sync = sync_folder(rag_assistant, directory_path)
+    ds[kb_name].extend(sync['added'])
+    errors = {file_name: result['error'] for file_name, result in sync['results'].items() if result['error']}
+    return jsonify({'kb_name': kb_name, 'added': sync['added'], 'changed': sync['changed'], 'unchanged': sync['unchanged'], 'removed': sync['removed'], 'errors': errors, 'sync_ms': sync['sync_ms']}),200
+
+
+def process_url(file_path, rag_assistant, input_url, max_pages=None, max_depth=None):
      if rag_assistant :
-        scraper = WebsiteReader(max_links=2, max_depth=1)
-        web_documents = scraper.read(input_url)
-        print(web_documents)
-        save_text_to_folder(web_documents, file_path, str(input_url))
-        if web_documents:
-            rag_assistant.knowledge_base.load_documents(web_documents, upsert=True)
-            logging.info("URL processed and content loaded into the knowledge base")
+        # Only pages whose text changed since the last crawl are embedded again
+        crawl = ingest_url(rag_assistant, input_url, max_pages, max_depth)
+        pages = [get_page_cache().get(page_url) for page_url in crawl['results']]
+        save_text_to_folder("\n\n".join(page.content for page in pages if page), file_path, str(input_url))
+        if crawl['pages']:
+            logging.info(f"URL processed and content loaded into the knowledge base: {crawl['pages']} pages, {crawl['not_modified']} not modified")
         else:
             logging.error("Could not process URL")    
+        return crawl
 
 def save_text_to_folder(text, folder_path, file_name):
     # Check if the folder exists, if not, create it
@@ -238,9 +224,32 @@ def list_files_in_folder(folder_path):
             file_list.append(file)
     return file_list
 
+def get_chat_assistant(id):
+    run_id = runs.resolve_run_id(id)
+    rag_assistant=get_assistant(id, p_embeddings_model, run_id=run_id)
+    if run_id is None:
+        runs.remember_run_id(id, rag_assistant.create_run())
+    logging.info(f"run id: {rag_assistant.run_id} for user id:{rag_assistant.user_id}")
+    return rag_assistant
+
+
+@app.route('/chat/stream', methods=['POST'])
+def rag_chat_stream():
+    if not request.is_json:
+        return jsonify({"error": "Missing parameters in request"}), 400
+    data = request.get_json()
+    id=data.get('kb_name')
+    try:
+        set_search_params(data)
+        rag_assistant = get_chat_assistant(id)
+    except Exception as e:
+        logging.error(f"Error processing chat: {str(e)}")
+        return jsonify("Error processing request"), 500
+    return stream_chat(rag_assistant, data.get('user_prompt'), id, use_cache=response_cache.enabled(data))
+
+
 @app.route('/chat', methods=['POST'])
 def rag_chat():  
-    global p_llm_model, assistant_processor
     data = None
     user_prompt = None
     id=None
@@ -249,19 +258,25 @@ def rag_chat():
           data = request.get_json()
           user_prompt = data.get('user_prompt')
           id=data.get('kb_name')
-    print(assistant_processor,p_llm_model)
+          if data.get('stream'):
+              return rag_chat_stream()
     try:
-        rag_assistant = assistant_processor(llm_model=p_llm_model, embeddings_model=p_embeddings_model,user_id=id)
-        rag_assistant_run_ids: List[str] = rag_assistant.storage.get_all_run_ids(user_id=id) 
-        if not rag_assistant_run_ids:    
-           run_id=rag_assistant.create_run()
-        else: run_id=rag_assistant_run_ids[0]
-        rag_assistant=assistant_processor(llm_model=p_llm_model, embeddings_model=p_embeddings_model,run_id=run_id,user_id=id)
+        set_search_params(data)
+        reset_breakdown()
+        reset_last_call()
+        rag_assistant = get_chat_assistant(id)
+        use_cache = response_cache.enabled(data)
+        if use_cache:
+            cached, cache_entry = response_cache.lookup(rag_assistant, user_prompt)
+            if cached is not None:
+                return jsonify({"content": cached, "kb_name": id, "cached": True}), 200
         
         response=''
         
         for delta in rag_assistant.run(user_prompt):
                     response += delta 
+        if use_cache:
+            response_cache.store(cache_entry, rag_assistant, user_prompt, response)
         # r = requests.post("https://api.apispreadsheets.com/data/44QkCUAfiN14wsvh/", headers={}, json={"data": {"Prompt":user_prompt,"phidata":response}})
         # if r.status_code == 201:
         #     # SUCCESS 
@@ -272,8 +287,7 @@ def rag_chat():
         #     print('error on xlsx')
         #     pass
         
-        logging.info(f"run ids: {rag_assistant_run_ids} for user id:{rag_assistant.user_id}")
-        return jsonify({"content": response,"kb_name":id}),200
+        return jsonify({"content": response,"kb_name":id,"tokens": breakdown(), "llm": last_call()}),200
         #return response
     except Exception as e:
         logging.error(f"Error processing chat: {str(e)}")
@@ -302,16 +316,16 @@ def get_file_contents():
 
 @app.route('/clear', methods=['POST'])
 def clear_db():
-    global p_llm_model, assistant_processor
     try:
          
         # Extract the 'user_prompt' from the JSON data
         data = request.get_json()
         id=data.get('kb_name')
         directory_path = upload_folder+"/"+id
-        rag_assistant = assistant_processor(llm_model=p_llm_model, embeddings_model=p_embeddings_model,user_id=id)
+        rag_assistant = get_assistant(id, p_embeddings_model)
         logging.info("Clearing KB : "+id)
         clear_status = rag_assistant.knowledge_base.vector_db.clear()
+        manifest.delete_entries(rag_assistant.knowledge_base.vector_db.collection)
         if clear_status:
             try:
                 shutil.rmtree(directory_path)
@@ -329,6 +343,10 @@ def clear_db():
 def status_check():
     logging.info('Status check called')
     return jsonify({'status': 'API is up'}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({'assistant_cache': component_cache_stats(), 'db_pool': pool_stats(), 'embedding_cache': get_embedding_cache().stats(), 'response_cache': response_cache.stats(), 'run_id_cache': runs.run_id_cache.stats(), 'retrieval': retrieval_stats.stats(), 'model_routes': routing_stats(), 'llm_providers': provider_stats()}), 200
      
 
 
@@ -0,0 +1,173 @@
+"""Second retrieval stage: rerank a wide candidate set, keep the best top_k.
+
+Knowledge bases with a reranker (see retrieval.py) fetch RERANK_CANDIDATES
+chunks from the vector (or hybrid) search instead of top_k, and reorder them
+before the best top_k go into the prompt:
+
+    bm25           BM25 of the query words in each candidate, with the
+                   statistics of the candidate set, fused with the first
+                   stage ranking by RRF
+    cross-encoder  a local sentence-transformers CrossEncoder (RERANK_MODEL)
+                   scoring every (query, candidate) pair on the CPU; bm25 is
+                   used instead when sentence-transformers is not installed
+
+The time spent in each stage is kept for the current request (timings())
+and summarised per process for /metrics (retrieval_stats).
+"""
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from phi.document import Document
+
+from retrieval import RERANKER, reciprocal_rank_fusion
+
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Candidates are cut to this many characters before the cross-encoder reads them
+RERANK_MAX_CHARS = int(os.getenv("RERANK_MAX_CHARS", "2000"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Latencies kept per stage for stats()
+RETRIEVAL_STATS_WINDOW = 1000
+
+_WORD = re.compile(r"\w+(?:[-.]\w+)*")
+
+# Timings of the last search made in this request/thread
+_timings: ContextVar[Optional[Dict[str, Any]]] = ContextVar("retrieval_timings", default=None)
+
+
+def timings() -> Optional[Dict[str, Any]]:
+    """Stage latencies of the last search made by this request, or None if it made none."""
+    return _timings.get()
+
+
+def reset_timings() -> None:
+    _timings.set(None)
+
+
+class RetrievalStats:
+    """Recent per-stage latencies of this process, for /metrics."""
+
+    def __init__(self, window: int = RETRIEVAL_STATS_WINDOW):
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Counter = Counter()
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, reranker: str, stage_ms: Dict[str, float]) -> None:
+        with self._lock:
+            self._counts[reranker] += 1
+            for stage, ms in stage_ms.items():
+                self._samples.setdefault(stage, deque(maxlen=self._window)).append(ms)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            summary: Dict[str, Any] = {"searches": dict(self._counts)}
+            for stage, samples in self._samples.items():
+                ordered = sorted(samples)
+                summary[stage] = {
+                    "avg": round(sum(ordered) / len(ordered), 2),
+                    "p50": ordered[len(ordered) // 2],
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                }
+            return summary
+
+
+retrieval_stats = RetrievalStats()
+
+
+def candidate_count(reranker: Optional[str], limit: int) -> int:
+    """How many chunks the first stage fetches for `limit` chunks in the prompt."""
+    return limit if (reranker or RERANKER) == "none" else max(limit, RERANK_CANDIDATES)
+
+
+def tokenize(text: str) -> List[str]:
+    # Keeps codes such as AZ-104 or v2.1 in one piece
+    return _WORD.findall(text.lower())
+
+
+def bm25_scores(query: str, documents: List[Document]) -> List[float]:
+    """BM25 of the query in each document, with document frequencies taken from `documents`."""
+    terms = set(tokenize(query))
+    counts = [Counter(tokenize(document.content)) for document in documents]
+    lengths = [sum(count.values()) for count in counts]
+    average_length = (sum(lengths) / len(lengths)) or 1
+    idf = {}
+    for term in terms:
+        frequency = sum(1 for count in counts if term in count)
+        idf[term] = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+    scores = []
+    for count, length in zip(counts, lengths):
+        score = 0.0
+        for term in terms:
+            tf = count.get(term, 0)
+            if tf:
+                score += idf[term] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def _bm25_rerank(query: str, documents: List[Document]) -> List[Document]:
+    scores = bm25_scores(query, documents)
+    lexical = sorted((i for i in range(len(documents)) if scores[i] > 0), key=lambda i: -scores[i])
+    # The first stage order still counts: BM25 alone would drop purely semantic matches
+    return [documents[i] for i in reciprocal_rank_fusion([list(range(len(documents))), lexical])]
+
+
+_cross_encoder: Any = None
+_cross_encoder_lock = threading.Lock()
+_cross_encoder_missing = False
+
+
+def _get_cross_encoder() -> Any:
+    """The CrossEncoder of RERANK_MODEL, loaded once per process; None if it can't be loaded."""
+    global _cross_encoder, _cross_encoder_missing
+    if _cross_encoder is None and not _cross_encoder_missing:
+        with _cross_encoder_lock:
+            if _cross_encoder is None and not _cross_encoder_missing:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError:
+                    logging.warning("sentence-transformers is not installed, reranking with bm25 instead")
+                    _cross_encoder_missing = True
+                    return None
+                try:
+                    _cross_encoder = CrossEncoder(RERANK_MODEL, device="cpu")
+                except Exception as e:
+                    logging.error(f"Could not load {RERANK_MODEL}, reranking with bm25 instead: {e}")
+                    _cross_encoder_missing = True
+    return _cross_encoder
+
+
+def rerank(
+    query: str, documents: List[Document], limit: int, reranker: Optional[str], retrieve_ms: float
+) -> List[Document]:
+    """The best `limit` of the first stage's `documents` for the query, with the stage latencies recorded."""
+    reranker = reranker or RERANKER
+    start = time.perf_counter()
+    model = _get_cross_encoder() if reranker == "cross-encoder" else None
+    if reranker == "cross-encoder" and model is None:
+        reranker = "bm25"
+    if reranker != "none" and len(documents) > 1:
+        try:
+            if model is not None:
+                scores = model.predict([(query, document.content[:RERANK_MAX_CHARS]) for document in documents])
+                order = sorted(range(len(documents)), key=lambda i: -float(scores[i]))
+                documents = [documents[i] for i in order]
+            else:
+                documents = _bm25_rerank(query, documents)
+        except Exception as e:
+            # Keep the first stage order rather than failing the chat
+            logging.error(f"Error reranking documents: {e}")
+    stage_ms = {"retrieve_ms": round(retrieve_ms, 2), "rerank_ms": round((time.perf_counter() - start) * 1000, 2)}
+    _timings.set({"reranker": reranker, "candidates": len(documents), **stage_ms})
+    retrieval_stats.record(reranker, stage_ms)
+    logging.info(f"Retrieved {len(documents)} candidates in {stage_ms['retrieve_ms']}ms, reranked in {stage_ms['rerank_ms']}ms")
+    return documents[:limit]
@@ -0,0 +1,124 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+import manifest
+from cache import LRUCache
+from failover import last_call
+
+# Opt-in: enable for every request with the env var, or per request with {"cache": true}
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+# Minimum cosine similarity between query embeddings for a cached answer to be reused
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+# Answers kept per (knowledge base, llm model)
+RESPONSE_CACHE_ENTRIES = int(os.getenv("RESPONSE_CACHE_ENTRIES", "256"))
+RESPONSE_CACHE_KBS = int(os.getenv("RESPONSE_CACHE_KBS", "512"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    prompt = re.sub(r"\s+", " ", prompt.strip().lower())
+    return prompt.rstrip("?!. ")
+
+
+class _KbAnswers:
+    """Cached answers for one knowledge base version."""
+
+    def __init__(self, version: int):
+        self.version = version
+        self.answers: "OrderedDict[str, Tuple[np.ndarray, str]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+
+class ResponseCache:
+    """Per-process cache of /chat answers.
+
+    A prompt hits if its normalised text was answered before, or if its query
+    embedding is within `threshold` cosine similarity of one that was. Entries
+    are tied to the knowledge base version in the manifest, so any change made
+    through /receive-file, /delete or /clear invalidates them in every worker.
+    Chat history is not part of the key.
+    """
+
+    def __init__(self, threshold: float = RESPONSE_CACHE_THRESHOLD, entries: int = RESPONSE_CACHE_ENTRIES):
+        self.threshold = threshold
+        self.entries = entries
+        self._kbs = LRUCache(maxsize=RESPONSE_CACHE_KBS)
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def enabled(data: Optional[Dict[str, Any]]) -> bool:
+        if data and data.get('cache') is not None:
+            return bool(data.get('cache'))
+        return RESPONSE_CACHE_ENABLED
+
+    def _answers(self, rag_assistant) -> _KbAnswers:
+        collection = rag_assistant.knowledge_base.vector_db.collection
+        key = (collection, rag_assistant.llm.model)
+        version = manifest.get_version(collection)
+        kb_answers = self._kbs.get(key)
+        if kb_answers is None or kb_answers.version != version:
+            kb_answers = _KbAnswers(version)
+            self._kbs.set(key, kb_answers)
+        return kb_answers
+
+    def _embed(self, rag_assistant, prompt: str) -> np.ndarray:
+        embedding = np.asarray(rag_assistant.knowledge_base.vector_db.embedder.get_embedding(prompt), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def lookup(self, rag_assistant, prompt: str) -> Tuple[Optional[str], _KbAnswers]:
+        """Return the cached answer (or None) and the entry to store a fresh answer in.
+
+        Storing into the entry returned here means an answer generated while the
+        knowledge base changed is never filed under the new version.
+        """
+        kb_answers = self._answers(rag_assistant)
+        normalized = normalize_prompt(prompt)
+        with kb_answers.lock:
+            if normalized in kb_answers.answers:
+                kb_answers.answers.move_to_end(normalized)
+                self.hits += 1
+                return kb_answers.answers[normalized][1], kb_answers
+            cached = list(kb_answers.answers.items())
+        if cached:
+            query = self._embed(rag_assistant, prompt)
+            matrix = np.stack([embedding for _, (embedding, _) in cached])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                self.hits += 1
+                self.semantic_hits += 1
+                return cached[best][1][1], kb_answers
+        self.misses += 1
+        return None, kb_answers
+
+    def store(self, kb_answers: _KbAnswers, rag_assistant, prompt: str, answer: str) -> None:
+        if not answer:
+            return
+        call = last_call()
+        if call is not None and call["failed_over"]:
+            # Answers are filed under the routed model, not the fallback that wrote this one
+            return
+        embedding = self._embed(rag_assistant, prompt)
+        with kb_answers.lock:
+            kb_answers.answers[normalize_prompt(prompt)] = (embedding, answer)
+            while len(kb_answers.answers) > self.entries:
+                kb_answers.answers.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "knowledge_bases": len(self._kbs),
+            "threshold": self.threshold,
+        }
+
+
+response_cache = ResponseCache()
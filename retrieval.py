@@ -0,0 +1,98 @@
+"""How each knowledge base is searched: vector only, or hybrid.
+
+Hybrid retrieval runs a Postgres full-text query on the chunk content next
+to the vector query and merges the two rankings with reciprocal rank fusion
+(RRF), so exact terms such as product codes and course ids that embeddings
+blur are still found. Either way the candidates can be reranked before the
+best top_k go into the prompt (see rerank.py). The mode, reranker and top_k
+are kept per knowledge base and can be changed at any time.
+"""
+import os
+import threading
+import time
+from typing import Dict, Hashable, List, NamedTuple, Optional, Sequence, Tuple
+
+import manifest
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+# Mode of knowledge bases that never chose one
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower()
+RERANKERS = ("none", "bm25", "cross-encoder")
+# Reranker of knowledge bases that never chose one
+RERANKER = os.getenv("RERANKER", "none").lower()
+RETRIEVAL_MAX_TOP_K = int(os.getenv("RETRIEVAL_MAX_TOP_K", "20"))
+# Each side of a hybrid search ranks this many candidates before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+# RRF constant: a chunk ranked r by one side scores 1 / (RRF_K + r)
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Postgres text search configuration of the full-text index and queries
+TEXT_SEARCH_CONFIG = os.getenv("TEXT_SEARCH_CONFIG", "english")
+# Settings are re-read this often, so a change made by another worker is picked up
+RETRIEVAL_SETTINGS_TTL = float(os.getenv("RETRIEVAL_SETTINGS_TTL", "30"))
+
+
+class RetrievalSettings(NamedTuple):
+    """mode: "vector" or "hybrid".
+    top_k: chunks added to the prompt; None keeps the knowledge base's num_documents.
+    reranker: "none", "bm25" or "cross-encoder"; None uses RERANKER.
+    """
+
+    mode: str = RETRIEVAL_MODE
+    top_k: Optional[int] = None
+    reranker: Optional[str] = None
+
+
+_settings: Dict[str, Tuple[RetrievalSettings, float]] = {}
+_settings_lock = threading.Lock()
+
+
+def _remember(collection: str, settings: RetrievalSettings) -> RetrievalSettings:
+    with _settings_lock:
+        _settings[collection] = (settings, time.monotonic())
+    return settings
+
+
+def get_settings(collection: str) -> RetrievalSettings:
+    """Retrieval settings of a knowledge base's vector table."""
+    cached = _settings.get(collection)
+    if cached is not None and time.monotonic() - cached[1] < RETRIEVAL_SETTINGS_TTL:
+        return cached[0]
+    row = manifest.get_retrieval(collection)
+    settings = RetrievalSettings() if row is None else RetrievalSettings(row["mode"], row["top_k"], row["reranker"])
+    return _remember(collection, settings)
+
+
+def set_settings(
+    collection: str, mode: Optional[str] = None, top_k: Optional[int] = None, reranker: Optional[str] = None
+) -> RetrievalSettings:
+    """Change the retrieval mode, top_k and/or reranker of a knowledge base; None keeps the current value.
+
+    Raises ValueError for an unknown mode or reranker, or a top_k outside 1..RETRIEVAL_MAX_TOP_K.
+    """
+    current = get_settings(collection)
+    if mode is None and top_k is None and reranker is None:
+        return current
+    if mode is not None and mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}', expected one of {', '.join(RETRIEVAL_MODES)}")
+    if top_k is not None and not 1 <= top_k <= RETRIEVAL_MAX_TOP_K:
+        raise ValueError(f"top_k must be between 1 and {RETRIEVAL_MAX_TOP_K}")
+    if reranker is not None and reranker not in RERANKERS:
+        raise ValueError(f"Unknown reranker '{reranker}', expected one of {', '.join(RERANKERS)}")
+    settings = RetrievalSettings(
+        mode or current.mode, top_k if top_k is not None else current.top_k, reranker or current.reranker
+    )
+    if settings != current:
+        manifest.save_retrieval(collection, settings.mode, settings.top_k, settings.reranker)
+        # Cached answers were retrieved with the old settings
+        manifest.bump_version(collection)
+    return _remember(collection, settings)
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Hashable]], k: int = RRF_K) -> List[Hashable]:
+    """Merge best-first rankings into one: an item scores 1 / (k + rank) in every ranking it is in."""
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    # Ties keep the order items were first seen in, i.e. earlier rankings win
+    return sorted(scores, key=lambda item: -scores[item])
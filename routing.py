@@ -0,0 +1,198 @@
+"""Which LLM provider and model each knowledge base chats with.
+
+Routes are stored in Postgres (kb_models_table), so every gunicorn
+worker answers a knowledge base with the model selected for it, whichever
+worker handled /select-model. Each worker keeps the routes it has read in
+memory, so the chat path does not query them. A change is published with
+NOTIFY on ROUTING_CHANNEL; a listener thread in every worker drops its stale
+entry on the notification. ROUTING_CACHE_TTL bounds how long a worker can
+keep an old route if notifications cannot be received.
+
+A knowledge base without a route of its own uses the deployment default:
+the route saved under DEFAULT_ROUTE, else DEFAULT_LLM_PROVIDER/DEFAULT_LLM_MODEL.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+import psycopg
+from phi.assistant import Assistant
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import Column, MetaData, Table
+from sqlalchemy.sql.expression import select, text
+from sqlalchemy.types import DateTime, String
+
+from assistant import get_groq_assistant, get_openai_assistant
+from cache import LRUCache
+from db import db_url, get_engine
+
+PROVIDERS: Dict[str, Callable[..., Assistant]] = {"groq": get_groq_assistant, "openai": get_openai_assistant}
+DEFAULT_LLM_PROVIDER = os.getenv("DEFAULT_LLM_PROVIDER", "groq").lower()
+DEFAULT_LLM_MODEL = os.getenv("DEFAULT_LLM_MODEL", "llama3-70b-8192")
+# kb_name of the route used by knowledge bases that never selected a model
+DEFAULT_ROUTE = "*"
+ROUTING_CHANNEL = "groq_rag_kb_models"
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "4096"))
+# Routes are re-read at least this often, in case a notification was missed
+ROUTING_CACHE_TTL = float(os.getenv("ROUTING_CACHE_TTL", "300"))
+ROUTING_LISTEN = os.getenv("ROUTING_LISTEN", "true").lower() == "true"
+# Seconds between attempts to reconnect the listener
+ROUTING_LISTEN_RETRY = float(os.getenv("ROUTING_LISTEN_RETRY", "5"))
+
+
+# Keyed by kb_name rather than by vector table: a route does not depend on the embeddings
+kb_models_table = Table(
+    "groq_rag_kb_models",
+    MetaData(schema="ai"),
+    Column("kb_name", String, primary_key=True),
+    Column("provider", String, nullable=False),
+    Column("model", String, nullable=False),
+    Column("updated_at", DateTime(timezone=True), server_default=text("now()"), onupdate=text("now()")),
+)
+_created = False
+_create_lock = threading.Lock()
+
+
+def _ensure_table() -> None:
+    global _created
+    if _created:
+        return
+    with _create_lock:
+        if not _created:
+            with get_engine().begin() as conn:
+                conn.execute(text("create schema if not exists ai;"))
+            kb_models_table.create(get_engine(), checkfirst=True)
+            _created = True
+
+
+def _load_route(kb_name: str) -> Optional[Dict[str, Any]]:
+    _ensure_table()
+    stmt = select(kb_models_table).where(kb_models_table.c.kb_name == kb_name)
+    with get_engine().connect() as conn:
+        row = conn.execute(stmt).first()
+    return dict(row._mapping) if row is not None else None
+
+
+def _save_route(kb_name: str, provider: str, model: str) -> None:
+    """Upsert the route and NOTIFY every worker's listener with the kb_name when the transaction commits."""
+    _ensure_table()
+    stmt = postgresql.insert(kb_models_table).values(kb_name=kb_name, provider=provider, model=model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["kb_name"],
+        set_=dict(provider=stmt.excluded.provider, model=stmt.excluded.model, updated_at=text("now()")),
+    )
+    with get_engine().begin() as conn:
+        conn.execute(stmt)
+        conn.execute(text("SELECT pg_notify(:channel, :kb_name)"), {"channel": ROUTING_CHANNEL, "kb_name": kb_name})
+
+
+class ModelRoute(NamedTuple):
+    provider: str = DEFAULT_LLM_PROVIDER
+    model: str = DEFAULT_LLM_MODEL
+
+
+# kb_name -> (its route or None, monotonic time it was read)
+route_cache = LRUCache(maxsize=ROUTING_CACHE_SIZE)
+_lock = threading.Lock()
+# Bumped by every invalidation, so a read that raced with one is not cached
+_generation = 0
+_invalidations = 0
+_listener_pid: Optional[int] = None
+_listening = False
+
+
+def _invalidate(kb_name: Optional[str] = None) -> None:
+    """Forget the route of `kb_name`, or every route."""
+    global _generation, _invalidations
+    with _lock:
+        _generation += 1
+        _invalidations += 1
+        if kb_name is None:
+            route_cache.clear()
+        else:
+            route_cache.pop(kb_name)
+
+
+def _listen() -> None:
+    global _listening
+    url = make_url(db_url).set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        try:
+            with psycopg.connect(url, autocommit=True) as conn:
+                conn.execute(f"LISTEN {ROUTING_CHANNEL}")
+                # Changes made while nobody was listening were not notified
+                _invalidate()
+                _listening = True
+                for notify in conn.notifies():
+                    _invalidate(notify.payload)
+        except Exception as e:
+            logging.error(f"Model routing listener disconnected: {e}")
+        _listening = False
+        _invalidate()
+        time.sleep(ROUTING_LISTEN_RETRY)
+
+
+def _ensure_listener() -> None:
+    """Start this process's listener thread; a worker forked from a preloaded master starts its own."""
+    global _listener_pid
+    pid = os.getpid()
+    if not ROUTING_LISTEN or _listener_pid == pid:
+        return
+    with _lock:
+        if _listener_pid != pid:
+            threading.Thread(target=_listen, name="model-routing-listener", daemon=True).start()
+            _listener_pid = pid
+
+
+def _lookup(kb_name: str) -> Optional[ModelRoute]:
+    cached = route_cache.get(kb_name)
+    if cached is not None and time.monotonic() - cached[1] < ROUTING_CACHE_TTL:
+        return cached[0]
+    _ensure_listener()
+    generation = _generation
+    row = _load_route(kb_name)
+    route = ModelRoute(row["provider"], row["model"]) if row is not None else None
+    with _lock:
+        if generation == _generation:
+            route_cache.set(kb_name, (route, time.monotonic()))
+    return route
+
+
+def get_route(kb_name: Optional[str]) -> ModelRoute:
+    """Provider and model a knowledge base chats with."""
+    route = _lookup(kb_name) if kb_name else None
+    return route or _lookup(DEFAULT_ROUTE) or ModelRoute()
+
+
+def set_route(kb_name: Optional[str], provider: Optional[str], model: Optional[str]) -> ModelRoute:
+    """Select the provider and model of a knowledge base, or the default one if kb_name is None.
+
+    Raises ValueError for an unknown provider or a missing model.
+    """
+    provider = (provider or "").lower()
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider '{provider}', expected one of {', '.join(PROVIDERS)}")
+    if not model:
+        raise ValueError("Missing LLM model")
+    kb_name = kb_name or DEFAULT_ROUTE
+    _save_route(kb_name, provider, model)
+    # This worker does not wait for its own notification
+    _invalidate(kb_name)
+    logging.info(f"Model of {kb_name}: {provider} {model}")
+    return ModelRoute(provider, model)
+
+
+def get_assistant(
+    kb_name: Optional[str], embeddings_model: str, run_id: Optional[str] = None
+) -> Assistant:
+    """The assistant of a knowledge base, with the provider and model routed to it."""
+    route = get_route(kb_name)
+    processor = PROVIDERS.get(route.provider, PROVIDERS[DEFAULT_LLM_PROVIDER])
+    return processor(llm_model=route.model, embeddings_model=embeddings_model, run_id=run_id, user_id=kb_name)
+
+
+def routing_stats() -> Dict[str, Any]:
+    return {**route_cache.stats(), "listening": _listening, "invalidations": _invalidations}
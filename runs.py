@@ -0,0 +1,63 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+from sqlalchemy.sql.expression import text
+
+from cache import LRUCache
+from db import get_engine
+
+# Every assistant run for every knowledge base lives in this table (see assistant.py)
+RUNS_TABLE = "ai.groq_rag_assistant"
+RUNS_INDEX = "groq_rag_assistant_user_id_created_at_idx"
+
+# Active run id per kb_name, so /chat does not look it up on every request
+RUN_ID_CACHE_SIZE = int(os.getenv("RUN_ID_CACHE_SIZE", "1024"))
+RUN_ID_CACHE_TTL = float(os.getenv("RUN_ID_CACHE_TTL", "600"))
+run_id_cache = LRUCache(maxsize=RUN_ID_CACHE_SIZE, ttl=RUN_ID_CACHE_TTL)
+
+_indexed = False
+_index_lock = threading.Lock()
+
+
+def _ensure_index() -> bool:
+    """Index runs by (user_id, created_at) once the table exists; returns whether it does."""
+    global _indexed
+    if _indexed:
+        return True
+    with _index_lock:
+        if not _indexed:
+            with get_engine().begin() as conn:
+                if conn.execute(text("SELECT to_regclass(:table)"), {"table": RUNS_TABLE}).scalar() is None:
+                    # phidata creates the table on the first write
+                    return False
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {RUNS_INDEX} ON {RUNS_TABLE} (user_id, created_at DESC)"))
+            _indexed = True
+    return True
+
+
+def latest_run_id(user_id: Optional[str]) -> Optional[str]:
+    """Most recent run of a knowledge base, the same one `get_all_run_ids(user_id)[0]` returns."""
+    if not _ensure_index():
+        return None
+    where = "WHERE user_id = :user_id" if user_id is not None else ""
+    stmt = text(f"SELECT run_id FROM {RUNS_TABLE} {where} ORDER BY created_at DESC LIMIT 1")
+    with get_engine().connect() as conn:
+        return conn.execute(stmt, {"user_id": user_id}).scalar()
+
+
+def resolve_run_id(user_id: Optional[str]) -> Optional[str]:
+    """Active run id for a knowledge base, or None if it has no run yet."""
+    run_id = run_id_cache.get(user_id)
+    if run_id is None:
+        run_id = latest_run_id(user_id)
+        if run_id is not None:
+            run_id_cache.set(user_id, run_id)
+    return run_id
+
+
+def remember_run_id(user_id: Optional[str], run_id: Optional[str]) -> None:
+    if run_id is not None:
+        run_id_cache.set(user_id, run_id)
+        logging.info(f"Created run {run_id} for user id: {user_id}")
@@ -0,0 +1,217 @@
+"""Shared, hash partitioned vector tables for all knowledge bases.
+
+With VECTOR_STORAGE_LAYOUT=shared every knowledge base stores its chunks in
+one table per storage profile (ai.groq_rag_documents_shared for "full"),
+partitioned by HASH (kb_name), instead of a groq_rag_documents_openai_<kb>
+table of its own. Existing per knowledge base tables are moved with:
+
+    python shared_table.py migrate [--kb NAME ...] [--drop]
+
+Searches filter the ANN index scan on kb_name, which needs pgvector >= 0.8
+and its iterative index scans to always find top_k chunks of a small
+knowledge base. On older versions searches of a shared table raise
+hnsw.ef_search and ivfflat.probes (SHARED_HNSW_EF_SEARCH,
+SHARED_IVFFLAT_PROBES in vector_index.py), which makes a shortfall unlikely
+but not impossible.
+"""
+import argparse
+import logging
+import os
+from hashlib import md5
+from typing import Any, Dict, List, Optional
+
+from phi.document import Document
+from phi.embedder.base import Embedder
+from sqlalchemy.schema import Column, Table
+from sqlalchemy.sql.expression import delete, func, select, text
+from sqlalchemy.types import String
+
+from db import get_engine
+from storage_profiles import StorageProfile, get_profile
+from vector_index import IndexedPgVector, maintain_index
+
+# "per_kb" (one table per knowledge base) or "shared"
+VECTOR_STORAGE_LAYOUT = os.getenv("VECTOR_STORAGE_LAYOUT", "per_kb").lower()
+SHARED_TABLE_PARTITIONS = int(os.getenv("SHARED_TABLE_PARTITIONS", "16"))
+
+PER_KB_TABLE_PREFIX = "groq_rag_documents_openai"
+
+
+def shared_table_name(profile: StorageProfile) -> str:
+    suffix = "" if profile.name == "full" else "_" + profile.name.replace("-", "_")
+    return f"groq_rag_documents_shared{suffix}"
+
+
+class SharedPgVector(IndexedPgVector):
+    """One knowledge base's view of the shared vector table of its storage profile.
+
+    `collection` stays the per knowledge base name, which the manifest,
+    versions and caches are keyed on; rows are told apart by `kb_name`.
+    """
+
+    def __init__(self, *args: Any, kb_name: str, **kwargs: Any):
+        self.kb_name = kb_name
+        super().__init__(*args, **kwargs)
+
+    def table_name(self) -> str:
+        return shared_table_name(self.profile)
+
+    def table_columns(self) -> List[Column]:
+        return [Column("kb_name", String, primary_key=True)] + super().table_columns()
+
+    def get_table(self) -> Table:
+        return Table(
+            self.table_name(),
+            self.metadata,
+            *self.table_columns(),
+            postgresql_partition_by="HASH (kb_name)",
+            extend_existing=True,
+        )
+
+    def scope(self) -> Dict[str, Any]:
+        return {"kb_name": self.kb_name}
+
+    def create(self) -> None:
+        super().create()
+        # Idempotent, so a worker racing the one that created the table still finds every partition
+        with self.Session() as sess, sess.begin():
+            for remainder in range(SHARED_TABLE_PARTITIONS):
+                sess.execute(
+                    text(
+                        f"CREATE TABLE IF NOT EXISTS {self.schema}.{self.table.name}_p{remainder} "
+                        f"PARTITION OF {self.schema}.{self.table.name} "
+                        f"FOR VALUES WITH (MODULUS {SHARED_TABLE_PARTITIONS}, REMAINDER {remainder})"
+                    )
+                )
+
+    def _exists_where(self, condition) -> bool:
+        with self.Session() as sess, sess.begin():
+            return sess.execute(self.scoped(select(self.table.c.id).where(condition)).limit(1)).first() is not None
+
+    def doc_exists(self, document: Document) -> bool:
+        cleaned_content = document.content.replace("\x00", "\ufffd")
+        return self._exists_where(self.table.c.content_hash == md5(cleaned_content.encode()).hexdigest())
+
+    def name_exists(self, name: str) -> bool:
+        return self._exists_where(self.table.c.name == name)
+
+    def id_exists(self, id: str) -> bool:
+        return self._exists_where(self.table.c.id == id)
+
+    def upsert(self, documents: List[Document], batch_size: int = 20) -> None:
+        # Imported here: ingest depends on the vector db classes
+        from ingest import upsert_documents
+
+        for document in documents:
+            document.embed(embedder=self.embedder)
+        upsert_documents(self, documents, batch_size=batch_size)
+
+    def insert(self, documents: List[Document], batch_size: int = 10) -> None:
+        self.upsert(documents, batch_size=batch_size)
+
+    def get_count(self) -> int:
+        with self.Session() as sess, sess.begin():
+            return sess.execute(self.scoped(select(func.count()).select_from(self.table))).scalar() or 0
+
+    def clear(self) -> bool:
+        with self.Session() as sess, sess.begin():
+            sess.execute(self.scoped(delete(self.table)))
+        return True
+
+    def delete(self) -> None:
+        # Never drop the shared table, only this knowledge base's rows
+        if self.table_exists():
+            self.clear()
+
+
+def _per_kb_tables() -> List[str]:
+    stmt = text(
+        "SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE n.nspname = 'ai' AND c.relkind = 'r' AND NOT c.relispartition "
+        "AND (c.relname = :prefix OR c.relname LIKE :pattern) ORDER BY c.relname"
+    )
+    with get_engine().connect() as conn:
+        return list(conn.execute(stmt, {"prefix": PER_KB_TABLE_PREFIX, "pattern": PER_KB_TABLE_PREFIX + "\\_%"}).scalars())
+
+
+def migrate_table(collection: str, drop: bool = False) -> Dict[str, Any]:
+    """Copy one per knowledge base table into the shared table of its profile."""
+    kb_name = collection[len(PER_KB_TABLE_PREFIX) + 1:]
+    profile = get_profile(collection)
+    target = SharedPgVector(
+        collection=collection,
+        kb_name=kb_name,
+        profile=profile,
+        db_engine=get_engine(),
+        embedder=Embedder(dimensions=profile.dimensions),
+    )
+    target.create()
+
+    columns = "id, name, meta_data, content, embedding, usage, created_at, updated_at, content_hash"
+    with get_engine().begin() as conn:
+        # Blocks writes to the old table so no chunk is left behind
+        conn.execute(text(f"LOCK TABLE ai.{collection} IN SHARE MODE"))
+        copied = conn.execute(
+            text(
+                f"INSERT INTO ai.{target.table.name} (kb_name, {columns}) "
+                f"SELECT :kb_name, {columns} FROM ai.{collection} "
+                "ON CONFLICT (kb_name, id) DO NOTHING"
+            ),
+            {"kb_name": kb_name},
+        ).rowcount
+        source_rows = conn.execute(text(f"SELECT count(*) FROM ai.{collection}")).scalar()
+        target_rows = conn.execute(
+            text(f"SELECT count(*) FROM ai.{target.table.name} WHERE kb_name = :kb_name"), {"kb_name": kb_name}
+        ).scalar()
+        if target_rows < source_rows:
+            raise RuntimeError(f"{collection}: only {target_rows} of {source_rows} rows in {target.table.name}")
+        if drop:
+            conn.execute(text(f"DROP TABLE ai.{collection}"))
+    logging.info(f"Migrated {collection} ({copied} rows) into {target.table.name}")
+    return {"collection": collection, "kb_name": kb_name, "table": target.table.name, "rows": source_rows, "dropped": drop}
+
+
+def migrate(kb_names: Optional[List[str]] = None, drop: bool = False) -> List[Dict[str, Any]]:
+    """Move per knowledge base tables (all, or those of `kb_names`) into the shared tables."""
+    collections = _per_kb_tables()
+    if kb_names is not None:
+        wanted = {f"{PER_KB_TABLE_PREFIX}_{kb_name}" if kb_name else PER_KB_TABLE_PREFIX for kb_name in kb_names}
+        collections = [collection for collection in collections if collection in wanted]
+    results = [migrate_table(collection, drop=drop) for collection in collections]
+
+    # One ANN index per shared table instead of one per knowledge base
+    for table_name in {result["table"] for result in results}:
+        migrated = [result for result in results if result["table"] == table_name]
+        profile = get_profile(migrated[0]["collection"])
+        try:
+            maintain_index(
+                SharedPgVector(
+                    collection=table_name,
+                    kb_name="",
+                    profile=profile,
+                    db_engine=get_engine(),
+                    embedder=Embedder(dimensions=profile.dimensions),
+                )
+            )
+        except Exception as e:
+            # The rows are copied; searches work without the index and the next ingestion builds it
+            for result in migrated:
+                logging.error(f"Could not maintain the vector index of {result['collection']} in {table_name}: {e}")
+                result["index_error"] = str(e)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="move per knowledge base tables into the shared tables")
+    migrate_parser.add_argument("--kb", action="append", dest="kb_names", help="only this knowledge base (repeatable)")
+    migrate_parser.add_argument("--drop", action="store_true", help="drop each per knowledge base table once copied")
+    args = parser.parse_args()
+    for result in migrate(args.kb_names, drop=args.drop):
+        print(f"{result['collection']} -> {result['table']} (kb_name={result['kb_name']!r}, {result['rows']} rows)")
+        if result.get("index_error"):
+            print(f"  index not built: {result['index_error']}")
+    if not args.drop:
+        print("Per knowledge base tables were kept; rerun with --drop to remove them.")
@@ -0,0 +1,96 @@
+import os
+import threading
+from typing import Dict, NamedTuple, Optional
+
+from sqlalchemy.inspection import inspect
+
+import manifest
+from db import get_engine, pgvector_version
+
+
+class StorageProfile(NamedTuple):
+    """How a knowledge base stores its OpenAI embeddings.
+
+    dimensions: embeddings are requested truncated to this size
+        (text-embedding-3 models are Matryoshka trained, so shorter prefixes
+        keep most of the retrieval quality).
+    precision: "float32" stores `vector`, "half" stores `halfvec` (pgvector >= 0.7).
+    binary: also keep a 1 bit per dimension copy of each embedding; searches
+        scan the bits by Hamming distance and rescore the best candidates
+        with the full precision vectors.
+    """
+
+    name: str
+    dimensions: int
+    precision: str = "float32"
+    binary: bool = False
+
+
+STORAGE_PROFILES: Dict[str, StorageProfile] = {
+    profile.name: profile
+    for profile in (
+        StorageProfile("full", 3072),
+        StorageProfile("1024", 1024),
+        StorageProfile("256", 256),
+        StorageProfile("half", 3072, precision="half"),
+        StorageProfile("binary", 3072, binary=True),
+        StorageProfile("1024-binary", 1024, binary=True),
+    )
+}
+
+# Profile given to new knowledge bases when the upload does not ask for one.
+# Tables created before profiles existed are always "full".
+EMBEDDING_STORAGE_PROFILE = os.getenv("EMBEDDING_STORAGE_PROFILE", "full")
+# Binary searches rescore this many candidates per requested document
+BINARY_RESCORE_OVERSAMPLE = int(os.getenv("BINARY_RESCORE_OVERSAMPLE", "10"))
+
+# Profiles never change once recorded, so they are cached for the process lifetime
+_profiles: Dict[str, StorageProfile] = {}
+_profiles_lock = threading.Lock()
+
+
+def _table_exists(collection: str) -> bool:
+    return inspect(get_engine()).has_table(collection, schema="ai")
+
+
+def _remember(collection: str, name: str) -> StorageProfile:
+    profile = STORAGE_PROFILES[name]
+    with _profiles_lock:
+        _profiles[collection] = profile
+    return profile
+
+
+def get_profile(collection: str) -> StorageProfile:
+    """Storage profile of a knowledge base's vector table."""
+    if collection in _profiles:
+        return _profiles[collection]
+    name = manifest.get_profile(collection)
+    if name is None and _table_exists(collection):
+        name = manifest.save_profile(collection, "full")
+    if name is None:
+        # New knowledge base: the first upload records its profile
+        return STORAGE_PROFILES[EMBEDDING_STORAGE_PROFILE]
+    return _remember(collection, name)
+
+
+def set_profile(collection: str, name: Optional[str] = None) -> StorageProfile:
+    """Fix the profile of a knowledge base before its first documents are stored.
+
+    Raises ValueError for an unknown profile, one the database can't store, or
+    one that differs from the profile the knowledge base already uses.
+    """
+    if name is not None and name not in STORAGE_PROFILES:
+        raise ValueError(f"Unknown storage profile '{name}', expected one of {', '.join(STORAGE_PROFILES)}")
+    current = _profiles.get(collection) or get_profile(collection)
+    if collection in _profiles:
+        if name is not None and name != current.name:
+            raise ValueError(f"Knowledge base already stores embeddings with the '{current.name}' profile")
+        return current
+
+    profile = STORAGE_PROFILES[name or EMBEDDING_STORAGE_PROFILE]
+    if profile.precision == "half" and pgvector_version() < (0, 7):
+        raise ValueError("The 'half' storage profile needs pgvector >= 0.7")
+    saved = manifest.save_profile(collection, profile.name)
+    if saved != profile.name and name is not None:
+        raise ValueError(f"Knowledge base already stores embeddings with the '{saved}' profile")
+    return _remember(collection, saved)
@@ -0,0 +1,74 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from flask import Response, stream_with_context
+
+from budget import breakdown, reset_breakdown
+from failover import last_call, reset_last_call
+from rerank import reset_timings, timings
+from response_cache import response_cache
+
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format one Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+def stream_chat(rag_assistant, user_prompt: str, kb_name: Optional[str], use_cache: bool = False) -> Response:
+    """Forward the assistant's deltas to the client as they are generated.
+
+    Each delta is sent as a `data: {"delta": ...}` frame. The stream ends with a
+    `done` event carrying the kb_name, run_id, timings (retrieval stages
+    included), prompt token breakdown and the provider that answered (or an `error` event).
+    With `use_cache` a cached answer is sent as a single delta and the done
+    event is marked `"cached": true`.
+    """
+
+    def generate():
+        start = time.perf_counter()
+        first_token_ms = None
+        cached = False
+        reset_timings()
+        reset_breakdown()
+        reset_last_call()
+        try:
+            answer, cache_entry = response_cache.lookup(rag_assistant, user_prompt) if use_cache else (None, None)
+            if answer is not None:
+                cached = True
+                first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+                yield sse_event({"delta": answer})
+            else:
+                answer = ""
+                for delta in rag_assistant.run(user_prompt):
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+                    answer += delta
+                    yield sse_event({"delta": delta})
+                if use_cache:
+                    response_cache.store(cache_entry, rag_assistant, user_prompt, answer)
+        except Exception as e:
+            logging.error(f"Error streaming chat: {str(e)}")
+            yield sse_event({"error": "Error processing request", "kb_name": kb_name}, event="error")
+            return
+        yield sse_event(
+            {
+                "kb_name": kb_name,
+                "run_id": rag_assistant.run_id,
+                "time_to_first_token_ms": first_token_ms,
+                "total_ms": round((time.perf_counter() - start) * 1000, 1),
+                "retrieval": timings(),
+                "tokens": breakdown(),
+                "llm": last_call(),
+                "cached": cached,
+            },
+            event="done",
+        )
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,220 @@
+"""Crawler politeness, limits and revalidation against a local HTTP server.
+
+The site is served by http.server on 127.0.0.1; ETags make re-crawls
+conditional. The ingestion tests also need the Postgres at DB_URL (manifest
+and vector table) and are skipped without it; embeddings are made up locally.
+"""
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import pytest
+from phi.embedder.base import Embedder
+from sqlalchemy import delete, select
+
+import crawler
+from crawler import Crawler, PageCache
+
+ROBOTS = "User-agent: *\nDisallow: /private\n"
+
+
+def html(title: str, links: List[str]) -> str:
+    anchors = "".join(f'<a href="{link}">{link}</a>' for link in links)
+    return f"<html><body><main><h1>{title}</h1><p>Text of the {title} page.</p>{anchors}</main></body></html>"
+
+
+class Site:
+    """Pages served by the fixture server, and the requests it received."""
+
+    def __init__(self) -> None:
+        self.pages: Dict[str, str] = {
+            "/": html("home", ["/a", "/b", "/private/secret"]),
+            "/a": html("a", ["/a/deep"]),
+            "/b": html("b", []),
+            "/a/deep": html("deep", []),
+            "/private/secret": html("secret", []),
+        }
+        # (path, status, monotonic time received)
+        self.requests: List[Tuple[str, int, float]] = []
+
+    def etag(self, path: str) -> str:
+        return '"' + hashlib.sha256(self.pages[path].encode()).hexdigest()[:16] + '"'
+
+
+@pytest.fixture
+def site():
+    site = Site()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            received = time.monotonic()
+            if self.path == "/robots.txt":
+                status, body, headers = 200, ROBOTS, {"Content-Type": "text/plain"}
+            elif self.path not in site.pages:
+                status, body, headers = 404, "not found", {"Content-Type": "text/plain"}
+            elif self.headers.get("If-None-Match") == site.etag(self.path):
+                status, body, headers = 304, "", {"ETag": site.etag(self.path)}
+            else:
+                status, body = 200, site.pages[self.path]
+                headers = {"Content-Type": "text/html; charset=utf-8", "ETag": site.etag(self.path)}
+            site.requests.append((self.path, status, received))
+            data = body.encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    site.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    yield site
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = PageCache(str(tmp_path / "crawl_cache.sqlite3"))
+    monkeypatch.setattr(crawler, "_cache", cache)
+    monkeypatch.setattr(crawler, "CRAWL_DELAY", 0.0)
+    return cache
+
+
+def run(site, cache, max_pages=10, max_depth=crawler.CRAWL_MAX_DEPTH) -> Crawler:
+    page_crawler = Crawler(site.url, max_pages, max_depth, cache=cache)
+    asyncio.run(page_crawler.run())
+    return page_crawler
+
+
+def paths(page_crawler: Crawler) -> List[str]:
+    return sorted("/" + page.url.split("/", 3)[3] for page in page_crawler.pages)
+
+
+def test_disallowed_path_is_skipped(site, cache):
+    page_crawler = run(site, cache)
+    assert "/private/secret" not in paths(page_crawler)
+    assert page_crawler.stats["disallowed"] == 1
+    assert not any(path.startswith("/private") for path, _, _ in site.requests)
+
+
+def test_recrawl_is_revalidated_with_304s(site, cache):
+    first = run(site, cache)
+    assert first.stats["fetched"] == 4
+    second = run(site, cache)
+    assert second.stats["fetched"] == 0
+    assert second.stats["not_modified"] == 4
+    assert paths(second) == paths(first)
+
+
+def test_changed_page_is_fetched_again(site, cache):
+    run(site, cache)
+    site.pages["/b"] = html("b changed", [])
+    again = run(site, cache)
+    assert again.stats["fetched"] == 1
+    assert again.stats["not_modified"] == 3
+
+
+def test_crawl_delay_spaces_requests_per_host(site, cache, monkeypatch):
+    monkeypatch.setattr(crawler, "CRAWL_DELAY", 0.3)
+    run(site, cache)
+    times = sorted(received for path, _, received in site.requests if path != "/robots.txt")
+    assert len(times) == 4
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert min(gaps) >= 0.25
+
+
+def test_max_depth_limits_the_crawl(site, cache):
+    # The start page is at depth 1
+    page_crawler = run(site, cache, max_depth=2)
+    assert paths(page_crawler) == ["/", "/a", "/b"]
+    assert page_crawler.complete
+
+
+def test_max_pages_limits_the_crawl(site, cache):
+    page_crawler = run(site, cache, max_pages=2)
+    assert len(page_crawler.pages) == 2
+    assert page_crawler.truncated
+    assert not page_crawler.complete
+
+
+class CountingEmbedder(Embedder):
+    dimensions: int = 8
+    calls: int = 0
+
+    def get_embedding(self, text: str) -> List[float]:
+        self.calls += 1
+        generator = random.Random(text)
+        return [generator.random() for _ in range(self.dimensions)]
+
+    def get_embedding_and_usage(self, text: str):
+        return self.get_embedding(text), None
+
+
+@pytest.fixture
+def knowledge_base():
+    from sqlalchemy.sql.expression import text
+
+    import manifest
+    from db import get_engine
+    from vector_index import IndexedPgVector
+
+    try:
+        with get_engine().connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    collection = f"test_crawler_{random.randrange(1 << 30)}"
+    embedder = CountingEmbedder()
+    vector_db = IndexedPgVector(collection=collection, db_engine=get_engine(), embedder=embedder)
+    yield SimpleNamespace(knowledge_base=SimpleNamespace(vector_db=vector_db)), embedder
+    vector_db.delete()
+    manifest.delete_entries(collection)
+    with get_engine().begin() as conn:
+        for table in (manifest.kb_versions_table, manifest.kb_chunking_table):
+            conn.execute(delete(table).where(table.c.collection == collection))
+
+
+def test_recrawl_embeds_nothing_and_removes_vanished_pages(site, cache, knowledge_base):
+    rag_assistant, embedder = knowledge_base
+    vector_db = rag_assistant.knowledge_base.vector_db
+
+    first = crawler.ingest_url(rag_assistant, site.url)
+    assert first["pages"] == 4
+    assert embedder.calls > 0
+    rows = vector_db.get_count()
+
+    calls = embedder.calls
+    second = crawler.ingest_url(rag_assistant, site.url)
+    assert second["not_modified"] == 4
+    assert embedder.calls == calls
+    assert all(result.get("unchanged") for result in second["results"].values())
+    assert second["removed"] == []
+
+    del site.pages["/b"]
+    site.pages["/"] = html("home", ["/a", "/private/secret"])
+    third = crawler.ingest_url(rag_assistant, site.url)
+    assert third["complete"]
+    assert third["removed"] == [site.url + "b"]
+    assert vector_db.get_count() < rows
+    with vector_db.Session() as sess:
+        chunk_ids = sess.execute(select(vector_db.table.c.id)).scalars().all()
+    # Chunk ids are <page url>_<n>
+    assert not any(chunk_id.startswith(site.url + "b_") for chunk_id in chunk_ids)
+
+
+def test_incomplete_crawl_keeps_pages(site, cache, knowledge_base):
+    rag_assistant, _ = knowledge_base
+    crawler.ingest_url(rag_assistant, site.url)
+    truncated = crawler.ingest_url(rag_assistant, site.url, max_pages=2)
+    assert not truncated["complete"]
+    assert truncated["removed"] == []
@@ -0,0 +1,194 @@
+"""Failover, first-token timeouts, circuit breaker and hedging with local stub providers.
+
+phidata's Groq and OpenAIChat response/response_stream are replaced by stubs
+that wait, fail or answer as each test says; no request leaves the process.
+"""
+import time
+from typing import Dict, List, Optional
+
+import pytest
+from groq import Groq as GroqClient
+from openai import OpenAI as OpenAIClient
+from phi.llm.groq import Groq
+from phi.llm.message import Message
+from phi.llm.openai import OpenAIChat
+
+import failover
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class StubProvider:
+    """How a provider behaves: seconds before its first token, or the error it raises."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.delay = 0.0
+        self.error: Optional[Exception] = None
+        self.calls = 0
+
+    def answer(self, model: str, messages: List[Message]):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        messages.append(Message(role="assistant", content=f"{self.name} {model}"))
+        yield f"{self.name} "
+        yield model
+
+
+@pytest.fixture
+def providers(monkeypatch) -> Dict[str, StubProvider]:
+    stubs = {"groq": StubProvider("groq"), "openai": StubProvider("openai")}
+    for provider, llm_class in (("groq", Groq), ("openai", OpenAIChat)):
+        stub = stubs[provider]
+
+        def response_stream(self, messages, stub=stub):
+            yield from stub.answer(self.model, messages)
+
+        def response(self, messages, stub=stub):
+            return "".join(stub.answer(self.model, messages))
+
+        monkeypatch.setattr(llm_class, "response_stream", response_stream)
+        monkeypatch.setattr(llm_class, "response", response)
+
+    clients = {"groq": GroqClient(api_key="test"), "openai": OpenAIClient(api_key="test")}
+    monkeypatch.setattr(failover, "llm_client", lambda provider: clients[provider])
+    monkeypatch.setattr(failover, "_health", {})
+    monkeypatch.setattr(failover, "LLM_FAILOVER", True)
+    monkeypatch.setattr(failover, "FAILOVER_MODELS", {"groq": ("openai", "gpt-4o"), "openai": ("groq", "llama3-70b-8192")})
+    monkeypatch.setattr(failover, "LLM_HEDGING", False)
+    monkeypatch.setattr(failover, "LLM_FIRST_TOKEN_TIMEOUT", 2.0)
+    monkeypatch.setattr(failover, "CIRCUIT_FAILURES", 2)
+    monkeypatch.setattr(failover, "CIRCUIT_OPEN_SECONDS", 0.3)
+    failover.reset_last_call()
+    return stubs
+
+
+def ask(stream: bool = True):
+    """Ask a Groq LLM; returns (answer, messages, seconds)."""
+    llm = failover.FailoverGroq(model="llama3-70b-8192", groq_client=GroqClient(api_key="test"), max_tokens=100)
+    messages = [Message(role="system", content="system"), Message(role="user", content="question")]
+    start = time.monotonic()
+    answer = "".join(llm.response_stream(messages)) if stream else llm.response(messages)
+    return answer, messages, time.monotonic() - start
+
+
+def test_primary_answers(providers):
+    answer, messages, _ = ask()
+    assert answer == "groq llama3-70b-8192"
+    assert failover.last_call()["provider"] == "groq"
+    assert not failover.last_call()["failed_over"]
+    assert [message.role for message in messages] == ["system", "user", "assistant"]
+    assert providers["openai"].calls == 0
+
+
+def test_error_fails_over(providers):
+    providers["groq"].error = RateLimited("rate limited")
+    answer, messages, _ = ask()
+    assert answer == "openai gpt-4o"
+    assert failover.last_call() == {
+        "provider": "openai", "model": "gpt-4o", "failed_over": True, "hedged": False, "attempts": 2
+    }
+    # Only the answer that was sent is kept
+    assert [message.content for message in messages[2:]] == ["openai gpt-4o"]
+
+
+def test_error_fails_over_without_streaming(providers):
+    providers["groq"].error = RateLimited("rate limited")
+    answer, _, _ = ask(stream=False)
+    assert answer == "openai gpt-4o"
+
+
+def test_first_token_timeout_fails_over(providers, monkeypatch):
+    monkeypatch.setattr(failover, "LLM_FIRST_TOKEN_TIMEOUT", 0.2)
+    providers["groq"].delay = 1.0
+    answer, messages, seconds = ask()
+    assert answer == "openai gpt-4o"
+    assert seconds < 0.8
+    assert failover.provider_health("groq").counts["timeouts"] == 1
+    assert len(messages) == 3
+
+
+def test_slow_primary_is_waited_for_without_a_fallback(providers, monkeypatch):
+    monkeypatch.setattr(failover, "LLM_FAILOVER", False)
+    monkeypatch.setattr(failover, "LLM_FIRST_TOKEN_TIMEOUT", 0.1)
+    providers["groq"].delay = 0.3
+    answer, _, _ = ask()
+    assert answer == "groq llama3-70b-8192"
+
+
+def test_circuit_opens_stays_open_and_closes_after_trial(providers):
+    providers["groq"].error = RateLimited("rate limited")
+    ask()
+    assert failover.provider_health("groq").state() == "closed"
+    ask()
+    assert failover.provider_health("groq").state() == "open"
+
+    # Open: straight to the fallback, the primary is not called
+    calls = providers["groq"].calls
+    answer, _, _ = ask()
+    assert answer == "openai gpt-4o"
+    assert failover.last_call()["attempts"] == 1
+    assert providers["groq"].calls == calls
+
+    # Half-open: the trial request goes to the primary again and closes the circuit
+    providers["groq"].error = None
+    time.sleep(0.35)
+    assert failover.provider_health("groq").state() == "half-open"
+    answer, _, _ = ask()
+    assert answer == "groq llama3-70b-8192"
+    assert failover.provider_health("groq").state() == "closed"
+
+
+def test_failed_trial_reopens_circuit(providers):
+    providers["groq"].error = RateLimited("rate limited")
+    ask()
+    ask()
+    time.sleep(0.35)
+    answer, _, _ = ask()
+    assert answer == "openai gpt-4o"
+    assert failover.provider_health("groq").state() == "open"
+
+
+def test_client_errors_do_not_open_circuit(providers):
+    error = RateLimited("bad request")
+    error.status_code = 400
+    providers["groq"].error = error
+    for _ in range(3):
+        assert ask()[0] == "openai gpt-4o"
+    assert failover.provider_health("groq").state() == "closed"
+
+
+def test_hedge_wins_over_slow_primary(providers, monkeypatch):
+    monkeypatch.setattr(failover, "LLM_HEDGING", True)
+    monkeypatch.setattr(failover, "HEDGE_DEFAULT_DELAY", 0.1)
+    providers["groq"].delay = 0.6
+    answer, messages, seconds = ask()
+    assert answer == "openai gpt-4o"
+    assert failover.last_call()["hedged"]
+    assert seconds < 0.5
+    assert [message.content for message in messages[2:]] == ["openai gpt-4o"]
+
+
+def test_no_hedge_when_primary_is_fast(providers, monkeypatch):
+    monkeypatch.setattr(failover, "LLM_HEDGING", True)
+    monkeypatch.setattr(failover, "HEDGE_DEFAULT_DELAY", 0.5)
+    answer, _, _ = ask()
+    assert answer == "groq llama3-70b-8192"
+    assert not failover.last_call()["hedged"]
+    assert providers["openai"].calls == 0
+
+
+def test_both_providers_failing_raises(providers):
+    providers["groq"].error = RateLimited("groq rate limited")
+    providers["openai"].error = RateLimited("openai rate limited")
+    with pytest.raises(RateLimited):
+        ask()
+
+
+def test_references_fit_the_fallback_window(providers):
+    llm = failover.FailoverOpenAIChat(model="gpt-4o", client=OpenAIClient(api_key="test"), max_tokens=100)
+    assert llm.answer_models() == ["gpt-4o", "llama3-70b-8192"]
@@ -0,0 +1,162 @@
+"""ANN and full-text index maintenance on a hash partitioned (shared layout) vector table.
+
+Needs the Postgres at DB_URL with pgvector and is skipped without it. The
+table is a SharedPgVector under a test name, dropped afterwards.
+"""
+import random
+from typing import List
+
+import pytest
+from phi.document import Document
+from phi.embedder.base import Embedder
+from sqlalchemy.sql.expression import text
+
+import shared_table
+import vector_index
+from shared_table import SharedPgVector
+from retrieval import RetrievalSettings
+from vector_index import maintain_index, maintain_text_index
+
+
+class RandomEmbedder(Embedder):
+    dimensions: int = 8
+
+    def get_embedding(self, text: str) -> List[float]:
+        generator = random.Random(text)
+        return [generator.random() for _ in range(self.dimensions)]
+
+    def get_embedding_and_usage(self, text: str):
+        return self.get_embedding(text), None
+
+
+class TestSharedPgVector(SharedPgVector):
+    __test__ = False
+
+    def __init__(self, *args, table_name: str, **kwargs):
+        self.test_table_name = table_name
+        super().__init__(*args, **kwargs)
+
+    def table_name(self) -> str:
+        return self.test_table_name
+
+
+def documents(kb_name: str, count: int) -> List[Document]:
+    generator = random.Random(kb_name)
+    return [
+        Document(
+            name=kb_name,
+            id=f"{kb_name}_{i}",
+            content=f"chunk {i} of {kb_name}",
+            embedding=[generator.random() for _ in range(8)],
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    from db import get_engine
+    from ingest import upsert_documents
+
+    try:
+        with get_engine().connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    monkeypatch.setattr(shared_table, "SHARED_TABLE_PARTITIONS", 4)
+    monkeypatch.setattr(vector_index, "VECTOR_INDEX_MIN_ROWS", 100)
+    table_name = f"test_shared_{random.randrange(1 << 30)}"
+
+    def vector_db(kb_name: str) -> SharedPgVector:
+        return TestSharedPgVector(
+            collection=f"test_{kb_name}",
+            kb_name=kb_name,
+            table_name=table_name,
+            db_engine=get_engine(),
+            embedder=RandomEmbedder(),
+        )
+
+    def load(kb_name: str, count: int) -> SharedPgVector:
+        kb = vector_db(kb_name)
+        kb.create()
+        upsert_documents(kb, documents(kb_name, count))
+        return kb
+
+    yield load
+    with get_engine().begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{table_name}"))
+
+
+def indexes(vector_db: SharedPgVector, name: str):
+    """(relkind, valid) of the index on the table, and the partitions' indexes attached to it."""
+    with vector_db.db_engine.connect() as conn:
+        parent = conn.execute(
+            text(
+                "SELECT c.relkind, i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+                "WHERE c.relname = :name"
+            ),
+            {"name": name},
+        ).first()
+        children = conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits h JOIN pg_class c ON c.oid = h.inhrelid "
+                "WHERE h.inhparent = (SELECT oid FROM pg_class WHERE relname = :name) ORDER BY c.relname"
+            ),
+            {"name": name},
+        ).scalars().all()
+    return tuple(parent) if parent is not None else None, children
+
+
+def test_hnsw_index_is_built_on_every_partition(shared):
+    shared("alpha", 80)
+    kb = shared("beta", 80)
+    assert maintain_index(kb) == "built"
+    name = kb.index_name()
+    parent, children = indexes(kb, name)
+    assert parent == ("I", True)
+    assert children == [f"{name}_p{remainder}" for remainder in range(4)]
+    found = kb.search("chunk", limit=3)
+    assert len(found) == 3
+    assert all(document.name == "beta" for document in found)
+    assert maintain_index(kb) is None
+
+
+def test_interrupted_build_is_finished(shared):
+    kb = shared("alpha", 150)
+    name = kb.index_name()
+    column, ops = kb.index_column()
+    # As a run that stopped after the first partition leaves it
+    with kb.db_engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX {name} ON ONLY ai.{kb.table.name} USING hnsw ({column} {ops})"))
+        conn.execute(text(f"CREATE INDEX {name}_p0 ON ai.{kb.table.name}_p0 USING hnsw ({column} {ops})"))
+    assert indexes(kb, name)[0] == ("I", False)
+    assert maintain_index(kb) == "built"
+    parent, children = indexes(kb, name)
+    assert parent == ("I", True)
+    assert len(children) == 4
+
+
+def test_ivfflat_index_is_rebuilt(shared, monkeypatch):
+    monkeypatch.setattr(vector_index, "VECTOR_INDEX_TYPE", "ivfflat")
+    kb = shared("alpha", 150)
+    assert maintain_index(kb) == "built"
+    kb = shared("beta", 150)
+    assert maintain_index(kb) == "rebuilt"
+    name = kb.index_name()
+    parent, children = indexes(kb, name)
+    assert parent == ("I", True)
+    assert children == [f"{name}_p{remainder}" for remainder in range(4)]
+    assert indexes(kb, kb.index_name("_new")) == (None, [])
+
+
+def test_text_index_is_built_on_every_partition(shared, monkeypatch):
+    monkeypatch.setattr(vector_index, "get_retrieval_settings", lambda collection: RetrievalSettings(mode="hybrid"))
+    kb = shared("alpha", 20)
+    assert maintain_text_index(kb) == "built"
+    name = kb.text_index_name()
+    parent, children = indexes(kb, name)
+    assert parent == ("I", True)
+    assert children == [f"{name}_p{remainder}" for remainder in range(4)]
+    assert maintain_text_index(kb) is None
+    found = kb.search("chunk", limit=3)
+    assert len(found) == 3
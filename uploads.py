@@ -0,0 +1,109 @@
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
+
+from flask import Request
+
+# Uploaded files are written here once, by werkzeug while it parses the request,
+# and ingestion reads them in place. Keep it on the same filesystem as the job
+# spool and knowledge base folders so uploads can be hard linked there.
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR", os.path.join("uploads", ".spool"))
+# phiapi2 keeps a copy of every upload under uploads/<kb_name> for /list-files
+# and /file-contents; set to false to ingest straight from the spooled file
+KEEP_UPLOADS = os.getenv("KEEP_UPLOADS", "true").lower() != "false"
+
+
+def upload_name(filename: Optional[str]) -> str:
+    name = os.path.basename(filename or "")
+    return name if name not in ("", ".", "..") else "upload"
+
+
+def duplicate_names(uploaded_files: List[Any]) -> List[str]:
+    """Names given to more than one upload; a knowledge base keys its files by name."""
+    names = [upload_name(uploaded_file.filename) for uploaded_file in uploaded_files if uploaded_file.filename != '']
+    return sorted({name for name in names if names.count(name) > 1})
+
+
+class SpooledRequest(Request):
+    """Request that streams each uploaded file to disk under its own name.
+
+    Every file gets a private directory in UPLOAD_SPOOL_DIR, so uploads with the
+    same name never overwrite each other and readers still derive the
+    document name from the file name. The directories go when the request is
+    closed; anything that must outlive the request is hard linked (keep_upload).
+    """
+
+    def _get_file_stream(
+        self,
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str] = None,
+        content_length: Optional[int] = None,
+    ) -> Any:
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        directory = tempfile.mkdtemp(dir=UPLOAD_SPOOL_DIR)
+        self.__dict__.setdefault("_spool_dirs", []).append(directory)
+        return open(os.path.join(directory, upload_name(filename)), "wb+")
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            for directory in self.__dict__.pop("_spool_dirs", []):
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def spooled_path(uploaded_file: Any) -> Optional[str]:
+    """Path of the file an upload was streamed into, or None if it is only in memory."""
+    path = getattr(uploaded_file.stream, "name", None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    uploaded_file.stream.flush()
+    return path
+
+
+def keep_upload(uploaded_file: Any, file_path: str) -> None:
+    """Give an upload a path that outlives the request: a hard link when possible, else a copy."""
+    path = spooled_path(uploaded_file)
+    if path is not None:
+        # Linked under a temporary name first so a reader of file_path never sees it missing
+        temp_path = f"{file_path}.{os.getpid()}.{id(uploaded_file)}.tmp"
+        try:
+            os.link(path, temp_path)
+            os.replace(temp_path, file_path)
+            return
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    uploaded_file.save(file_path)
+
+
+@contextmanager
+def uploaded_paths(uploaded_files: List[Any]) -> Iterator[List[Tuple[str, str]]]:
+    """(file_name, file_path) for each upload, readable until the block exits.
+
+    Spooled uploads are read where werkzeug wrote them; the others are saved to
+    private temporary directories that are removed afterwards.
+    """
+    files: List[Tuple[str, str]] = []
+    directories: List[str] = []
+    try:
+        for uploaded_file in uploaded_files:
+            if uploaded_file.filename == '':
+                logging.error("Error in processing file ")
+                continue
+            file_name = upload_name(uploaded_file.filename)
+            file_path = spooled_path(uploaded_file)
+            if file_path is None or os.path.basename(file_path) != file_name:
+                os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+                directories.append(tempfile.mkdtemp(dir=UPLOAD_SPOOL_DIR))
+                file_path = os.path.join(directories[-1], file_name)
+                uploaded_file.save(file_path)
+            files.append((file_name, file_path))
+        yield files
+    finally:
+        for directory in directories:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,584 @@
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from phi.document import Document
+from phi.vectordb.distance import Distance
+from phi.vectordb.pgvector import PgVector2
+from pgvector.sqlalchemy import Vector
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import Column, Computed, Table
+from sqlalchemy.sql.expression import cast, func, literal_column, select, text
+from sqlalchemy.types import DateTime, Float, String, Text, UserDefinedType
+
+from db import pgvector_version
+from rerank import candidate_count, rerank
+from retrieval import HYBRID_CANDIDATES, TEXT_SEARCH_CONFIG, reciprocal_rank_fusion
+from retrieval import get_settings as get_retrieval_settings
+from storage_profiles import BINARY_RESCORE_OVERSAMPLE, STORAGE_PROFILES, StorageProfile
+
+# Approximate nearest neighbour indexes for the per knowledge base vector tables.
+# Tables smaller than VECTOR_INDEX_MIN_ROWS are scanned exactly; past it an
+# index of VECTOR_INDEX_TYPE (hnsw, ivfflat or none) is built after ingestion.
+# Indexes are built CONCURRENTLY, so uploads and searches go on meanwhile; on
+# a partitioned (shared) table, one partition at a time, see _build_index().
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()
+VECTOR_INDEX_MIN_ROWS = int(os.getenv("VECTOR_INDEX_MIN_ROWS", "5000"))
+VECTOR_INDEX_MAINTENANCE_WORK_MEM = os.getenv("VECTOR_INDEX_MAINTENANCE_WORK_MEM", "1GB")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+# IVFFlat lists are trained on the rows present at build time, so the index is
+# rebuilt once the table has grown by this fraction since
+IVFFLAT_REBUILD_GROWTH = float(os.getenv("IVFFLAT_REBUILD_GROWTH", "0.5"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "10"))
+# Searches of a shared table keep only their knowledge base's rows of what the
+# index scan returns. pgvector >= 0.8 scans on until it has enough of them
+# (iterative scans); older versions stop after ef_search rows or the probed
+# lists, so a small knowledge base could get fewer than top_k chunks. There
+# the scans are widened to these instead.
+SHARED_HNSW_EF_SEARCH = int(os.getenv("SHARED_HNSW_EF_SEARCH", "1000"))
+SHARED_IVFFLAT_PROBES = int(os.getenv("SHARED_IVFFLAT_PROBES", "100"))
+# Threads running the full-text side of hybrid searches (see retrieval.py)
+HYBRID_SEARCH_THREADS = int(os.getenv("HYBRID_SEARCH_THREADS", "8"))
+
+# pgvector cannot index `vector` columns wider than this; wider embeddings are
+# indexed as halfvec (pgvector >= 0.7), which allows up to 4000 dimensions
+VECTOR_MAX_INDEX_DIMENSIONS = 2000
+HALFVEC_MAX_INDEX_DIMENSIONS = 4000
+# Largest hnsw.ef_search pgvector accepts
+HNSW_MAX_EF_SEARCH = 1000
+
+_OPS = {Distance.cosine: "cosine", Distance.l2: "l2", Distance.max_inner_product: "ip"}
+_OPERATORS = {Distance.cosine: "<=>", Distance.l2: "<->", Distance.max_inner_product: "<#>"}
+
+# Shared tables already reported as searched without iterative index scans
+_shallow_scans = set()
+
+# Per request overrides of the search parameters, see set_search_params()
+_search_params: ContextVar[Dict[str, int]] = ContextVar("vector_search_params", default={})
+
+
+def set_search_params(data: Optional[Dict[str, Any]]) -> None:
+    """Use the request's `ef_search` / `probes` (if any) for searches on this thread."""
+    params = {}
+    for key in ("ef_search", "probes"):
+        if data and data.get(key) is not None:
+            params[key] = max(1, int(data[key]))
+    _search_params.set(params)
+
+
+class HalfVector(UserDefinedType):
+    """pgvector's `halfvec` column type (pgvector >= 0.7)."""
+
+    cache_ok = True
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def get_col_spec(self, **kw: Any) -> str:
+        return f"halfvec({self.dimensions})"
+
+    def bind_expression(self, bindvalue):
+        return cast(bindvalue, self)
+
+    def bind_processor(self, dialect):
+        def process(value):
+            return None if value is None else "[" + ",".join(str(float(v)) for v in value) + "]"
+
+        return process
+
+    def result_processor(self, dialect, coltype):
+        def process(value):
+            return None if value is None else [float(v) for v in value[1:-1].split(",")]
+
+        return process
+
+
+# Sign bit of every dimension, used for the binary copy of each embedding.
+# pgvector >= 0.7 has binary_quantize(); this works with any version.
+QUANTIZE_FUNCTION = """
+CREATE OR REPLACE FUNCTION {schema}.quantize_binary(v vector) RETURNS varbit AS $$
+    SELECT string_agg(CASE WHEN x > 0 THEN '1' ELSE '0' END, '' ORDER BY i)::varbit
+    FROM unnest(v::real[]) WITH ORDINALITY AS t(x, i)
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE
+"""
+
+
+def quantize_binary(embedding: List[float]) -> str:
+    return "".join("1" if x > 0 else "0" for x in embedding)
+
+
+class IndexedPgVector(PgVector2):
+    """PgVector2 whose searches can use the index built by `maintain_index`,
+    storing embeddings as described by its storage profile."""
+
+    def __init__(self, *args: Any, profile: Optional[StorageProfile] = None, **kwargs: Any):
+        # Needed by get_table(), which PgVector2.__init__ calls
+        self.profile = profile or STORAGE_PROFILES["full"]
+        super().__init__(*args, **kwargs)
+
+    def table_name(self) -> str:
+        return self.collection
+
+    def table_columns(self) -> List[Column]:
+        embedding_type = HalfVector(self.dimensions) if self.profile.precision == "half" else Vector(self.dimensions)
+        columns = [
+            Column("id", String, primary_key=True),
+            Column("name", String),
+            Column("meta_data", postgresql.JSONB, server_default=text("'{}'::jsonb")),
+            Column("content", postgresql.TEXT),
+            Column("embedding", embedding_type),
+            Column("usage", postgresql.JSONB),
+            Column("created_at", DateTime(timezone=True), server_default=text("now()")),
+            Column("updated_at", DateTime(timezone=True), onupdate=text("now()")),
+            Column("content_hash", String),
+        ]
+        if self.profile.binary:
+            columns.append(
+                Column(
+                    "embedding_bits",
+                    postgresql.BIT(self.dimensions),
+                    Computed(f"{self.schema}.quantize_binary(embedding)", persisted=True),
+                )
+            )
+        return columns
+
+    def get_table(self) -> Table:
+        return Table(self.table_name(), self.metadata, *self.table_columns(), extend_existing=True)
+
+    def scope(self) -> Dict[str, Any]:
+        """Column values identifying this knowledge base's rows; empty when it owns the table."""
+        return {}
+
+    def scoped(self, stmt, table=None):
+        """Restrict a statement on the vector table to this knowledge base's rows."""
+        table = self.table if table is None else table
+        for key, value in self.scope().items():
+            stmt = stmt.where(table.c[key] == value)
+        return stmt
+
+    def create(self) -> None:
+        if self.profile.binary and not self.table_exists():
+            with self.Session() as sess, sess.begin():
+                sess.execute(text("create extension if not exists vector;"))
+                sess.execute(text(f"create schema if not exists {self.schema};"))
+                sess.execute(text(QUANTIZE_FUNCTION.format(schema=self.schema)))
+        super().create()
+
+    def index_type(self) -> str:
+        return VECTOR_INDEX_TYPE
+
+    def index_name(self, suffix: str = "") -> str:
+        # Postgres truncates identifiers to 63 bytes; shorten the table part instead
+        suffix = f"_{self.index_type()}_idx{suffix}"
+        return self.table.name[: 63 - len(suffix)] + suffix
+
+    def index_column(self) -> Optional[Tuple[str, str]]:
+        """The indexed expression and its operator class, or None if the table can't be indexed."""
+        ops = _OPS[self.distance]
+        if self.profile.binary:
+            return ("embedding_bits", "bit_hamming_ops") if pgvector_version(self.db_engine) >= (0, 7) else None
+        if self.profile.precision == "half":
+            return "embedding", f"halfvec_{ops}_ops"
+        if self.dimensions <= VECTOR_MAX_INDEX_DIMENSIONS:
+            return "embedding", f"vector_{ops}_ops"
+        if self.dimensions <= HALFVEC_MAX_INDEX_DIMENSIONS and pgvector_version(self.db_engine) >= (0, 7):
+            return f"(embedding::halfvec({self.dimensions}))", f"halfvec_{ops}_ops"
+        return None
+
+    def optimize(self) -> None:
+        maintain_index(self)
+
+    def _distance(self, table, query_embedding: List[float]):
+        """Exact distance to the query, on the expression the index was built on if there is one."""
+        column = self.index_column()
+        if self.profile.precision == "half" or (column is not None and column[0].startswith("(embedding::halfvec")):
+            expression = "embedding" if self.profile.precision == "half" else column[0]
+            return text(
+                f"{expression} {_OPERATORS[self.distance]} CAST(:query AS halfvec({self.dimensions}))"
+            ).bindparams(query=str(list(query_embedding)))
+        if self.distance == Distance.cosine:
+            return table.c.embedding.cosine_distance(query_embedding)
+        if self.distance == Distance.l2:
+            return table.c.embedding.l2_distance(query_embedding)
+        return table.c.embedding.max_inner_product(query_embedding)
+
+    def _filtered(self, stmt, filters: Optional[Dict[str, Any]]):
+        stmt = self.scoped(stmt)
+        if filters is not None:
+            for key, value in filters.items():
+                if hasattr(self.table.c, key):
+                    stmt = stmt.where(getattr(self.table.c, key) == value)
+        return stmt
+
+    def _columns(self) -> List[Column]:
+        return [
+            self.table.c.id,
+            self.table.c.name,
+            self.table.c.meta_data,
+            self.table.c.content,
+            self.table.c.embedding,
+            self.table.c.usage,
+        ]
+
+    def _vector_rows(self, query_embedding: List[float], limit: int, filters: Optional[Dict[str, Any]]) -> List[Any]:
+        """The `limit` rows nearest to the query embedding, nearest first."""
+        stmt = self._filtered(select(*self._columns()), filters)
+
+        candidates = limit
+        if self.profile.binary:
+            # Shortlist by Hamming distance between the binary codes, then rescore
+            # the shortlist with the full precision embeddings
+            candidates = limit * BINARY_RESCORE_OVERSAMPLE
+            bits = cast(quantize_binary(query_embedding), postgresql.BIT(self.dimensions))
+            if self.index_column() is not None:
+                hamming = self.table.c.embedding_bits.op("<~>", return_type=Float)(bits)
+            else:
+                hamming = func.bit_count(self.table.c.embedding_bits.op("#")(bits))
+            shortlist = stmt.order_by(hamming).limit(candidates).subquery()
+            stmt = select(*shortlist.c).order_by(self._distance(shortlist, query_embedding)).limit(limit)
+        else:
+            # Order by the same expression the index was built on so the planner can use it
+            stmt = stmt.order_by(self._distance(self.table, query_embedding)).limit(limit)
+
+        params = _search_params.get()
+        ef_search = max(params.get("ef_search", HNSW_EF_SEARCH), candidates)
+        probes = params.get("probes", IVFFLAT_PROBES)
+        iterative = bool(self.scope()) and pgvector_version(self.db_engine) >= (0, 8)
+        if self.scope() and not iterative:
+            if self.table.name not in _shallow_scans:
+                _shallow_scans.add(self.table.name)
+                logging.warning(
+                    f"{self.table.name}: pgvector < 0.8 has no iterative index scans; searches use "
+                    f"hnsw.ef_search = {SHARED_HNSW_EF_SEARCH} and ivfflat.probes = {SHARED_IVFFLAT_PROBES}, "
+                    "and a small knowledge base may still get fewer chunks than asked for"
+                )
+            ef_search, probes = max(ef_search, SHARED_HNSW_EF_SEARCH), max(probes, SHARED_IVFFLAT_PROBES)
+        try:
+            with self.Session() as sess, sess.begin():
+                sess.execute(text(f"SET LOCAL hnsw.ef_search = {min(ef_search, HNSW_MAX_EF_SEARCH)}"))
+                sess.execute(text(f"SET LOCAL ivfflat.probes = {probes}"))
+                if iterative:
+                    # Keep scanning the index until enough rows of this knowledge base are found
+                    sess.execute(text("SET LOCAL hnsw.iterative_scan = strict_order"))
+                    sess.execute(text("SET LOCAL ivfflat.iterative_scan = relaxed_order"))
+                return sess.execute(stmt).fetchall() or []
+        except Exception as e:
+            logging.error(f"Error searching for documents: {e}")
+            self.create()
+            return []
+
+    def text_index_name(self) -> str:
+        return self.table.name[: 63 - len("_fts_idx")] + "_fts_idx"
+
+    def _text_rows(self, query: str, limit: int, filters: Optional[Dict[str, Any]]) -> List[Any]:
+        """The `limit` rows best matching the query's words, best first.
+
+        Rows need any of the words, not all of them, and are ranked by
+        ts_rank_cd; the expression is the one the full-text index is built on.
+        """
+        config = literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig")
+        document = func.to_tsvector(config, self.table.c.content)
+        words = func.replace(cast(func.plainto_tsquery(config, query), Text), " & ", " | ")
+        tsquery = cast(words, postgresql.TSQUERY)
+        stmt = self._filtered(select(*self._columns()), filters).where(document.op("@@")(tsquery))
+        stmt = stmt.order_by(func.ts_rank_cd(document, tsquery).desc()).limit(limit)
+        try:
+            with self.Session() as sess, sess.begin():
+                return sess.execute(stmt).fetchall() or []
+        except Exception as e:
+            logging.error(f"Error in full-text search for documents: {e}")
+            return []
+
+    def _documents(self, rows: List[Any]) -> List[Document]:
+        return [
+            Document(
+                name=row.name,
+                meta_data=row.meta_data,
+                content=row.content,
+                embedder=self.embedder,
+                embedding=row.embedding,
+                usage=row.usage,
+            )
+            for row in rows
+        ]
+
+    def search(self, query: str, limit: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        settings = get_retrieval_settings(self.collection)
+        limit = settings.top_k or limit
+        start = time.perf_counter()
+        # A wider candidate set when the knowledge base reranks
+        candidates = candidate_count(settings.reranker, limit)
+        if settings.mode == "hybrid":
+            documents = self.hybrid_search(query, candidates, filters)
+        else:
+            query_embedding = self.embedder.get_embedding(query)
+            if query_embedding is None:
+                logging.error(f"Error getting embedding for Query: {query}")
+                return []
+            documents = self._documents(self._vector_rows(query_embedding, candidates, filters))
+        return rerank(query, documents, limit, settings.reranker, (time.perf_counter() - start) * 1000)
+
+    def hybrid_search(self, query: str, limit: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """Full-text and vector search merged with reciprocal rank fusion.
+
+        The full-text query runs on another thread while the query is embedded
+        and the vector query runs. If the embedding fails, the full-text results
+        are used alone.
+        """
+        if self.table.name not in _text_indexed:
+            # Knowledge bases switched to hybrid after their last upload get the index now,
+            # on a thread of its own so the build never holds a search thread
+            _text_indexed.add(self.table.name)
+            threading.Thread(target=maintain_text_index, args=(self,), name="text-index", daemon=True).start()
+
+        candidates = max(limit, HYBRID_CANDIDATES)
+        text_future = _get_search_pool().submit(self._text_rows, query, candidates, filters)
+        query_embedding = self.embedder.get_embedding(query)
+        if query_embedding is None:
+            logging.error(f"Error getting embedding for Query: {query}")
+            vector_rows = []
+        else:
+            vector_rows = self._vector_rows(query_embedding, candidates, filters)
+        text_rows = text_future.result()
+
+        rows = {row.id: row for row in text_rows + vector_rows}
+        fused = reciprocal_rank_fusion([[row.id for row in vector_rows], [row.id for row in text_rows]])
+        return self._documents([rows[row_id] for row_id in fused[:limit]])
+
+
+# Full-text queries of hybrid searches run here, next to the vector query
+_search_pool: Optional[ThreadPoolExecutor] = None
+_search_pool_lock = threading.Lock()
+# Tables whose full-text index this process has already seen to
+_text_indexed = set()
+
+
+def _get_search_pool() -> ThreadPoolExecutor:
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=HYBRID_SEARCH_THREADS, thread_name_prefix="hybrid-search")
+        return _search_pool
+
+
+def _index_info(conn: Connection, schema: str, name: str) -> Optional[Dict[str, Any]]:
+    row = conn.execute(
+        text(
+            "SELECT i.indisvalid AS valid, obj_description(c.oid, 'pg_class') AS comment "
+            "FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = :schema AND c.relname = :name"
+        ),
+        {"schema": schema, "name": name},
+    ).first()
+    return dict(row._mapping) if row is not None else None
+
+
+@contextmanager
+def _maintenance_connection(vector_db, key: str) -> Iterator[Optional[Connection]]:
+    """Autocommit connection holding the advisory lock `key`, or None if another process holds it.
+
+    CREATE INDEX CONCURRENTLY cannot run in a transaction block, so the lock
+    is a session lock, released before the connection goes back to the pool.
+    """
+    with vector_db.db_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if not conn.execute(text("SELECT pg_try_advisory_lock(hashtext(:key))"), {"key": key}).scalar():
+            yield None
+            return
+        try:
+            conn.execute(text(f"SET maintenance_work_mem = '{VECTOR_INDEX_MAINTENANCE_WORK_MEM}'"))
+            yield conn
+        finally:
+            conn.execute(text("RESET maintenance_work_mem"))
+            conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), {"key": key})
+
+
+def _relkind(conn: Connection, schema: str, name: str) -> Optional[str]:
+    """pg_class.relkind of a relation: 'r' table, 'p' partitioned table, 'i' index, 'I' partitioned index."""
+    return conn.execute(
+        text(
+            "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = :schema AND c.relname = :name"
+        ),
+        {"schema": schema, "name": name},
+    ).scalar()
+
+
+def _partitions(conn: Connection, schema: str, name: str) -> List[Tuple[str, str]]:
+    """(child, table of the child) for each partition of a partitioned table or index."""
+    rows = conn.execute(
+        text(
+            "SELECT c.relname AS child, coalesce(t.relname, c.relname) AS child_table "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent JOIN pg_namespace n ON n.oid = p.relnamespace "
+            "LEFT JOIN pg_index x ON x.indexrelid = c.oid LEFT JOIN pg_class t ON t.oid = x.indrelid "
+            "WHERE n.nspname = :schema AND p.relname = :name ORDER BY c.relname"
+        ),
+        {"schema": schema, "name": name},
+    )
+    return [(row.child, row.child_table) for row in rows]
+
+
+def _partition_index_name(name: str, table: str, partition: str) -> str:
+    """Name of the index `name` of `table` on one of its partitions: <name>_p3 for <table>_p3."""
+    suffix = "_" + (partition[len(table) + 1:] if partition.startswith(table + "_") else partition)
+    return name[: 63 - len(suffix)] + suffix
+
+
+def _build_index(conn: Connection, schema: str, table: str, name: str, using: str) -> None:
+    """CREATE INDEX CONCURRENTLY, also on a partitioned table, where Postgres does not allow it.
+
+    There the index is created (invalid) ON ONLY the parent, then built
+    concurrently on each partition and attached; the parent's index turns
+    valid once every partition's is. Partitions whose index a failed run
+    already built are only attached, so calling this again finishes the job.
+    """
+    if _relkind(conn, schema, table) != "p":
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} ON {schema}.{table} USING {using}"))
+        return
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {schema}.{table} USING {using}"))
+    attached = {child_table for _, child_table in _partitions(conn, schema, name)}
+    for _, partition in _partitions(conn, schema, table):
+        if partition in attached:
+            continue
+        partition_name = _partition_index_name(name, table, partition)
+        info = _index_info(conn, schema, partition_name)
+        if info is not None and not info["valid"]:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {schema}.{partition_name}"))
+            info = None
+        if info is None:
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY {partition_name} ON {schema}.{partition} USING {using}"))
+        conn.execute(text(f"ALTER INDEX {schema}.{name} ATTACH PARTITION {schema}.{partition_name}"))
+
+
+def _drop_index(conn: Connection, schema: str, name: str) -> None:
+    """Drop an index without blocking the table, except a partitioned index, which cannot be dropped CONCURRENTLY.
+
+    Dropping that one only holds the table's lock for as long as removing the files takes.
+    """
+    if _relkind(conn, schema, name) == "I":
+        conn.execute(text(f"DROP INDEX {schema}.{name}"))
+    else:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY {schema}.{name}"))
+
+
+def _create_index(conn: Connection, vector_db: IndexedPgVector, name: str, rows: int) -> None:
+    column, ops = vector_db.index_column()
+    if vector_db.index_type() == "ivfflat":
+        lists = max(1, rows // 1000) if rows <= 1_000_000 else int(math.sqrt(rows))
+        using = f"ivfflat ({column} {ops}) WITH (lists = {lists})"
+    else:
+        using = f"hnsw ({column} {ops}) WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+    _build_index(conn, vector_db.schema, vector_db.table.name, name, using)
+    # Remember the size the index was built for, to decide when to rebuild it
+    conn.execute(text(f"COMMENT ON INDEX {vector_db.schema}.{name} IS 'rows={rows}'"))
+
+
+# Tables already reported as impossible to index with the installed pgvector
+_unindexable = set()
+
+
+def maintain_index(vector_db) -> Optional[str]:
+    """Build the knowledge base's ANN index once the table is large enough, and
+    rebuild an IVFFlat index the table has outgrown. Returns what was done.
+
+    Called after ingestion; concurrent calls for the same table are skipped.
+    """
+    if not isinstance(vector_db, IndexedPgVector) or vector_db.index_type() not in ("hnsw", "ivfflat"):
+        return None
+    if vector_db.index_column() is None:
+        if vector_db.table.name not in _unindexable:
+            _unindexable.add(vector_db.table.name)
+            logging.warning(
+                f"{vector_db.table.name}: the '{vector_db.profile.name}' storage profile needs pgvector >= 0.7 to be indexed"
+            )
+        return None
+
+    table = f"{vector_db.schema}.{vector_db.table.name}"
+    name = vector_db.index_name()
+    with _maintenance_connection(vector_db, table) as conn:
+        if conn is None:
+            return None
+        rows = conn.execute(text(f"SELECT count(*) FROM {table}")).scalar() or 0
+        info = _index_info(conn, vector_db.schema, name)
+        if info is not None and not info["valid"]:
+            # Left behind by a concurrent build that failed; a partitioned one is finished instead
+            if _relkind(conn, vector_db.schema, name) != "I":
+                _drop_index(conn, vector_db.schema, name)
+            info = None
+
+        if info is None:
+            if rows < VECTOR_INDEX_MIN_ROWS:
+                return None
+            logging.info(f"Building {vector_db.index_type()} index on {table} ({rows} rows)")
+            _create_index(conn, vector_db, name, rows)
+            return "built"
+
+        if vector_db.index_type() == "ivfflat":
+            built_rows = int((info["comment"] or "rows=0").split("=")[1])
+            if rows > built_rows * (1 + IVFFLAT_REBUILD_GROWTH):
+                # Build the replacement first so searches keep using the old index meanwhile
+                logging.info(f"Rebuilding ivfflat index on {table} ({built_rows} -> {rows} rows)")
+                new_name = vector_db.index_name("_new")
+                new_info = _index_info(conn, vector_db.schema, new_name)
+                if new_info is not None:
+                    _drop_index(conn, vector_db.schema, new_name)
+                _create_index(conn, vector_db, new_name, rows)
+                # Swapped in one short transaction, so searches always have an index
+                with vector_db.db_engine.begin() as swap:
+                    swap.execute(text(f"DROP INDEX {vector_db.schema}.{name}"))
+                    swap.execute(text(f"ALTER INDEX {vector_db.schema}.{new_name} RENAME TO {name}"))
+                    # The partitions' indexes take their names too, freeing the _new ones for the next rebuild
+                    for child, partition in _partitions(swap, vector_db.schema, name):
+                        child_name = _partition_index_name(name, vector_db.table.name, partition)
+                        swap.execute(text(f"ALTER INDEX {vector_db.schema}.{child} RENAME TO {child_name}"))
+                return "rebuilt"
+    return None
+
+
+def maintain_text_index(vector_db) -> Optional[str]:
+    """Build the full-text index of a knowledge base searched in hybrid mode. Returns what was done.
+
+    Called after ingestion, and in the background by the first hybrid search on
+    a table in each process.
+    """
+    if not isinstance(vector_db, IndexedPgVector) or get_retrieval_settings(vector_db.collection).mode != "hybrid":
+        return None
+    table = f"{vector_db.schema}.{vector_db.table.name}"
+    name = vector_db.text_index_name()
+    _text_indexed.add(vector_db.table.name)
+    if not vector_db.table_exists():
+        return None
+    try:
+        with _maintenance_connection(vector_db, table + ":fts") as conn:
+            if conn is None:
+                return None
+            info = _index_info(conn, vector_db.schema, name)
+            if info is not None and info["valid"]:
+                return None
+            if info is not None and _relkind(conn, vector_db.schema, name) != "I":
+                # Left behind by a concurrent build that failed; a partitioned one is finished instead
+                _drop_index(conn, vector_db.schema, name)
+            logging.info(f"Building full-text index on {table}")
+            _build_index(
+                conn,
+                vector_db.schema,
+                vector_db.table.name,
+                name,
+                f"gin (to_tsvector('{TEXT_SEARCH_CONFIG}'::regconfig, content))",
+            )
+            return "built"
+    except Exception as e:
+        # Hybrid searches still work without the index, only slower
+        _text_indexed.discard(vector_db.table.name)
+        logging.error(f"Could not build the full-text index of {table}: {e}")
+        return None